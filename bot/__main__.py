@@ -3,6 +3,7 @@ import logging
 import os
 import sys # Добавляем sys
 import time # Добавляем time для работы с временем
+import datetime
 import shutil # Добавляем shutil для работы с файлами и папками
 # import aioschedule # Удаляем импорт aioschedule
 from apscheduler.schedulers.asyncio import AsyncIOScheduler # <--- Импортируем APScheduler
@@ -18,6 +19,7 @@ from bot.services.captcha import CaptchaService
 from bot.services.subscription import SubscriptionService
 # Добавляем импорт нового сервиса очистки пользователей
 from bot.services.user_cleanup_service import scheduled_user_cleanup_task
+from bot.services.channel_mgmt import shutdown_background_tasks
 
 # Импортируем настройки для доступа к BOT_USERNAME
 from bot.config import settings, BOT_OWNER_ID # Импортируем BOT_OWNER_ID для напоминаний
@@ -267,6 +269,30 @@ async def main():
     )
     logger.info("Запланирована задача scheduled_user_cleanup_task (каждые 24 часа) через APScheduler.")
 
+    # Ежедневное массовое обновление кэша подписок. CronTrigger корректно переживает переходы часов,
+    # в отличие от прежнего цикла со sleep до вычисленного datetime
+    scheduler.add_job(
+        subscription_service.update_all_subscriptions_cache,
+        trigger='cron',
+        hour=5,
+        minute=0,
+        id='subscription_cache_update_job',
+        replace_existing=True
+    )
+    logger.info("Запланирована задача update_all_subscriptions_cache (ежедневно в 05:00) через APScheduler.")
+
+    # Данные привязанных каналов (название, ссылка) для предупреждений о подписке: первый прогрев сразу
+    # при старте, затем каждые 5 минут - записи кэша живут 10 минут и не успевают устареть
+    scheduler.add_job(
+        subscription_service.warm_channel_cache,
+        trigger='interval',
+        minutes=5,
+        next_run_time=datetime.datetime.now(datetime.timezone.utc),
+        id='channel_cache_warm_job',
+        replace_existing=True
+    )
+    logger.info("Запланирована задача warm_channel_cache (при старте и каждые 5 минут) через APScheduler.")
+
     scheduler.start()
     logger.info("APScheduler запущен.")
     # --- Конец блока APScheduler --- 
@@ -302,6 +328,9 @@ async def main():
         if scheduler.running:
             scheduler.shutdown()
         logger.info("APScheduler остановлен.")
+
+        await shutdown_background_tasks()
+        logger.info("Фоновые задачи управления каналами завершены.")
         
         logger.info("Завершение работы бота...")
         try:
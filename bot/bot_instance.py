@@ -3,6 +3,7 @@ import asyncio # Возможно, потребуется asyncio для Captcha
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties # Для ParseMode
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.storage.memory import MemoryStorage # Импорт хранилища
 
 # Обновленный импорт DatabaseManager
@@ -28,8 +29,16 @@ storage = MemoryStorage()
 # Инициализация бота и диспетчера
 # Убираем db_manager из конструктора Dispatcher
 dp = Dispatcher(storage=storage) 
+
+# Одна HTTP-сессия на все запросы бота. Соединения с api.telegram.org держим открытыми дольше
+# стандартных 15 сек., чтобы пачки запросов (очистка пользователей, обновление кэша подписок)
+# шли по уже установленным TLS-соединениям, а не открывали новые
+session = AiohttpSession(limit=100)
+session._connector_init.update(keepalive_timeout=75, enable_cleanup_closed=True)
+
 bot = Bot(
     token=settings.bot_token.get_secret_value(),
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
@@ -4,7 +4,7 @@
 import logging
 import time
 import json
-from typing import Optional, List, Tuple, Dict, Any, Union
+from typing import Optional, List, Tuple, Dict, Any, Union, AsyncIterator
 import aiosqlite
 import os
 import sqlite3
@@ -64,6 +64,29 @@ class DatabaseManager:
                                 logger.error(f"Ошибка ALTER TABLE chats ADD COLUMN {col_name}: {oe}", exc_info=True)
                                 raise # Перебрасываем другие ошибки
 
+                # --- Миграции для таблицы 'users' ---
+                logger.debug("Проверка и применение миграций для таблицы 'users'...")
+                cursor_info_users = await db.execute("PRAGMA table_info(users)")
+                existing_columns_users = {row['name'] for row in await cursor_info_users.fetchall()}
+                user_columns_to_ensure = {
+                    "is_bot": "INTEGER DEFAULT 0",
+                    "last_cleanup_check_ts": "INTEGER DEFAULT NULL"
+                }
+
+                for col_name, col_def in user_columns_to_ensure.items():
+                    if col_name not in existing_columns_users:
+                        logger.info(f"Миграция (users): Добавление колонки '{col_name}'...")
+                        try:
+                            await db.execute(f"ALTER TABLE users ADD COLUMN {col_name} {col_def}")
+                            migration_applied_overall = True
+                            logger.info(f"Миграция (users): Колонка '{col_name}' добавлена.")
+                        except aiosqlite.OperationalError as oe:
+                            if "duplicate column name" in str(oe).lower():
+                                logger.warning(f"Миграция (users): Колонка '{col_name}' уже существует.")
+                            else:
+                                logger.error(f"Ошибка ALTER TABLE users ADD COLUMN {col_name}: {oe}", exc_info=True)
+                                raise
+
                 # --- Миграции для таблицы 'users_status_in_chats' ---
                 logger.debug("Проверка существования таблицы 'users_status_in_chats' для миграций...")
                 cursor_check_users_status_table = await db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users_status_in_chats'")
@@ -146,6 +169,8 @@ class DatabaseManager:
             async with aiosqlite.connect(self.db_path) as db:
                 # Включаем поддержку внешних ключей
                 await db.execute("PRAGMA foreign_keys = ON")
+                # В режиме WAL NORMAL безопасен и избавляет от fsync на каждом коммите
+                await db.execute("PRAGMA synchronous = NORMAL")
                 db.row_factory = aiosqlite.Row # Возвращать строки как объекты Row
                 
                 # Если query не None, выполняем его
@@ -171,6 +196,10 @@ class DatabaseManager:
 
     async def init_db(self):
         """Инициализация таблиц базы данных (НОВАЯ СХЕМА)."""
+        # WAL сохраняется в файле БД: читатели не блокируют писателя, а коммит не требует fsync основного файла
+        async with aiosqlite.connect(self.db_path) as db:
+            await db.execute("PRAGMA journal_mode=WAL")
+
         # --- 1. Создание всех таблиц ---
         # Таблица пользователей (глобальная информация)
         await self._execute("""
@@ -181,8 +210,10 @@ class DatabaseManager:
                 last_name TEXT,
                 language_code TEXT,
                 is_premium INTEGER DEFAULT 0,
+                is_bot INTEGER DEFAULT 0, -- Заполняется из message.from_user.is_bot, чтобы не запрашивать API
                 first_seen_timestamp INTEGER NOT NULL,
                 last_seen_timestamp INTEGER,
+                last_cleanup_check_ts INTEGER DEFAULT NULL, -- Когда задача очистки последний раз подтвердила через API, что аккаунт жив
                 referrer_id INTEGER, -- ID пользователя, который его пригласил
                 FOREIGN KEY (referrer_id) REFERENCES users(user_id) ON DELETE SET NULL
             )
@@ -337,7 +368,8 @@ class DatabaseManager:
         last_name: Optional[str] = None, 
         language_code: Optional[str] = None,
         is_premium: Optional[bool] = False,
-        referrer_id: Optional[int] = None # Принимаем ID реферера при первом добавлении
+        referrer_id: Optional[int] = None, # Принимаем ID реферера при первом добавлении
+        is_bot: Optional[bool] = None # None - не менять сохраненное значение
     ) -> bool:
         """Добавляет пользователя, если его нет. Возвращает True, если пользователь был добавлен, False - если уже существовал."""
         current_time = int(time.time())
@@ -346,18 +378,18 @@ class DatabaseManager:
         if existing_user:
             # Обновляем last_seen и, возможно, другую информацию
             await self._execute(
-                """UPDATE users SET last_seen_timestamp = ?, username = ?, first_name = ?, last_name = ?, language_code = ?, is_premium = ? 
+                """UPDATE users SET last_seen_timestamp = ?, username = ?, first_name = ?, last_name = ?, language_code = ?, is_premium = ?, is_bot = COALESCE(?, is_bot) 
                 WHERE user_id = ?""",
-                (current_time, username, first_name, last_name, language_code, int(is_premium or 0), user_id),
+                (current_time, username, first_name, last_name, language_code, int(is_premium or 0), None if is_bot is None else int(is_bot), user_id),
                 commit=True
             )
             return False # Пользователь уже существовал
         else:
             # Добавляем нового пользователя
             await self._execute(
-                """INSERT INTO users (user_id, username, first_name, last_name, language_code, is_premium, first_seen_timestamp, last_seen_timestamp, referrer_id) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (user_id, username, first_name, last_name, language_code, int(is_premium or 0), current_time, current_time, referrer_id),
+                """INSERT INTO users (user_id, username, first_name, last_name, language_code, is_premium, is_bot, first_seen_timestamp, last_seen_timestamp, referrer_id) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, username, first_name, last_name, language_code, int(is_premium or 0), int(is_bot or 0), current_time, current_time, referrer_id),
                 commit=True
             )
             logger.info(f"Добавлен новый пользователь: {user_id} ({username}), referrer: {referrer_id}")
@@ -443,24 +475,43 @@ class DatabaseManager:
             return result
         return None
 
-    async def toggle_setting(self, chat_id: int, setting_name: str) -> Optional[bool]:
-        """Переключает настройку (captcha_enabled или subscription_check_enabled)."""
+    async def flip_setting(self, chat_id: int, setting_name: str, admin_user_id: Optional[int] = None) -> Optional[bool]:
+        """Переключает настройку (captcha_enabled или subscription_check_enabled) без предварительного чтения.
+
+        UPDATE и чтение нового значения выполняются в одном соединении/транзакции.
+        Возвращает новое значение настройки или None при ошибке.
+        """
         if setting_name not in ['captcha_enabled', 'subscription_check_enabled']:
             logger.error(f"Попытка переключить неизвестную настройку: {setting_name}")
             return None
 
-        settings = await self.get_chat_settings(chat_id)
-        if not settings: return None
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("PRAGMA foreign_keys = ON")
+                await db.execute("PRAGMA synchronous = NORMAL")
+                # Все изменения ниже фиксируются одним коммитом
+                # Чат мог еще не попасть в БД - создаем запись с настройками по умолчанию
+                await db.execute(
+                    "INSERT OR IGNORE INTO chats (chat_id, added_timestamp, setup_complete) VALUES (?, ?, 0)",
+                    (chat_id, int(time.time()))
+                )
+                # NULL считаем включенной настройкой (как в get_chat_settings), поэтому COALESCE(..., 1)
+                await db.execute(
+                    f"UPDATE chats SET {setting_name} = 1 - COALESCE({setting_name}, 1) WHERE chat_id = ?",
+                    (chat_id,)
+                )
+                cursor = await db.execute(f"SELECT {setting_name} FROM chats WHERE chat_id = ?", (chat_id,))
+                row = await cursor.fetchone()
+                await db.commit()
+        except aiosqlite.Error as e:
+            logger.error(f"Ошибка SQLite при переключении настройки '{setting_name}' для чата {chat_id}: {e}", exc_info=True)
+            return None
 
-        current_value = settings[setting_name]
-        new_value = 1 - (current_value or 0) # Переключаем 0 -> 1, 1 -> 0, None -> 1
-        await self._execute(
-            f"UPDATE chats SET {setting_name} = ? WHERE chat_id = ?",
-            (new_value, chat_id),
-            commit=True
-        )
-        logger.info(f"Настройка '{setting_name}' для чата {chat_id} переключена на {new_value}")
-        return bool(new_value)
+        if row is None:
+            return None
+        new_value = bool(row[0])
+        logger.info(f"Настройка '{setting_name}' для чата {chat_id} переключена на {int(new_value)} (admin={admin_user_id})")
+        return new_value
 
     async def update_chat_settings(self, chat_id: int, settings: Dict[str, Any]) -> bool:
         """Обновляет настройки чата в базе данных."""
@@ -735,6 +786,34 @@ class DatabaseManager:
         # Просто логируем попытку
         logger.info(f"[DB] Попытка сброса статуса бана для user {user_id} в чате {chat_id}")
 
+    async def get_active_bans_in_chat(self, chat_id: int) -> Dict[int, int]:
+        """{user_id: ban_until_ts} для всех пользователей чата с еще не истекшим мутом - одним запросом."""
+        query = "SELECT user_id, ban_until_ts FROM users_status_in_chats WHERE chat_id = ? AND ban_until_ts > ?"
+        try:
+            rows = await self._execute(query, (chat_id, int(time.time())), fetchall=True)
+            return {row['user_id']: row['ban_until_ts'] for row in rows} if rows else {}
+        except Exception as e:
+            logger.error(f"[DB] Ошибка при получении активных мутов в чате {chat_id}: {e}", exc_info=True)
+            return {}
+
+    async def bulk_clear_ban_until(self, chat_id: int, user_ids: List[int]) -> None:
+        """Обнуляет ban_until_ts для списка пользователей чата одной транзакцией (executemany)."""
+        if not user_ids:
+            return
+        current_time = int(time.time())
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("PRAGMA synchronous = NORMAL")
+                await db.executemany(
+                    "UPDATE users_status_in_chats SET ban_until_ts = 0, last_update_timestamp = ? WHERE user_id = ? AND chat_id = ?",
+                    [(current_time, user_id, chat_id) for user_id in user_ids]
+                )
+                await db.commit()
+        except aiosqlite.Error as e:
+            logger.error(f"[DB] Ошибка SQLite при массовом сбросе мутов в чате {chat_id}: {e}", exc_info=True)
+            return
+        logger.info(f"[DB] Сброшен мут для {len(user_ids)} пользователей в чате {chat_id}")
+
     async def update_user_warnings(self, user_id: int, chat_id: int, warnings_count: int):
         """Обновляет счетчик предупреждений для пользователя в чате."""
         current_time = int(time.time())
@@ -774,6 +853,7 @@ class DatabaseManager:
     async def get_active_chat_users(self, chat_id: int, days: int = 7) -> List[int]:
         """
         Получает список ID активных пользователей чата за последние N дней.
+        Боты (users.is_bot) и служебный аккаунт Telegram (777000) отфильтровываются на стороне БД.
         
         Args:
             chat_id: ID чата
@@ -789,8 +869,10 @@ class DatabaseManager:
             async with aiosqlite.connect(self.db_path) as db:
                 # Запрос к таблице user_status, получаем пользователей, которые писали сообщения недавно
                 query = """
-                SELECT user_id FROM users_status_in_chats
-                WHERE chat_id = ? AND last_update_timestamp > ?
+                SELECT s.user_id FROM users_status_in_chats s
+                LEFT JOIN users u ON u.user_id = s.user_id
+                WHERE s.chat_id = ? AND s.last_update_timestamp > ?
+                AND COALESCE(u.is_bot, 0) = 0 AND s.user_id != 777000
                 """
                 rows = await db.execute(query, (chat_id, cutoff_time))
                 results = await rows.fetchall()
@@ -800,8 +882,10 @@ class DatabaseManager:
                 # Если нет данных о последних сообщениях, вернем всех пользователей из чата
                 if not user_ids:
                     backup_query = """
-                    SELECT user_id FROM users_status_in_chats
-                    WHERE chat_id = ?
+                    SELECT s.user_id FROM users_status_in_chats s
+                    LEFT JOIN users u ON u.user_id = s.user_id
+                    WHERE s.chat_id = ?
+                    AND COALESCE(u.is_bot, 0) = 0 AND s.user_id != 777000
                     """
                     backup_rows = await db.execute(backup_query, (chat_id,))
                     backup_results = await backup_rows.fetchall()
@@ -812,6 +896,86 @@ class DatabaseManager:
             logger.error(f"Ошибка при получении активных пользователей чата {chat_id}: {e}", exc_info=True)
             return [] 
 
+    async def get_all_linked_channels(self) -> Dict[int, List[int]]:
+        """
+        Возвращает привязанные каналы сразу для всех активных чатов с проверкой подписки
+        одним запросом: {chat_id: [channel_id, ...]}.
+        """
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                query = """
+                SELECT l.group_chat_id, l.channel_id FROM chat_channel_links l
+                JOIN chats c ON c.chat_id = l.group_chat_id
+                WHERE c.subscription_check_enabled = 1 AND c.setup_complete = 1
+                """
+                rows = await db.execute(query)
+                links_by_chat: Dict[int, List[int]] = {}
+                for chat_id, channel_id in await rows.fetchall():
+                    links_by_chat.setdefault(chat_id, []).append(channel_id)
+                return links_by_chat
+        except Exception as e:
+            logger.error(f"Ошибка при массовом получении привязанных каналов: {e}", exc_info=True)
+            return {}
+
+    async def count_active_chats_with_subscription_check(self) -> int:
+        """Количество активных чатов с включенной проверкой подписки (для логов прогресса)."""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "SELECT COUNT(*) FROM chats WHERE subscription_check_enabled = 1 AND setup_complete = 1"
+                )
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+        except Exception as e:
+            logger.error(f"Ошибка при подсчете активных чатов с проверкой подписки: {e}", exc_info=True)
+            return 0
+
+    async def iter_active_users_by_chat(self, days: int = 7, chats_per_page: int = 20) -> AsyncIterator[Tuple[int, List[int]]]:
+        """
+        Потоково отдает (chat_id, [user_id, ...]) для всех активных чатов с проверкой подписки.
+        Чаты читаются страницами по chats_per_page (по возрастанию chat_id), каждая страница - своим
+        коротким соединением, которое закрывается до того, как строки уходят потребителю.
+        Потребитель (массовая проверка подписок) может идти часами, и долгий читатель не должен
+        держать снимок БД: в режиме WAL он не дает завершиться checkpoint и -wal растет.
+        Как и в get_active_chat_users, если в чате нет активных за N дней, берутся все его пользователи;
+        боты и служебный аккаунт Telegram (777000) отфильтровываются.
+        """
+        cutoff_time = int(time.time()) - (days * 24 * 60 * 60)
+        chats_query = """
+        SELECT chat_id FROM chats
+        WHERE subscription_check_enabled = 1 AND setup_complete = 1 AND chat_id > ?
+        ORDER BY chat_id LIMIT ?
+        """
+        users_query = """
+        SELECT s.chat_id, s.user_id, s.last_update_timestamp FROM users_status_in_chats s
+        LEFT JOIN users u ON u.user_id = s.user_id
+        WHERE s.chat_id IN ({placeholders})
+        AND COALESCE(u.is_bot, 0) = 0 AND s.user_id != 777000
+        """
+        last_chat_id: Optional[int] = None
+        while True:
+            async with aiosqlite.connect(self.db_path) as db:
+                # chat_id групп отрицательные, поэтому стартуем с заведомо меньшего значения, а не с 0
+                async with db.execute(chats_query, (last_chat_id if last_chat_id is not None else -(2 ** 63), chats_per_page)) as cursor:
+                    chat_ids = [row[0] for row in await cursor.fetchall()]
+                if not chat_ids:
+                    return
+                placeholders = ",".join("?" * len(chat_ids))
+                async with db.execute(users_query.format(placeholders=placeholders), chat_ids) as cursor:
+                    rows = await cursor.fetchall()
+            last_chat_id = chat_ids[-1]
+
+            recent_users: Dict[int, List[int]] = {}
+            all_users: Dict[int, List[int]] = {}
+            for chat_id, user_id, last_update_ts in rows:
+                all_users.setdefault(chat_id, []).append(user_id)
+                if last_update_ts is not None and last_update_ts > cutoff_time:
+                    recent_users.setdefault(chat_id, []).append(user_id)
+            # Чаты без единого известного пользователя не отдаются (как и раньше при JOIN)
+            for chat_id in chat_ids:
+                if chat_id in all_users:
+                    yield chat_id, recent_users.get(chat_id) or all_users[chat_id]
+
     async def update_user_subscription_status(self, chat_id: int, user_id: int, is_subscribed: bool, timestamp: int = None) -> None:
         """Обновляет статус подписки пользователя в БД"""
         if timestamp is None:
@@ -951,6 +1115,51 @@ class DatabaseManager:
         params = (user_id, chat_id)
         await self._execute(query, params, commit=True) 
 
+    async def finalize_mute(self, user_id: int, chat_id: int, ban_until_ts: int) -> bool:
+        """Записывает время мута и обнуляет счетчик неудач подписки одним запросом (одна транзакция вместо двух).
+
+        Возвращает True при успехе, False при ошибке SQLite.
+        """
+        current_time = int(time.time())
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("PRAGMA foreign_keys = ON")
+                await db.execute("PRAGMA synchronous = NORMAL")
+                # Пользователь и чат к этому моменту обычно уже есть в БД; INSERT OR IGNORE не затирает их данные
+                await db.execute(
+                    "INSERT OR IGNORE INTO users (user_id, first_name, first_seen_timestamp, last_seen_timestamp) VALUES (?, ?, ?, ?)",
+                    (user_id, f"User_{user_id}", current_time, current_time)
+                )
+                await db.execute(
+                    "INSERT OR IGNORE INTO chats (chat_id, added_timestamp, setup_complete) VALUES (?, ?, 0)",
+                    (chat_id, current_time)
+                )
+                await db.execute(
+                    """INSERT INTO users_status_in_chats (user_id, chat_id, ban_until_ts, subscription_fail_count, last_update_timestamp)
+                       VALUES (?, ?, ?, 0, ?)
+                       ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                           ban_until_ts = excluded.ban_until_ts,
+                           subscription_fail_count = 0,
+                           last_update_timestamp = excluded.last_update_timestamp""",
+                    (user_id, chat_id, ban_until_ts, current_time)
+                )
+                await db.commit()
+        except aiosqlite.Error as e:
+            logger.error(f"[DB] Ошибка SQLite при сохранении мута для user {user_id} в чате {chat_id}: {e}", exc_info=True)
+            return False
+        logger.info(f"[DB] Мут для user {user_id} в чате {chat_id} до {ban_until_ts} сохранен, счетчик неудач сброшен")
+        return True
+
+    async def clear_ban_and_fails(self, user_id: int, chat_id: int):
+        """Сбрасывает статус бана (ban_until_ts, ban_reason) и счетчик неудач подписки одним UPDATE."""
+        query = """
+            UPDATE users_status_in_chats
+            SET ban_until_ts = NULL, ban_reason = NULL, subscription_fail_count = 0
+            WHERE user_id = ? AND chat_id = ?;
+        """
+        await self._execute(query, (user_id, chat_id), commit=True)
+        logger.info(f"[DB] Сброшены статус бана и счетчик неудач для user {user_id} в чате {chat_id}")
+
     async def update_user_granted_access(self, user_id: int, chat_id: int, access_until_ts: Optional[int]):
         """Обновляет или устанавливает срок предоставленного доступа для пользователя в чате."""
         current_time = int(time.time())
@@ -1149,29 +1358,75 @@ class DatabaseManager:
             # В случае ошибки, возвращаем ID как названия, без ссылок
             return [{'channel_id': ch_id, 'channel_title': f'Канал ID {ch_id}', 'channel_link': None} for ch_id in channel_ids] 
 
-    async def get_users_for_cleanup_check(self, batch_size: int) -> List[Dict[str, Any]]:
+    async def iter_users_for_cleanup_check(self, batch_size: int) -> AsyncIterator[int]:
         """
-        Выбирает пользователей для проверки на предмет удаления.
-        Возвращает список словарей с user_id, отсортированных по last_seen_timestamp (старые сначала).
+        Потоково отдает user_id для проверки на предмет удаления (не более batch_size):
+        сначала никогда не проверявшиеся и проверенные давнее всего (last_cleanup_check_ts),
+        затем по last_seen_timestamp (старые сначала). Строки читаются курсором, без промежуточного списка.
+        SQLite при ASC ставит NULL первыми, так что еще не "виденные" пользователи тоже идут в начале.
+        Ошибки БД пробрасываются вызывающему.
         """
         query = """
             SELECT user_id
             FROM users
-            ORDER BY last_seen_timestamp ASC 
+            ORDER BY last_cleanup_check_ts ASC, last_seen_timestamp ASC
             LIMIT ?
         """
-        # last_seen_timestamp ASC NULLS FIRST - если есть NULL значения, они будут первыми
-        # Если last_seen_timestamp не может быть NULL, то просто ASC
-        # В текущей схеме users.last_seen_timestamp может быть NULL, если пользователь был добавлен, но еще не "виделся"
-        # Это маловероятно для старых записей, но для полноты можно использовать:
-        # ORDER BY last_seen_timestamp ASC NULLS FIRST
-        # Однако, SQLite по умолчанию обрабатывает NULL как наименьшие значения при ASC, так что это должно работать.
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(query, (batch_size,)) as cursor:
+                async for (user_id,) in cursor:
+                    yield user_id
+
+    async def apply_cleanup_results(self, alive_user_ids: List[int], deleted_user_ids: List[int]) -> int:
+        """Записывает итог проверки очистки одной транзакцией: отмечает живых пользователей проверенными
+        (last_cleanup_check_ts) и удаляет найденных удаленных.
 
+        Возвращает количество удаленных пользователей (0 при ошибке - тогда не применяется ничего).
+        """
+        if not alive_user_ids and not deleted_user_ids:
+            return 0
+        deleted_count = 0
         try:
-            rows = await self._execute(query, (batch_size,), fetchall=True)
-            return [dict(row) for row in rows] if rows else []
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("PRAGMA foreign_keys = ON")
+                await db.execute("PRAGMA synchronous = NORMAL")
+                # UPDATE и DELETE фиксируются одним коммитом
+                if alive_user_ids:
+                    placeholders = ",".join("?" for _ in alive_user_ids)
+                    await db.execute(
+                        f"UPDATE users SET last_cleanup_check_ts = ? WHERE user_id IN ({placeholders})",
+                        (int(time.time()), *alive_user_ids)
+                    )
+                if deleted_user_ids:
+                    placeholders = ",".join("?" for _ in deleted_user_ids)
+                    cursor = await db.execute(f"DELETE FROM users WHERE user_id IN ({placeholders})", tuple(deleted_user_ids))
+                    deleted_count = cursor.rowcount
+                await db.commit()
+        except aiosqlite.Error as e:
+            logger.error(f"[DB] Ошибка SQLite при сохранении результатов очистки пользователей: {e}", exc_info=True)
+            return 0
+        logger.info(f"[DB] Очистка: отмечено {len(alive_user_ids)} проверенных, удалено {deleted_count} из {len(deleted_user_ids)} запрошенных пользователей.")
+        return deleted_count
+
+    async def get_likely_dead_users(self, inactive_days: int, limit: int) -> List[int]:
+        """
+        Возвращает ID пользователей, которых бот не видел дольше inactive_days дней (самые старые первыми).
+        Это только кандидаты на проверку через API: last_seen_timestamp обновляется при входе в чат и /start,
+        но не на каждом сообщении, поэтому удалять по нему напрямую нельзя.
+        """
+        cutoff_ts = int(time.time()) - inactive_days * 86400
+        query = """
+            SELECT user_id
+            FROM users
+            WHERE last_seen_timestamp < ?
+            ORDER BY last_seen_timestamp ASC
+            LIMIT ?
+        """
+        try:
+            rows = await self._execute(query, (cutoff_ts, limit), fetchall=True)
+            return [row['user_id'] for row in rows] if rows else []
         except Exception as e:
-            logger.error(f"[DB] Ошибка при выборе пользователей для проверки очистки: {e}", exc_info=True)
+            logger.error(f"[DB] Ошибка при выборе давно неактивных пользователей: {e}", exc_info=True)
             return []
 
     async def delete_users_by_ids(self, user_ids: List[int]) -> int:
@@ -44,7 +44,7 @@ async def toggle_captcha_command(message: types.Message, bot: Bot, db_manager: D
         return
 
     chat_id = message.chat.id
-    new_state = await db_manager.toggle_setting(chat_id, 'captcha_enabled')
+    new_state = await db_manager.flip_setting(chat_id, 'captcha_enabled', message.from_user.id)
     if new_state is not None:
         status = "включена" if new_state else "выключена"
         await message.reply(f"✅ Проверка капчей для новых пользователей теперь {status}.")
@@ -57,7 +57,7 @@ async def toggle_sub_check_command(message: types.Message, bot: Bot, db_manager:
         return
 
     chat_id = message.chat.id
-    new_state = await db_manager.toggle_setting(chat_id, 'subscription_check_enabled')
+    new_state = await db_manager.flip_setting(chat_id, 'subscription_check_enabled', message.from_user.id)
     if new_state is not None:
         status = "включена" if new_state else "выключена"
         await message.reply(f"✅ Проверка подписки на каналы теперь {status}.")
@@ -7,7 +7,7 @@
 """
 import logging
 from aiogram import Router, Bot, F, types
-from aiogram.filters import Command, ChatMemberUpdatedFilter, ADMINISTRATOR, Filter, IS_ADMIN, IS_MEMBER
+from aiogram.filters import Command, ChatMemberUpdatedFilter, ADMINISTRATOR, Filter, IS_ADMIN, IS_MEMBER, IS_NOT_MEMBER
 from aiogram.enums import ChatType, ContentType, ChatMemberStatus
 from aiogram.fsm.context import FSMContext
 from aiogram.types import ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup
@@ -24,6 +24,7 @@ from bot.db.database import DatabaseManager
 from bot.keyboards.inline import get_confirm_setup_keyboard
 from bot.services.channel_mgmt import ChannelManagementService
 from bot.utils.helpers import get_user_mention_html
+from bot.utils.chat_info import invalidate_admins
 from bot.states import ManageChannels
 from bot.bot_instance import bot, db_manager, actual_bot_username # <--- ИМПОРТИРУЕМ ОТСЮДА
 from bot.middlewares.db_middleware import DbSessionMiddleware
@@ -91,6 +92,7 @@ async def on_admin_status_change(event: ChatMemberUpdated, bot: Bot, db_manager:
     chat_title = event.chat.title or f"Чат ID {chat_id}"
     new_admin_user = event.new_chat_member.user
     actor_user = event.from_user # Кто выполнил действие
+    invalidate_admins(chat_id) # Состав админов изменился - сбрасываем кэш
 
     logger.info(f"[ADMIN_EVENT] В чате {chat_id} ('{chat_title}') изменился статус/права admin {new_admin_user.id} ({new_admin_user.full_name}). Инициатор: {actor_user.id}")
 
@@ -124,12 +126,17 @@ async def on_admin_status_change(event: ChatMemberUpdated, bot: Bot, db_manager:
         # Просто логируем, дальнейших действий не требуется по ТЗ
         pass
 
-# --- Обработка разжалования (опционально) --- #
-# @group_admin_router.chat_member(
-#     ChatMemberUpdatedFilter(member_status_changed=IS_ADMIN >> IS_MEMBER)
-# )
-# async def on_admin_demoted(...):
-#     ...
+# --- Обработка разжалования --- #
+@group_admin_router.chat_member(
+    ChatMemberUpdatedFilter(member_status_changed=IS_ADMIN >> IS_MEMBER)
+)
+@group_admin_router.chat_member(
+    ChatMemberUpdatedFilter(member_status_changed=IS_ADMIN >> IS_NOT_MEMBER)
+)
+async def on_admin_demoted(event: ChatMemberUpdated):
+    """Сбрасывает кэш админов чата, когда админа разжаловали или он покинул чат."""
+    invalidate_admins(event.chat.id)
+    logger.debug(f"[ADMIN_EVENT] Пользователь {event.new_chat_member.user.id} больше не админ в чате {event.chat.id}.")
 
 # --- Хендлеры --- #
 
@@ -141,6 +148,7 @@ async def handle_admin_promotion_wrapper(event: types.ChatMemberUpdated, bot: Bo
     # Пока оставим как есть, но возможно, ее стоит объединить с flow через код
     # !!! ВНИМАНИЕ: Код ниже использует старый state.key(), его тоже нужно исправить !!!
     user_id_who_promoted = event.from_user.id
+    invalidate_admins(event.chat.id) # Бот тоже в списке админов - сбрасываем кэш
     bot_id = bot.id
     # Исправляем ключ FSM, chat_id должен быть ID чата, где произошло событие
     user_fsm_key = StorageKey(bot_id=bot_id, chat_id=event.chat.id, user_id=user_id_who_promoted)
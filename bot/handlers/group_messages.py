@@ -411,7 +411,8 @@ async def on_user_join_entry(event: types.ChatMemberUpdated, bot: Bot, db_manage
         user_id=user.id, username=user.username, first_name=user.first_name,
         last_name=user.last_name,
         language_code=user.language_code if hasattr(user, 'language_code') else None,
-        is_premium=bool(user.is_premium) if hasattr(user, 'is_premium') else False
+        is_premium=bool(user.is_premium) if hasattr(user, 'is_premium') else False,
+        is_bot=user.is_bot
     )
 
     chat_settings = await db_manager.get_chat_settings(chat.id)
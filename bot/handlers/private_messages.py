@@ -207,7 +207,8 @@ async def cmd_start_in_pm(message: types.Message, command: CommandObject, db_man
         last_name=user.last_name,
         language_code=user.language_code,
         is_premium=bool(user.is_premium), # Приводим к bool на всякий случай
-        referrer_id=actual_referrer_id if is_new_user else None # Передаем реферера только если пользователь новый
+        referrer_id=actual_referrer_id if is_new_user else None, # Передаем реферера только если пользователь новый
+        is_bot=user.is_bot
     )
 
     # Если пользователь не новый, но реферера у него не было, а сейчас пришел с ним
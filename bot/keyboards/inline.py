@@ -1,7 +1,8 @@
 """
 Inline клавиатуры для FSM управления каналами и других нужд.
 """
-from typing import List, Dict, Union, Optional, Any
+from functools import lru_cache
+from typing import List, Dict, Union, Optional, Any, Tuple
 
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
@@ -35,15 +36,21 @@ def get_channel_management_keyboard(channels: List[Dict[str, Union[int, str]]])
     Returns:
         Инлайн-клавиатура.
     """
+    # Клавиатура зависит только от пар (id, title), поэтому собираем ее через кэш по кортежу пар
+    channels_key = tuple((channel['id'], channel.get('title')) for channel in channels)
+    return _build_channel_management_keyboard(channels_key)
+
+@lru_cache(maxsize=512)
+def _build_channel_management_keyboard(channels: Tuple[Tuple[int, Optional[str]], ...]) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
     # Кнопка добавления
     builder.button(text="➕ Добавить канал", callback_data="mng:add_channel")
 
     # Кнопки удаления для каждого канала
-    for channel in channels:
-        channel_id = channel['id']
-        channel_title = channel.get('title', f'ID {channel_id}')
+    for channel_id, channel_title in channels:
+        if channel_title is None:
+            channel_title = f'ID {channel_id}'
         # Обрезаем слишком длинные названия для кнопки
         display_title = (channel_title[:20] + '...') if len(channel_title) > 23 else channel_title
         builder.button(
@@ -129,8 +136,9 @@ def get_subscription_check_keyboard(user_id: int, channels: List[Dict[str, Any]]
     # Добавляем ссылки на каналы
     for channel in channels:
         try:
-            # Пытаемся получить username, если нет - используем invite_link или приватную ссылку
-            link = f"https://t.me/{channel['username']}" if channel.get('username') else channel.get('invite_link')
+            # Готовая ссылка ('link', как в данных SubscriptionService._resolve_channel) используется как есть;
+            # иначе пытаемся получить username, если нет - используем invite_link или приватную ссылку
+            link = channel.get('link') or (f"https://t.me/{channel['username']}" if channel.get('username') else channel.get('invite_link'))
             # Пытаемся сформировать приватную ссылку если channel_id это число (обычно отрицательное для супергрупп/каналов)
             # и нет других ссылок
             if not link and isinstance(channel.get('id'), int) and channel['id'] < 0:
@@ -1,6 +1,7 @@
 """
 Сервис для управления каналами, связанными с чатом (добавление/удаление).
 """
+import asyncio
 import logging
 from typing import List, Optional, Dict, Any
 
@@ -11,6 +12,7 @@ from aiogram.fsm.context import FSMContext
 from bot.db import DatabaseManager
 from bot.keyboards.inline import get_channel_management_keyboard
 from bot.utils.chat_info import get_chat_administrators_ids
+from bot.services.subscription import invalidate_linked_channels_cache, forget_channel_info
 from bot.texts import (
     YOU_ARE_NOT_ADMIN, CHANNEL_ADDED_SUCCESS, CHANNEL_REMOVED_SUCCESS, 
     ERROR_GETTING_CHANNEL_INFO, BOT_NEED_ADMIN_IN_CHANNEL, ERROR_ADDING_CHANNEL, 
@@ -76,22 +78,22 @@ class ChannelManagementService:
             removed = await self.db.remove_linked_channel(group_chat_id=chat_id, channel_id=channel_id)
             if removed:
                 success = True
-                alert_text = CHANNEL_REMOVED_SUCCESS
+                alert_text = CHANNEL_REMOVED_SUCCESS.format(channel_title=f"ID {channel_id}")
                 logger.info(f"Пользователь {user_id} удалил канал {channel_id} из чата {chat_id}")
             else:
-                alert_text = ERROR_REMOVING_CHANNEL
+                alert_text = ERROR_REMOVING_CHANNEL.format(error="канал не найден в списке")
                 logger.warning(f"Не удалось удалить канал {channel_id} из чата {chat_id} (возможно, уже удален)")
         else:
             # Добавляем канал (сначала проверка)
             channel_info = await self.get_channel_details(channel_id)
             if not channel_info:
-                alert_text = ERROR_GETTING_CHANNEL_INFO
+                alert_text = ERROR_GETTING_CHANNEL_INFO.format(channel_id=channel_id)
             else:
                 try:
                     # Проверяем, есть ли бот админом в канале
                     bot_member = await self.bot.get_chat_member(channel_id, self.bot.id)
                     if bot_member.status not in [types.ChatMemberStatus.ADMINISTRATOR, types.ChatMemberStatus.CREATOR]:
-                        alert_text = BOT_NEED_ADMIN_IN_CHANNEL
+                        alert_text = BOT_NEED_ADMIN_IN_CHANNEL.format(channel_title=channel_info.title)
                     else:
                         # Добавляем связь в БД
                         added = await self.db.add_linked_channel(
@@ -100,15 +102,17 @@ class ChannelManagementService:
                             added_by_user_id=user_id # Записываем, кто добавил
                         )
                         if added:
+                            invalidate_linked_channels_cache(chat_id)
+                            forget_channel_info(channel_id)
                             success = True
-                            alert_text = CHANNEL_ADDED_SUCCESS
+                            alert_text = CHANNEL_ADDED_SUCCESS.format(channel_title=channel_info.title)
                             logger.info(f"Пользователь {user_id} добавил канал {channel_id} в чат {chat_id}")
                         else:
-                            alert_text = ERROR_ADDING_CHANNEL # Возможно, IntegrityError из-за гонки состояний
+                            alert_text = ERROR_ADDING_CHANNEL.format(error="канал уже добавлен") # Возможно, IntegrityError из-за гонки состояний
                             logger.warning(f"Не удалось добавить канал {channel_id} в чат {chat_id} (возможно, уже добавлен)")
                 except TelegramAPIError as e:
                     logger.error(f"Ошибка API при проверке/добавлении канала {channel_id} для чата {chat_id}: {e}")
-                    alert_text = f"{ERROR_ADDING_CHANNEL} (Ошибка API: {e.message})"
+                    alert_text = ERROR_ADDING_CHANNEL.format(error=f"Ошибка API: {e.message}")
 
         # Отвечаем на callback
         await callback_query.answer(alert_text)
@@ -156,10 +160,12 @@ class ChannelManagementService:
         text = INSTRUCTION_AFTER_SETUP
         if linked_channels_ids and sub_check_enabled:
             text += "\n\n✅ Проверка подписки <b>включена</b> для следующих каналов:"
-            channels_details = []
-            for chan_id in linked_channels_ids:
-                 detail = await self.get_channel_details(chan_id)
-                 channels_details.append(f"- {detail.title if detail else f'ID: {chan_id}'}")
+            # Запрашиваем все каналы параллельно, а не по одному
+            details = await asyncio.gather(*(self.get_channel_details(chan_id) for chan_id in linked_channels_ids))
+            channels_details = [
+                f"- {detail.title if detail else f'ID: {chan_id}'}"
+                for chan_id, detail in zip(linked_channels_ids, details)
+            ]
             text += "\n" + "\n".join(channels_details)
         elif linked_channels_ids and not sub_check_enabled:
              text += f"\n\n⚠️ Вы добавили каналы, но проверка подписки сейчас <b>выключена</b>. Используйте /toggle_sub чтобы включить её."
@@ -8,7 +8,10 @@
 import logging
 import time
 import asyncio
-from typing import Union, List, Dict, Optional, Tuple, Set, TYPE_CHECKING
+import functools
+from html import escape
+from datetime import datetime, timedelta, timezone
+from typing import Union, List, Dict, Optional, Tuple, Set, Callable, Awaitable, TYPE_CHECKING
 
 from aiogram import Bot, F, types
 from aiogram.enums import ChatType, ChatMemberStatus
@@ -17,19 +20,22 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import (KeyboardButton, ReplyKeyboardMarkup, KeyboardButtonRequestChat,
                          ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup, 
                          ChatAdministratorRights, ReplyKeyboardRemove)
-from aiogram.utils.markdown import hbold, hlink, hitalic, hcode
+from aiogram.utils.markdown import hbold, hlink, hitalic
 from aiogram.fsm.storage.base import StorageKey, BaseStorage
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Используем абсолютные импорты
 from bot.db.database import DatabaseManager
-from bot.utils.helpers import get_user_mention_html
+from bot.utils.helpers import get_user_mention_html, with_telegram_retry
+from bot.services.subscription import invalidate_linked_channels_cache, forget_channel_info
 from bot.states import ManageChannels
 from bot.keyboards.inline import get_channel_management_keyboard, get_channel_remove_keyboard
 
 logger = logging.getLogger(__name__)
 
 # --- ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ (ПЕРЕНЕСЕНА ИЗ КОНЦА ФАЙЛА) ---
-# Вспомогательная функция для склонения слова "канал"
+# Вспомогательная функция для склонения слова "канал" (различных результатов всего три, кэшируем)
+@functools.lru_cache(maxsize=256)
 def _get_channel_word_form(count: int) -> str:
     if count % 10 == 1 and count % 100 != 11:
         return "канал"
@@ -39,15 +45,80 @@ def _get_channel_word_form(count: int) -> str:
         return "каналов"
 # --- КОНЕЦ ВСПОМОГАТЕЛЬНОЙ ФУНКЦИИ ---
 
-# --- Вспомогательная функция для удаления сообщения с задержкой ---
-# Эту функцию можно вынести в utils, если она будет использоваться в нескольких местах
-async def delete_message_after_delay(message: types.Message, delay: int):
-    await asyncio.sleep(delay)
-    try:
-        await message.delete()
-        logger.debug(f"Сервисное сообщение {message.message_id} в чате {message.chat.id} автоматически удалено.")
-    except Exception as e:
-        logger.warning(f"Не удалось автоматически удалить сервисное сообщение {message.message_id} в чате {message.chat.id}: {e}")
+# --- HTML-шаблоны уведомлений. Разметка уже в шаблоне, подставляется только экранированный {title} ---
+SUB_CHECK_ON_TPL = "✅ Проверка подписки на каналы для чата <b>{title}</b> (<code>{chat_id}</code>) теперь <b>включена</b>."
+SUB_CHECK_OFF_TPL = "✅ Проверка подписки на каналы для чата <b>{title}</b> (<code>{chat_id}</code>) теперь <b>выключена</b>."
+CAPTCHA_ON_TPL = "✅ Капча для новых пользователей в чате <b>{title}</b> (<code>{chat_id}</code>) теперь <b>включена</b>."
+CAPTCHA_OFF_TPL = "✅ Капча для новых пользователей в чате <b>{title}</b> (<code>{chat_id}</code>) теперь <b>выключена</b>."
+
+# Текст об успешном завершении настройки каналов
+FINISH_SUCCESS_TPL = (
+    "✅ Настройка каналов для чата <b>{title}</b> завершена!\n\n"
+    "Бот теперь будет проверять подписку на {count} {word}.\n\n"
+    "Вы можете вернуться к управлению каналами через команду /chats."
+)
+
+# --- Фоновые задачи модуля ---
+# Сильные ссылки на фоновые задачи: без них задача может быть собрана GC до завершения
+_bg_tasks: Set[asyncio.Task] = set()
+
+def _on_bg_done(task: asyncio.Task):
+    _bg_tasks.discard(task)
+    if task.cancelled():
+        return
+    # Забираем исключение, чтобы оно не потерялось ("Task exception was never retrieved")
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"Фоновая задача завершилась с ошибкой: {exc!r}", exc_info=exc)
+
+def _spawn(coro: Awaitable) -> asyncio.Task:
+    """Запускает корутину в фоне, сохраняя ссылку на задачу до ее завершения."""
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_on_bg_done)
+    return task
+
+async def shutdown_background_tasks():
+    """Останавливает планировщик отложенных действий и дожидается остальных фоновых задач модуля."""
+    if _delayed_scheduler is not None and _delayed_scheduler.running:
+        _delayed_scheduler.shutdown(wait=False)
+    if _bg_tasks:
+        await asyncio.gather(*_bg_tasks, return_exceptions=True)
+
+# --- Отложенные действия с сервисными сообщениями ---
+# Сервис создается на каждый апдейт, поэтому планировщик общий на модуль: APScheduler держит
+# все отложенные действия в одной куче по времени запуска вместо спящей корутины на каждое.
+_FLASH_TTL = 5 # Через сколько секунд убирать строку-уведомление из интерфейса управления
+_delayed_scheduler: Optional[AsyncIOScheduler] = None
+
+def schedule_job(delay: float, job: Callable[[], Awaitable[None]], job_id: Optional[str] = None):
+    """
+    Планирует job (корутинную функцию без аргументов) на выполнение через delay секунд.
+    Задание с тем же job_id заменяет ранее запланированное.
+    """
+    global _delayed_scheduler
+    if _delayed_scheduler is None:
+        _delayed_scheduler = AsyncIOScheduler()
+    if not _delayed_scheduler.running:
+        _delayed_scheduler.start()
+
+    _delayed_scheduler.add_job(
+        job,
+        trigger='date',
+        run_date=datetime.now(timezone.utc) + timedelta(seconds=delay),
+        id=job_id,
+        replace_existing=job_id is not None,
+        misfire_grace_time=30
+    )
+
+# --- Защита от повторных нажатий на переключатели ---
+# Ключ: (admin_user_id, target_chat_id, setting_name). Пока переключение выполняется, повторные клики пропускаются.
+_toggle_locks: Dict[Tuple[int, int, str], asyncio.Lock] = {}
+
+def _acquire_or_skip(key: Tuple[int, int, str]) -> Optional[asyncio.Lock]:
+    """Возвращает свободный замок для key или None, если переключение уже выполняется."""
+    lock = _toggle_locks.setdefault(key, asyncio.Lock())
+    return None if lock.locked() else lock
 
 class ChannelManagementService:
     """Обрабатывает FSM логику для управления каналами подписки."""
@@ -82,7 +153,11 @@ class ChannelManagementService:
             logger.error(f"Error checking bot permissions in channel {channel_id}: {e}")
             return False
 
-    async def update_management_interface(self, user_id: int, state: FSMContext) -> None:
+    async def update_management_interface(self, user_id: int, state: FSMContext, flash: Optional[str] = None) -> None:
+        """Отправляет или редактирует сообщение с интерфейсом управления.
+
+        flash - необязательная строка-уведомление (HTML), выводится первой строкой сообщения.
+        """
         try:
             state_data = await state.get_data()
             target_chat_id = state_data.get('target_chat_id')
@@ -91,7 +166,8 @@ class ChannelManagementService:
             # Сообщение, которое редактируем (если есть)
             message_id_to_edit = state_data.get('management_message_id')
 
-            text_parts = [f"⚙️ Управление каналами для чата {hbold(target_chat_title)}\n"] # Используем название чата
+            text_parts = [f"{flash}\n"] if flash else []
+            text_parts.append(f"⚙️ Управление каналами для чата {hbold(target_chat_title)}\n") # Используем название чата
 
             if not current_channels:
                 text_parts.append("Список каналов для проверки пока пуст.")
@@ -141,7 +217,7 @@ class ChannelManagementService:
                 logger.info(f"[FSM_MGMT] Отправляем НОВЫЙ интерфейс управления user={user_id}")
 
             try:
-                 sent_message = await send_method(**send_kwargs)
+                 sent_message = await with_telegram_retry(max_attempts=2)(send_method)(**send_kwargs)
                  # Если отправили новое сообщение, сохраняем его ID для будущих редактирований
                  if not message_id_to_edit and sent_message:
                      await state.update_data(management_message_id=sent_message.message_id)
@@ -182,6 +258,16 @@ class ChannelManagementService:
             except Exception:
                 pass # Если и это не удалось, просто игнорируем
 
+    def _schedule_flash_clear(self, user_id: int, state: FSMContext):
+        """Через _FLASH_TTL секунд перерисовывает интерфейс без строки-уведомления."""
+        async def clear_flash():
+            # Сессия могла закончиться или перейти в другой шаг - тогда интерфейс не трогаем
+            if await state.get_state() != ManageChannels.managing_list.state:
+                return
+            await self.update_management_interface(user_id, state)
+        # Один id на админа: при серии переключений перерисовка будет одна, после последнего
+        schedule_job(_FLASH_TTL, clear_flash, job_id=f"mgmt_flash:{user_id}")
+
     async def start_channel_management(self, target_chat_id: int, target_chat_title: str, admin_user_id: int):
         """
         Инициирует FSM для управления каналами из команды /managechannels.
@@ -444,6 +530,11 @@ class ChannelManagementService:
     async def handle_finish_channel_management(self, query: types.CallbackQuery, state: FSMContext):
         """Обрабатывает нажатие кнопки 'Завершить' в управлении каналами."""
         user_id = query.from_user.id
+        # Локальные ссылки вместо повторных обращений к атрибутам в теле метода
+        bot, db = self.bot, self.db
+        log_info, _dbg = logger.info, logger.debug
+        ack_task: Optional[asyncio.Task] = None
+        cleared = False # Чтобы не очищать состояние повторно в ветке общей ошибки
         try:
             state_data = await state.get_data()
             target_chat_id = state_data.get('target_chat_id')
@@ -451,40 +542,46 @@ class ChannelManagementService:
             # Получаем список каналов из состояния FSM (это список словарей)
             final_channels_in_state: List[Dict] = state_data.get('current_channels', []) 
 
-            logger.info(f"[MGMT_FINISH] Пользователь {user_id} завершил управление каналами для чата {target_chat_id} ('{target_chat_title}'). Каналов в state: {len(final_channels_in_state)}.")
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 1: Проверка наличия каналов перед сохранением.")
+            log_info("[MGMT_FINISH] Пользователь %s завершил управление каналами для чата %s ('%s'). Каналов в state: %s.",
+                        user_id, target_chat_id, target_chat_title, len(final_channels_in_state))
 
             if not final_channels_in_state:
-                logger.warning(f"[MGMT_FINISH] Попытка завершить без каналов user={user_id} chat={target_chat_id}.")
+                logger.warning("[MGMT_FINISH] Попытка завершить без каналов user=%s chat=%s.", user_id, target_chat_id)
                 await query.answer("⚠️ Вы не добавили ни одного канала! Настройка не завершена.", show_alert=True)
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 1.1: Завершение без каналов, query.answer вызван.")
                 return # Важно: выходим, если нет каналов
 
+            # Сразу отвечаем на callback (не дожидаясь ответа), чтобы у пользователя пропали "часики",
+            # пока идет работа с БД. Ответить на callback можно лишь один раз, поэтому дальнейшие
+            # ошибки сообщаем отдельным беззвучным сообщением, а не алертом.
+            ack_task = _spawn(query.answer())
+
             # --- НАЧАЛО БЛОКА СИНХРОНИЗАЦИИ С БД ---
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 1.5: Синхронизация каналов state с БД...")
+            _dbg("[MGMT_FINISH_DEBUG] Шаг 1: Синхронизация каналов state с БД...")
             try:
                 # Преобразуем каналы из state в множество ID
                 state_channel_ids: Set[int] = {ch['id'] for ch in final_channels_in_state}
                 
                 # Получаем текущие каналы из БД
-                db_channel_ids_list = await self.db.get_linked_channels_for_chat(target_chat_id)
+                db_channel_ids_list = await db.get_linked_channels_for_chat(target_chat_id)
                 db_channel_ids: Set[int] = set(db_channel_ids_list)
             
-                logger.debug(f"[MGMT_FINISH_SYNC] Каналы в state: {state_channel_ids}")
-                logger.debug(f"[MGMT_FINISH_SYNC] Каналы в БД: {db_channel_ids}")
+                _dbg("[MGMT_FINISH_SYNC] Каналы в state: %s", state_channel_ids)
+                _dbg("[MGMT_FINISH_SYNC] Каналы в БД: %s", db_channel_ids)
             
                 # Определяем разницу
                 channels_to_add = state_channel_ids - db_channel_ids
                 channels_to_remove = db_channel_ids - state_channel_ids
             
-                logger.info(f"[MGMT_FINISH_SYNC] Каналы для добавления в БД: {channels_to_add if channels_to_add else 'нет'}")
-                logger.info(f"[MGMT_FINISH_SYNC] Каналы для удаления из БД: {channels_to_remove if channels_to_remove else 'нет'}")
+                log_info("[MGMT_FINISH_SYNC] Каналы для добавления в БД: %s", channels_to_add or 'нет')
+                log_info("[MGMT_FINISH_SYNC] Каналы для удаления из БД: %s", channels_to_remove or 'нет')
                 
                 # Добавляем новые каналы
                 for ch_id_add in channels_to_add:
                     try:
-                        await self.db.add_linked_channel(target_chat_id, ch_id_add, user_id)
-                        logger.info(f"[MGMT_FINISH_SYNC] Канал {ch_id_add} успешно добавлен в БД для чата {target_chat_id}.")
+                        await db.add_linked_channel(target_chat_id, ch_id_add, user_id)
+                        invalidate_linked_channels_cache(target_chat_id)
+                        forget_channel_info(ch_id_add)
+                        log_info("[MGMT_FINISH_SYNC] Канал %s успешно добавлен в БД для чата %s.", ch_id_add, target_chat_id)
                     except Exception as e_add:
                         logger.error(f"[MGMT_FINISH_SYNC] Ошибка добавления канала {ch_id_add} для чата {target_chat_id}: {e_add}", exc_info=True)
                         # Решаем, что делать при ошибке: прервать или продолжить? Пока продолжаем.
@@ -492,126 +589,126 @@ class ChannelManagementService:
                 # Удаляем ненужные каналы
                 for ch_id_remove in channels_to_remove:
                     try:
-                        await self.db.remove_linked_channel(target_chat_id, ch_id_remove)
-                        logger.info(f"[MGMT_FINISH_SYNC] Канал {ch_id_remove} успешно удален из БД для чата {target_chat_id}.")
+                        await db.remove_linked_channel(target_chat_id, ch_id_remove)
+                        log_info("[MGMT_FINISH_SYNC] Канал %s успешно удален из БД для чата %s.", ch_id_remove, target_chat_id)
                     except Exception as e_remove:
                         logger.error(f"[MGMT_FINISH_SYNC] Ошибка удаления канала {ch_id_remove} для чата {target_chat_id}: {e_remove}", exc_info=True)
                         # Решаем, что делать при ошибке: прервать или продолжить? Пока продолжаем.
-                
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 1.6: Синхронизация каналов state с БД завершена.")
 
             except Exception as e_sync:
                 logger.error(f"[MGMT_FINISH] Критическая ошибка при синхронизации каналов с БД для чата {target_chat_id}: {e_sync}", exc_info=True)
-                await query.answer("❌ Ошибка сохранения списка каналов в БД. Попробуйте позже.", show_alert=True)
+                await bot.send_message(user_id, "❌ Ошибка сохранения списка каналов в БД. Попробуйте позже.", disable_notification=True)
                 # Не очищаем состояние, чтобы пользователь мог попробовать снова
                 return
             # --- КОНЕЦ БЛОКА СИНХРОНИЗАЦИИ С БД ---
 
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 2: Вызов db.mark_setup_complete...")
+            _dbg("[MGMT_FINISH_DEBUG] Шаг 2: Вызов db.mark_setup_complete...")
             try:
-                await self.db.mark_setup_complete(target_chat_id, user_id)
-                logger.info(f"[MGMT_FINISH] Установлен флаг setup_complete=1 для чата {target_chat_id} (user={user_id}).")
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 2.1: mark_setup_complete успешно выполнен.")
+                await db.mark_setup_complete(target_chat_id, user_id)
+                log_info("[MGMT_FINISH] Установлен флаг setup_complete=1 для чата %s (user=%s).", target_chat_id, user_id)
             except Exception as e_db:
                 logger.error(f"[MGMT_FINISH] Ошибка при установке setup_complete=1 для чата {target_chat_id}: {e_db}", exc_info=True)
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 2.2: Ошибка mark_setup_complete, вызов query.answer...")
-                await query.answer("❌ Ошибка сохранения настроек в БД. Попробуйте позже.", show_alert=True)
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 2.3: query.answer для ошибки БД вызван.")
+                await bot.send_message(user_id, "❌ Ошибка сохранения настроек в БД. Попробуйте позже.", disable_notification=True)
                 return
 
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 3: Формирование текста сообщения...")
-            success_text = (
-                f"✅ Настройка каналов для чата {hbold(target_chat_title)} завершена!\n\n"
-                f"Бот теперь будет проверять подписку на {len(final_channels_in_state)} " # Используем финальное количество из state
-                f"{_get_channel_word_form(len(final_channels_in_state))}.\n\n"
-                f"Вы можете вернуться к управлению каналами через команду /chats."
-            )
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 3.1: Текст сообщения сформирован.")
+            channels_count = len(final_channels_in_state) # Используем финальное количество из state
+            success_text = FINISH_SUCCESS_TPL.format_map({
+                'title': escape(target_chat_title), 'count': channels_count, 'word': _get_channel_word_form(channels_count)
+            })
 
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 4: Редактирование/отправка сообщения...")
+            _dbg("[MGMT_FINISH_DEBUG] Шаг 3: Редактирование/отправка сообщения...")
             message_edited_or_sent = False
             try:
-                await query.message.edit_text(success_text, parse_mode="HTML", reply_markup=None, disable_web_page_preview=True)
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 4.1: Сообщение {query.message.message_id} успешно отредактировано.")
+                # При флуд-контроле ждем retry_after и повторяем редактирование, а не шлем новое сообщение
+                await with_telegram_retry(max_attempts=2)(query.message.edit_text)(
+                    success_text, parse_mode="HTML", reply_markup=None, disable_web_page_preview=True
+                )
+                _dbg("[MGMT_FINISH_DEBUG] Сообщение %s успешно отредактировано.", query.message.message_id)
                 message_edited_or_sent = True
-            except TelegramAPIError as e:
-                logger.warning(f"[MGMT_FINISH] Не удалось отредактировать сообщение {query.message.message_id} для user={user_id}: {e}. Отправляем новое.")
-                try:
-                    await self.bot.send_message(user_id, success_text, parse_mode="HTML", disable_web_page_preview=True)
-                    logger.info(f"[MGMT_FINISH_DEBUG] Шаг 4.2: Новое сообщение успешно отправлено.")
+            except TelegramBadRequest as e:
+                error_text = str(e).lower()
+                if "message is not modified" in error_text:
+                    # Сообщение уже содержит нужный текст
                     message_edited_or_sent = True
-                except Exception as e_send:
-                    logger.error(f"[MGMT_FINISH] Не удалось даже отправить новое сообщение user={user_id}: {e_send}")
-                    logger.info(f"[MGMT_FINISH_DEBUG] Шаг 4.3: Ошибка отправки нового сообщения.")
-
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 5: Вызов query.answer...")
-            try:
-                await query.answer("Настройка завершена!")
-                logger.info(f"[MGMT_FINISH_DEBUG] Шаг 5.1: query.answer успешно вызван.")
-            except Exception as e_ans:
-                 logger.error(f"[MGMT_FINISH] Ошибка при вызове query.answer(): {e_ans}", exc_info=True)
-                 logger.info(f"[MGMT_FINISH_DEBUG] Шаг 5.2: Ошибка вызова query.answer.")
+                elif "message can't be edited" in error_text or "message to edit not found" in error_text:
+                    logger.warning(f"[MGMT_FINISH] Не удалось отредактировать сообщение {query.message.message_id} для user={user_id}: {e}. Отправляем новое.")
+                    try:
+                        await with_telegram_retry(max_attempts=2)(bot.send_message)(
+                            user_id, success_text, parse_mode="HTML", disable_web_page_preview=True
+                        )
+                        message_edited_or_sent = True
+                    except TelegramAPIError as e_send:
+                        logger.error(f"[MGMT_FINISH] Не удалось даже отправить новое сообщение user={user_id}: {e_send}")
+                else:
+                    logger.error(f"[MGMT_FINISH] Ошибка редактирования сообщения {query.message.message_id} для user={user_id}: {e}")
+            except TelegramAPIError as e:
+                # В т.ч. исчерпанный TelegramRetryAfter: повторный запрос тоже упрется в лимит, поэтому не отправляем
+                logger.error(f"[MGMT_FINISH] Не удалось отредактировать сообщение {query.message.message_id} для user={user_id}: {e}")
 
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 6: Очистка состояния FSM...")
-            await state.clear()
-            logger.info(f"[MGMT_FINISH] Состояние FSM очищено для user={user_id}.")
-            logger.info(f"[MGMT_FINISH_DEBUG] Шаг 6.1: Состояние FSM очищено.")
+            # Ожидание ответа на callback и очистка состояния не зависят друг от друга - выполняем параллельно.
+            # Ошибки ответа логирует _on_bg_done, здесь только убеждаемся, что ответ ушел.
+            ack_result, clear_result = await asyncio.gather(
+                asyncio.wait({ack_task}, timeout=5), state.clear(), return_exceptions=True
+            )
+            if isinstance(ack_result, BaseException):
+                logger.error(f"[MGMT_FINISH] Ошибка ожидания query.answer() для user={user_id}: {ack_result!r}")
+            elif not ack_result[0]:
+                logger.warning(f"[MGMT_FINISH] query.answer() для user={user_id} не завершился за 5 сек.")
+            if isinstance(clear_result, BaseException):
+                logger.error(f"[MGMT_FINISH] Ошибка очистки состояния FSM для user={user_id}: {clear_result!r}")
+            else:
+                cleared = True
+                log_info("[MGMT_FINISH] Состояние FSM очищено для user=%s.", user_id)
 
-        except Exception as e:
+        except (TelegramAPIError, asyncio.TimeoutError) as e:
+            # Прочие (неожиданные) исключения и CancelledError не глушим - их залогирует диспетчер aiogram
             logger.error(f"[MGMT_FINISH] Общая ошибка при завершении управления каналами user={user_id}: {e}", exc_info=True)
-            logger.info(f"[MGMT_FINISH_DEBUG] Общая ошибка в блоке try, вызов query.answer...")
             try:
-                await query.answer("❌ Произошла непредвиденная ошибка при завершении.", show_alert=True)
-                logger.info(f"[MGMT_FINISH_DEBUG] query.answer для общей ошибки вызван.")
+                if ack_task is None:
+                    await query.answer("❌ Произошла непредвиденная ошибка при завершении.", show_alert=True)
+                else:
+                    await bot.send_message(user_id, "❌ Произошла непредвиденная ошибка при завершении.", disable_notification=True)
             except TelegramAPIError: 
-                logger.info(f"[MGMT_FINISH_DEBUG] Ошибка ответа на query.answer для общей ошибки.")
-                pass 
-            logger.info(f"[MGMT_FINISH_DEBUG] Очистка состояния FSM после общей ошибки...")
-            await state.clear() 
-            logger.info(f"[MGMT_FINISH_DEBUG] Состояние FSM очищено после общей ошибки.")
-
-    async def toggle_subscription_check(self, admin_user_id: int, target_chat_id: int, chat_title_for_msg: str, state: FSMContext):
-        """Переключает настройку обязательной подписки для чата."""
-        state_data = await state.get_data()
-        current_status = await self.db.get_chat_setting(target_chat_id, 'subscription_check_enabled')
-        new_status = not current_status
-        await self.db.toggle_setting(target_chat_id, 'subscription_check_enabled', new_status, admin_user_id)
-        logger.info(f"[FSM_MGMT] Переключена проверка подписки для чата {target_chat_id} на {' ВКЛ' if new_status else 'ВЫКЛ'} админом {admin_user_id}")
+                _dbg("[MGMT_FINISH_DEBUG] Ошибка ответа на query.answer для общей ошибки.")
+            if not cleared:
+                await state.clear()
+                _dbg("[MGMT_FINISH_DEBUG] Состояние FSM очищено после общей ошибки.")
+
+    async def _toggle_setting(self, admin_user_id: int, target_chat_id: int, chat_title_for_msg: str, state: FSMContext,
+                              setting_key: str, feedback_on_tpl: str, feedback_off_tpl: str):
+        """Переключает булеву настройку чата и показывает уведомление в интерфейсе управления."""
+        log_info = logger.info
+        lock_key = (admin_user_id, target_chat_id, setting_key)
+        lock = _acquire_or_skip(lock_key)
+        if lock is None:
+            log_info("[FSM_MGMT] Повторное нажатие переключателя '%s' для чата %s админом %s пропущено", setting_key, target_chat_id, admin_user_id)
+            return
 
-        if new_status:
-            feedback_text = f"✅ Проверка подписки на каналы для чата {hbold(chat_title_for_msg)} ({hcode(target_chat_id)}) теперь {hbold('включена')}."
-        else:
-            feedback_text = f"✅ Проверка подписки на каналы для чата {hbold(chat_title_for_msg)} ({hcode(target_chat_id)}) теперь {hbold('выключена')}."
-        
         try:
-            sent_message = await self.bot.send_message(admin_user_id, feedback_text, parse_mode="HTML")
-            # Добавляем автоудаление для этого сообщения через 5 секунд
-            asyncio.create_task(delete_message_after_delay(sent_message, 5))
-            logger.debug(f"Сообщение о статусе подписки user={admin_user_id} будет удалено через 5 сек.")
-        except Exception as e_send:
-            logger.error(f"Не удалось отправить/запланировать удаление сообщения о статусе подписки user={admin_user_id}: {e_send}")
+            async with lock:
+                new_status = await self.db.flip_setting(target_chat_id, setting_key, admin_user_id)
+                if new_status is None:
+                    logger.error(f"[FSM_MGMT] Не удалось переключить '{setting_key}' для чата {target_chat_id} (admin={admin_user_id})")
+                    return
+                log_info("[FSM_MGMT] Переключена настройка '%s' для чата %s на %s админом %s",
+                         setting_key, target_chat_id, 'ВКЛ' if new_status else 'ВЫКЛ', admin_user_id)
+
+                feedback_tpl = feedback_on_tpl if new_status else feedback_off_tpl
+                feedback_text = feedback_tpl.format_map({'title': escape(chat_title_for_msg), 'chat_id': target_chat_id})
+
+                # Уведомление показываем строкой в самом интерфейсе управления (одно edit вместо send + delete)
+                await self.update_management_interface(admin_user_id, state, flash=feedback_text)
+                self._schedule_flash_clear(admin_user_id, state)
+        finally:
+            # Удаляем замок из реестра, чтобы словарь не рос
+            _toggle_locks.pop(lock_key, None)
 
-        await self.update_management_interface(admin_user_id, state) # Передаем только user_id и state
+    async def toggle_subscription_check(self, admin_user_id: int, target_chat_id: int, chat_title_for_msg: str, state: FSMContext):
+        """Переключает настройку обязательной подписки для чата."""
+        return await self._toggle_setting(admin_user_id, target_chat_id, chat_title_for_msg, state,
+                                          'subscription_check_enabled', SUB_CHECK_ON_TPL, SUB_CHECK_OFF_TPL)
 
     async def toggle_captcha(self, admin_user_id: int, target_chat_id: int, chat_title_for_msg: str, state: FSMContext):
         """Переключает настройку капчи для чата."""
-        state_data = await state.get_data()
-        current_status = await self.db.get_chat_setting(target_chat_id, 'captcha_enabled')
-        new_status = not current_status
-        await self.db.toggle_setting(target_chat_id, 'captcha_enabled', new_status, admin_user_id)
-        logger.info(f"[FSM_MGMT] Переключена капча для чата {target_chat_id} на {' ВКЛ' if new_status else 'ВЫКЛ'} админом {admin_user_id}")
-
-        if new_status:
-            feedback_text = f"✅ Капча для новых пользователей в чате {hbold(chat_title_for_msg)} ({hcode(target_chat_id)}) теперь {hbold('включена')}."
-        else:
-            feedback_text = f"✅ Капча для новых пользователей в чате {hbold(chat_title_for_msg)} ({hcode(target_chat_id)}) теперь {hbold('выключена')}."
-
-        try:
-            sent_message = await self.bot.send_message(admin_user_id, feedback_text, parse_mode="HTML")
-            # Добавляем автоудаление для этого сообщения через 5 секунд
-            asyncio.create_task(delete_message_after_delay(sent_message, 5))
-            logger.debug(f"Сообщение о статусе капчи user={admin_user_id} будет удалено через 5 сек.")
-        except Exception as e_send:
-            logger.error(f"Не удалось отправить/запланировать удаление сообщения о статусе капчи user={admin_user_id}: {e_send}")
-
-        await self.update_management_interface(admin_user_id, state) # Передаем только user_id и state
\ No newline at end of file
+        return await self._toggle_setting(admin_user_id, target_chat_id, chat_title_for_msg, state,
+                                          'captcha_enabled', CAPTCHA_ON_TPL, CAPTCHA_OFF_TPL)
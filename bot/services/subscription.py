@@ -3,30 +3,84 @@
 """
 import logging
 import asyncio
+import functools
+import heapq
+import itertools
 import json
-from typing import List, Tuple, Dict, Any, Optional, Union
+from typing import List, Tuple, Dict, Any, Optional, Union, NamedTuple
 import time # Для TTL кэша
+from time import monotonic as _now # Локальное имя: без поиска атрибута модуля time на горячем пути записи в кэш
 import datetime
 
+from cachetools import TTLCache, LRUCache
 from aiogram import Bot, types
 from aiogram.enums import ChatMemberStatus
-from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Chat
 from aiogram.utils.markdown import hlink, hbold, hcode
 
 from ..db.database import DatabaseManager
-from ..utils.helpers import get_user_mention_html, get_cached_general_info, is_admin
+from ..utils.helpers import get_user_mention_html, get_cached_general_info, is_admin, RateLimiter
 from bot.keyboards.inline import get_subscription_check_keyboard # Добавляем импорт
 
 logger = logging.getLogger(__name__)
 
 # --- Кэш для информации о чатах --- #
-_chat_info_cache = {}
+# TTLCache ограничен по размеру и сам вытесняет устаревшие записи, поэтому периодическая очистка не нужна.
+# Все сроки жизни в модуле считаются по time.monotonic(): переводы системных часов (NTP, ручная правка) не влияют на TTL
+_chat_info_cache = TTLCache(maxsize=10_000, ttl=1800, timer=time.monotonic) # {chat_id: Chat | None}, 30 минут
 _CACHE_TTL = 300 # Время жизни кэша в секундах (5 минут)
+_MISSING = object() # Маркер отсутствия записи (None в кэше означает неудачный запрос)
 
 # Кэш для результатов проверки подписки пользователей
-_subscription_cache = {}  # {(user_id, channel_id): {"result": bool, "timestamp": time}}
 _SUBSCRIPTION_CACHE_TTL = 86400  # 24 часа
+class SubEntry(NamedTuple):
+    """Запись кэша подписки. Кортеж вместо dict: ~56 байт на запись вместо ~230."""
+    timestamp: float # time.monotonic() момента проверки
+    result: bool
+
+# Время записи хранится рядом с результатом, чтобы ежедневное обновление могло пропускать свежие записи
+_subscription_cache = TTLCache(maxsize=500_000, ttl=_SUBSCRIPTION_CACHE_TTL, timer=time.monotonic)  # {(user_id, channel_id): SubEntry}
+
+# Статусы, при которых пользователь считается подписанным на канал
+_SUBSCRIBED_STATUSES: frozenset = frozenset({ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR})
+# Фрагменты текста ошибок API, означающие, что канал недействителен (удален или бот кикнут)
+_FATAL_CHANNEL_ERRORS = ("chat not found", "bot was kicked from the channel")
+# Сколько чатов ежедневное обновление кэша обрабатывает одновременно
+_SWEEP_WORKERS = 8
+
+# Чаты, у которых при последней проверке не было привязанных каналов. Хранится недолго (60 сек),
+# чтобы только что настроенный чат начал проверяться не позже чем через минуту даже без явной инвалидации
+_chats_known_empty = TTLCache(maxsize=50_000, ttl=60, timer=time.monotonic)
+
+# Каналы, по которым API недавно вернул фатальную ошибку ("chat not found", бот кикнут): {channel_id: текст ошибки}.
+# Пока запись жива (5 минут), проверки этого канала не делают запросов к API
+_dead_channels = TTLCache(maxsize=10_000, ttl=300, timer=time.monotonic)
+
+# Отображаемые данные каналов для сообщений о подписке: {channel_id: {"title", "username", "invite_link"}}.
+# Название и ссылки канала меняются редко, поэтому 10 минут хватает; неудачные запросы не кэшируются
+_channel_display_cache = TTLCache(maxsize=10_000, ttl=600, timer=time.monotonic)
+
+# Права для мута за неподписку и для снятия ограничений после подписки. Объекты неизменны,
+# поэтому создаются (и проходят валидацию pydantic) один раз, а не на каждый мут/размут
+_MUTE_PERMS = types.ChatPermissions(can_send_messages=False)
+_UNMUTE_PERMS = types.ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=False, # Обычно не разрешаем
+    can_invite_users=True,
+    can_pin_messages=False # Обычно не разрешаем
+)
+
+# Названия стадий handle_subscription_failure для логов
+_FAIL_STAGE_NAMES = {"first": "первая", "intermediate": "промежуточная", "last": "последняя"}
+
+# Проверки подписки, выполняющиеся прямо сейчас: {(user_id, channel_id): Task}.
+# Параллельные вызовы для той же пары (двойное нажатие кнопки, несколько хендлеров) ждут уже запущенный запрос
+_inflight_checks: Dict[Tuple[int, int], asyncio.Task] = {}
 
 # Функция для форматирования ссылок на чаты и пользователей
 def get_chat_link_for_md(chat_id, chat_title=None):
@@ -43,6 +97,17 @@ def get_user_link_for_md(user_id, user_name=None):
         user_name = f"Пользователь {user_id}"
     return f"[{user_name}](tg://user?id={user_id})"
 
+@functools.lru_cache(maxsize=4096)
+def _format_channel_row(title: str, link: Optional[str]) -> str:
+    """Строка канала для сообщения о непройденной проверке: ссылка, если есть, иначе жирное название."""
+    # Набор каналов у чатов маленький и стабильный, поэтому экранирование почти всегда берется из кэша
+    return f"🔗 {hlink(title, link)}" if link else f"📛 {hbold(title)}"
+
+@functools.lru_cache(maxsize=512)
+def _format_bullet(title: str, link: Optional[str]) -> str:
+    """Строка списка каналов в предупреждении и сообщении о муте: "  • " + ссылка или жирное название."""
+    return f"  • {hlink(title, link)}" if link else f"  • {hbold(title)}"
+
 # Функция форматирования сообщений для лога
 def format_sub_log(message_type: str, user_id: Optional[int] = None, 
                   user_name: Optional[str] = None, 
@@ -66,81 +131,93 @@ def format_sub_log(message_type: str, user_id: Optional[int] = None,
 # Получение информации о чате с кэшированием
 async def get_cached_chat_info(bot: Bot, chat_id: int, force_refresh: bool = False) -> Optional[Any]:
     """Получает информацию о чате с кэшированием."""
-    current_time = asyncio.get_event_loop().time()
-    
-    # Проверяем кэш и его срок годности (30 минут)
-    if not force_refresh and chat_id in _chat_info_cache:
-        cache_entry = _chat_info_cache[chat_id]
-        # Если кэш не старше 30 минут, используем его
-        if current_time - cache_entry.get('timestamp', 0) < 1800:  # 30 минут = 1800 секунд
-            return cache_entry.get('info')
+    # Срок годности записей (30 минут) отслеживает сам TTLCache
+    if not force_refresh and (info := _chat_info_cache.get(chat_id, _MISSING)) is not _MISSING:
+        return info
     
     # Кэш отсутствует или устарел, запрашиваем информацию
     try:
         chat_info_data = await bot.get_chat(chat_id)
         # Обновляем кэш
-        _chat_info_cache[chat_id] = {'info': chat_info_data, 'timestamp': current_time}
+        _chat_info_cache[chat_id] = chat_info_data
         return chat_info_data
     except Exception as e:
         logger.error(f"[CHAT_INFO] Не удалось получить информацию о чате {chat_id}: {e}")
         # В случае ошибки обнуляем кэш для этого чата
-        _chat_info_cache[chat_id] = {'info': None, 'timestamp': current_time} 
+        _chat_info_cache[chat_id] = None
         return None
 
+def _channel_stub(channel_id: int) -> Dict[str, Any]:
+    """Данные канала по умолчанию, когда получить информацию о нем не удалось."""
+    return {'id': channel_id, 'title': f"Канал ID {channel_id}", 'link': None, 'username': None}
+
 # Функции для работы с кэшем подписок
 def get_cached_subscription(user_id: int, channel_id: int) -> Tuple[bool, bool]:
     """
     Получает результат проверки подписки из кэша
     Возвращает (is_cached, is_member)
     """
-    cache_key = (user_id, channel_id)
-    current_time = time.time()
-    
-    if cache_key in _subscription_cache:
-        entry = _subscription_cache[cache_key]
-        # Проверяем TTL
-        if current_time - entry["timestamp"] < _SUBSCRIPTION_CACHE_TTL:
-            # Кэш актуален
-            return True, entry["result"]
-    
-    # Кэша нет или он устарел
-    return False, False
-
-def set_subscription_cache(user_id: int, channel_id: int, is_member: bool):
-    """Сохраняет результат проверки подписки в кэш"""
-    cache_key = (user_id, channel_id)
-    _subscription_cache[cache_key] = {
-        "result": is_member,
-        "timestamp": time.time()
-    }
-
-def update_subscription_cache(user_id: int, channel_id: int, is_member: bool = True):
-    """
-    Принудительно обновляет кэш подписки пользователя.
-    Используется когда мы точно знаем, что пользователь подписался на канал.
-    """
-    cache_key = (user_id, channel_id)
-    _subscription_cache[cache_key] = {
-        "result": is_member,
-        "timestamp": time.time()
-    }
-    logger.info(f"[SUB_CACHE_UPDATE] 🔵 Принудительно обновлен кэш для пользователя {user_id} на канал {channel_id}: подписан={is_member}")
-
-# Очистка старых записей из кэша (запускается периодически)
-def clear_expired_subscription_cache():
-    """Удаляет устаревшие записи из кэша подписок"""
-    current_time = time.time()
-    expired_keys = []
-    
-    for key, entry in _subscription_cache.items():
-        if current_time - entry["timestamp"] > _SUBSCRIPTION_CACHE_TTL:
-            expired_keys.append(key)
-    
-    for key in expired_keys:
-        del _subscription_cache[key]
-    
-    if expired_keys:
-        logger.debug(f"[SUB_CACHE] Очищено {len(expired_keys)} устаревших записей из кэша подписок")
+    # Устаревшие записи TTLCache вытесняет сам, поэтому найденная запись всегда актуальна.
+    # Обращаемся через [] а не .get(): TTLCache.get делает две проверки ключа (in + []), а тут одна
+    try:
+        entry = _subscription_cache[(user_id, channel_id)]
+    except KeyError:
+        # Кэша нет или он устарел
+        return False, False
+    return True, entry.result
+
+def set_subscription_cache(user_id: int, channel_id: int, is_member: bool = True):
+    """Сохраняет результат проверки подписки в кэш (перезаписывая прежний)."""
+    _subscription_cache[user_id, channel_id] = SubEntry(_now(), is_member)
+
+# Прежде отдельная функция с тем же телом; если при принудительном обновлении нужен лог - его пишет вызывающий
+update_subscription_cache = set_subscription_cache
+
+def invalidate_linked_channels_cache(chat_id: int):
+    """Сбрасывает отметку "у чата нет каналов" - вызывать после привязки канала к чату."""
+    _chats_known_empty.pop(chat_id, None)
+
+def forget_channel_info(channel_id: int):
+    """Сбрасывает кэш отображаемых данных канала - вызывать при (пере)привязке канала к чату."""
+    _channel_display_cache.pop(channel_id, None)
+
+# --- Обработчики ошибок API в check_single_channel --- #
+# Каждый получает (user_id, channel_id, исключение, текст ошибки в нижнем регистре, (имя, канал, ID канала) для логов)
+# и возвращает статус для результата проверки: ChatMemberStatus или None, если проверить не удалось.
+
+def _on_user_not_found(user_id: int, channel_id: int, e: TelegramAPIError, err_msg: str, log_args: tuple):
+    logger.warning("[SUB_CHECK_SINGLE_API_ERROR] %s на %s (ID: %s): пользователь не найден в канале (API: %s). Считаем НЕ подписанным.", *log_args, e)
+    set_subscription_cache(user_id, channel_id, False)
+    return ChatMemberStatus.LEFT
+
+def _on_chat_not_found(user_id: int, channel_id: int, e: TelegramAPIError, err_msg: str, log_args: tuple):
+    _dead_channels[channel_id] = err_msg
+    logger.error("[SUB_CHECK_SINGLE_API_ERROR] %s на %s (ID: %s): чат/канал не найден (API: %s).", *log_args, e)
+    return None
+
+def _on_bot_not_in_channel(user_id: int, channel_id: int, e: TelegramAPIError, err_msg: str, log_args: tuple):
+    _dead_channels[channel_id] = err_msg
+    logger.error("[SUB_CHECK_SINGLE_API_ERROR] %s на %s (ID: %s): бот не является участником канала (API: %s).", *log_args, e)
+    return None
+
+def _on_chat_unavailable(user_id: int, channel_id: int, e: TelegramAPIError, err_msg: str, log_args: tuple):
+    logger.warning("[SUB_CHECK_SINGLE_API_ERROR_UNAVAILABLE] %s на %s (ID: %s): канал временно недоступен (API: %s). Считаем НЕ подписанным на этот раз.", *log_args, e)
+    # Не кэшируем этот результат как False, так как проблема может быть временной
+    return ChatMemberStatus.LEFT
+
+def _on_other_api_error(user_id: int, channel_id: int, e: TelegramAPIError, err_msg: str, log_args: tuple):
+    logger.error("[SUB_CHECK_SINGLE_API_ERROR_OTHER] %s на %s (ID: %s): другая ошибка Telegram API: %s", *log_args, e)
+    set_subscription_cache(user_id, channel_id, False)
+    return ChatMemberStatus.LEFT
+
+# (фрагмент текста ошибки, тип исключения, обработчик) - проверяются по порядку, первый совпавший выигрывает
+_SINGLE_CHECK_ERROR_DISPATCH = (
+    ("user not found", TelegramAPIError, _on_user_not_found),
+    ("chat not found", TelegramAPIError, _on_chat_not_found),
+    ("bot was kicked from the channel", TelegramAPIError, _on_bot_not_in_channel),
+    ("bot is not a member of the channel", TelegramAPIError, _on_bot_not_in_channel),
+    ("chat unavailable", TelegramBadRequest, _on_chat_unavailable), # TelegramBadRequest - более специфичный тип ошибки
+)
 
 # ----------------------------------- #
 
@@ -148,196 +225,331 @@ class SubscriptionService:
     def __init__(self, bot: Bot, db_manager: DatabaseManager):
         self.bot = bot
         self.db = db_manager
-        # Запускаем периодическую очистку кэша (каждые 6 часов)
-        asyncio.create_task(self._schedule_cache_cleanup())
-        # Запускаем ежедневное обновление кэша в 5 утра
-        asyncio.create_task(self.schedule_daily_cache_update())
-
-    async def _schedule_cache_cleanup(self):
-        """Запускает периодическую очистку кэша"""
-        while True:
-            # await asyncio.sleep(600)  # Старый интервал 10 минут
-            await asyncio.sleep(6 * 60 * 60)  # Новый интервал 6 часов
-            logger.info("[SUB_CACHE] Запуск периодической очистки устаревшего кэша подписок (старше 24ч).") # Добавил лог
-            clear_expired_subscription_cache()
-            
-    async def schedule_daily_cache_update(self):
-        """Запускает ежедневное обновление кэша подписок в 5 утра"""
-        while True:
+        # Общий бюджет запросов get_chat_member: не более 10 одновременно и ~10 в секунду
+        self._api_sem = asyncio.Semaphore(10)
+        self._api_limiter = RateLimiter(rate=10)
+        # Отложенное удаление служебных сообщений: куча (время удаления по monotonic, chat_id, message_id, номер попытки),
+        # которую разбирает одна фоновая задача вместо отдельной спящей задачи на каждое сообщение
+        self._delete_queue: List[Tuple[float, int, int, int]] = []
+        self._delete_event = asyncio.Event()
+        self._delete_sweeper_task: Optional[asyncio.Task] = None
+        # Недавно удаленные сообщения {(chat_id, message_id): True}: повторное удаление пропускаем без запроса к API
+        self._deleted_recently = LRUCache(maxsize=4096)
+        # Каналы, показанные пользователю в последнем предупреждении: {(user_id, chat_id): [данные _resolve_channel]}.
+        # Сообщение о муте повторяет этот список, не запрашивая данные каналов заново
+        self._recent_resolve = LRUCache(maxsize=10_000)
+        # Ежедневное обновление кэша (update_all_subscriptions_cache) в 5 утра планируется через APScheduler в __main__
+
+    async def _get_cached_chat_info(self, channel_id: int, force_refresh: bool = False) -> Dict[str, Optional[str]]:
+        """
+        Возвращает {title, username, invite_link} канала, кэшируя ответ get_chat на 10 минут.
+        Хранится маленький dict, а не объект Chat целиком. Ошибки API пробрасываются и в кэш не попадают.
+        """
+        if not force_refresh:
             try:
-                # Вычисляем время до 5 утра
-                now = datetime.datetime.now()
-                target_time = now.replace(hour=5, minute=0, second=0, microsecond=0)
-                if now >= target_time:
-                    # Если сейчас после 5 утра, планируем на завтра
-                    target_time = target_time + datetime.timedelta(days=1)
-                
-                seconds_to_wait = (target_time - now).total_seconds()
-                logger.info(f"[CACHE_SCHEDULER] 📆 Запланировано обновление кэша подписок в {target_time.strftime('%Y-%m-%d %H:%M:%S')} (через {seconds_to_wait/3600:.1f} часов)")
-                await asyncio.sleep(seconds_to_wait)
-                
-                await self.update_all_subscriptions_cache()
-                logger.info(f"[CACHE_SCHEDULER] ✅ Выполнено массовое обновление кэша подписок")
-            except Exception as e:
-                logger.error(f"[CACHE_SCHEDULER] ❌ Ошибка в планировщике: {e}", exc_info=True)
-                await asyncio.sleep(3600)
+                return _channel_display_cache[channel_id]
+            except KeyError:
+                pass
+        channel_obj = await self.bot.get_chat(channel_id)
+        info = {
+            'title': channel_obj.title,
+            # Chat всегда определяет эти поля (Optional[str]) - проверки hasattr/getattr не нужны
+            'username': channel_obj.username,
+            'invite_link': channel_obj.invite_link,
+        }
+        _channel_display_cache[channel_id] = info
+        return info
+
+    async def warm_channel_cache(self):
+        """
+        Заново запрашивает данные всех привязанных каналов и кладет их в кэш.
+        Запускается по расписанию (APScheduler, каждые 5 минут при TTL кэша 10 минут), поэтому
+        предупреждения о подписке обычно берут данные каналов из памяти, без запросов к API.
+        """
+        try:
+            links_by_chat = await self.db.get_all_linked_channels()
+        except Exception as e:
+            logger.error(f"[CHANNEL_CACHE_WARM] Не удалось получить список привязанных каналов: {e}", exc_info=True)
+            return
+
+        # Один канал может быть привязан к нескольким чатам; недавно "умершие" каналы не трогаем
+        channel_ids = {cid for channels in links_by_chat.values() for cid in channels if cid not in _dead_channels}
+        if not channel_ids:
+            return
+
+        changed = False
+
+        async def refresh(cid: int) -> bool:
+            nonlocal changed
+            previous = _channel_display_cache.get(cid)
+            # Прогрев делит общий бюджет запросов с проверками подписки
+            async with self._api_sem:
+                await self._api_limiter.acquire()
+                try:
+                    info = await self._get_cached_chat_info(cid, force_refresh=True)
+                except Exception as e:
+                    logger.debug("[CHANNEL_CACHE_WARM] Не удалось обновить данные канала %s: %s", cid, e)
+                    return False
+            if previous is not None and previous != info:
+                changed = True
+            return True
+
+        results = await asyncio.gather(*(refresh(cid) for cid in channel_ids))
+        if changed:
+            # Строки со старыми названиями/ссылками больше не понадобятся - освобождаем кэши форматирования
+            _format_bullet.cache_clear()
+            _format_channel_row.cache_clear()
+        logger.info("[CHANNEL_CACHE_WARM] Обновлены данные %s из %s каналов.", sum(results), len(channel_ids))
+
+    async def _resolve_channel(self, cid: int) -> Dict[str, Any]:
+        """
+        Данные канала для сообщений о подписке: {id, title, link, username}.
+        Ошибки не пробрасывает: если информацию получить не удалось, возвращает заглушку с ID канала.
+        """
+        resolved = _channel_stub(cid)
+        try:
+            info = await self._get_cached_chat_info(cid)
+        except TelegramAPIError as e:
+            logger.warning("[SUB_CH_FETCH_FAIL] Не удалось получить инфо для канала %s: %s", cid, e)
+            return resolved
+        except Exception as e:
+            logger.error("[SUB_CH_FETCH_UNEXPECTED] Неожиданная ошибка при получении инфо для канала %s: %s", cid, e, exc_info=True)
+            return resolved
+
+        if info['title']:
+            resolved['title'] = info['title']
+        # username берется из Chat напрямую, а не выковыривается из ссылки (у инвайт-ссылок t.me/+XXXX его нет)
+        resolved['username'] = info['username']
+        if info['username']:
+            resolved['link'] = f"https://t.me/{info['username']}"
+        elif info['invite_link']:
+            resolved['link'] = info['invite_link']
+        logger.debug("[SUB_CH_INFO] Канал %s: title='%s', username='%s', invite_link='%s', final_link='%s'",
+                     cid, info['title'], info['username'], info['invite_link'], resolved['link'])
+        return resolved
+
+    async def _resolve_channels(self, channel_ids: List[int]) -> List[Dict[str, Any]]:
+        """Получает данные всех каналов параллельно (~1 запрос по времени вместо N последовательных), сохраняя порядок."""
+        results = await asyncio.gather(*(self._resolve_channel(cid) for cid in channel_ids), return_exceptions=True)
+        # _resolve_channel сам ловит ошибки API; return_exceptions - чтобы один сбой (например, отмена) не ронял весь список
+        return [
+            _channel_stub(cid) if isinstance(res, BaseException) else res
+            for cid, res in zip(channel_ids, results)
+        ]
 
     async def update_all_subscriptions_cache(self):
         """Обновляет кэш подписок для всех активных пользователей и каналов"""
         try:
-            active_chats = await self.db.get_active_chats_with_subscription_check()
-            total_chats = len(active_chats)
-            total_users_processed = 0 
-            total_api_checks_made = 0
+            # Полный список чатов не нужен - только их количество для логов прогресса
+            total_chats = await self.db.count_active_chats_with_subscription_check()
+            # Счетчики общие для всех воркеров (все работают в одном event loop, гонок нет)
+            stats = {"chats_done": 0, "users": 0, "api_checks": 0, "cache_hits": 0, "skipped_no_channels": 0, "skipped_no_users": 0}
             
-            logger.info(f"[CACHE_UPDATE] 🔄 Начато массовое обновление кэша для {total_chats} чатов")
+            logger.info("[CACHE_UPDATE] 🔄 Начато массовое обновление кэша для %s чатов", total_chats)
+            # Каналы всех чатов загружаются одним запросом (их немного), а пользователи читаются
+            # небольшими страницами чатов (iter_active_users_by_chat) - в памяти только текущая порция
+            links_by_chat = await self.db.get_all_linked_channels()
+
+            # Чаты обрабатываются несколькими воркерами параллельно; общий темп запросов к API
+            # по-прежнему ограничивают self._api_sem и self._api_limiter.
+            # Очередь ограничена, чтобы чтение из БД не убегало далеко вперед обработки
+            queue: asyncio.Queue = asyncio.Queue(maxsize=_SWEEP_WORKERS * 2)
+
+            async def worker():
+                while True:
+                    chat_id, active_users = await queue.get()
+                    try:
+                        await self._sweep_chat(chat_id, links_by_chat.get(chat_id, []), active_users, stats)
+                    except Exception as e_outer_loop:
+                        logger.error("[CACHE_UPDATE] Ошибка при обработке чата %s: %s", chat_id, e_outer_loop, exc_info=True)
+                        await asyncio.sleep(1) # Пауза при ошибке на уровне чата
+                    finally:
+                        stats["chats_done"] += 1
+                        # Прогресс пишем раз в 50 чатов, а не по строке на каждый чат
+                        if stats["chats_done"] % 50 == 0:
+                            logger.info("[CACHE_UPDATE] Прогресс: %d/%d чатов", stats["chats_done"], total_chats)
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(_SWEEP_WORKERS)]
+            chats_with_users = 0
+            try:
+                async for chat_id, active_users in self.db.iter_active_users_by_chat(days=7): # Можно параметризировать `days`
+                    chats_with_users += 1
+                    await queue.put((chat_id, active_users))
+                await queue.join()
+            finally:
+                for worker_task in workers:
+                    worker_task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+            # Чаты без единого известного пользователя генератор не отдает вовсе
+            stats["skipped_no_users"] += max(total_chats - chats_with_users, 0)
+
+            logger.info("[CACHE_UPDATE] ✅ Завершено обновление кэша: обработано чатов (попыток) - %s, уникальных пользователей (в циклах) - %s, API-запросов сделано - %s, пропущено свежих записей кэша - %s, чатов без каналов - %s, чатов без активных пользователей - %s.", total_chats, stats['users'], stats['api_checks'], stats['cache_hits'], stats['skipped_no_channels'], stats['skipped_no_users'])
             
-            API_REQUEST_DELAY = 0.1  # Задержка 0.1 сек -> ~10 запросов/сек от этой задачи
+        except Exception as e:
+            logger.error("[CACHE_UPDATE] ❌ Критическая ошибка при массовом обновлении кэша: %s", e, exc_info=True)
 
-            for chat_idx, chat_id in enumerate(active_chats):
+    async def _sweep_chat(self, chat_id: int, linked_channels: List[int], active_users: List[int], stats: Dict[str, int]):
+        """Обновляет кэш подписок для одного чата (вызывается воркерами update_all_subscriptions_cache)."""
+        # Пропуски только считаем - итог попадет в финальный лог update_all_subscriptions_cache
+        if not linked_channels:
+            stats["skipped_no_channels"] += 1
+            return
+        
+        if not active_users:
+            stats["skipped_no_users"] += 1
+            return
+    
+        logger.info("[CACHE_UPDATE] Обрабатываю чат %s: %s пользователей × %s каналов", chat_id, len(active_users), len(linked_channels))
+        fresh_threshold = _SUBSCRIPTION_CACHE_TTL * 0.5
+        
+        for user_idx, user_id in enumerate(active_users):
+            channel_invalidated = False
+            # Боты и служебный аккаунт Telegram (777000) отфильтрованы в iter_active_users_by_chat
+            stats["users"] += 1
+            # Записи моложе половины TTL уже обновлены живыми проверками - обновляем только более старые,
+            # так повторные проверки распределяются по времени, а не приходятся все на одну ночь
+            now = _now()
+            stale_channels = []
+            for channel_id in linked_channels:
                 try:
-                    linked_channels = await self.db.get_linked_channels_for_chat(chat_id)
-                    if not linked_channels:
-                        logger.debug(f"[CACHE_UPDATE] Чат {chat_id} ({(chat_idx+1)}/{total_chats}) не имеет связанных каналов, пропускаем")
-                        continue
-                    
-                    active_users = await self.db.get_active_chat_users(chat_id, days=7) # Можно параметризировать `days`
-                    if not active_users:
-                        logger.debug(f"[CACHE_UPDATE] Чат {chat_id} ({(chat_idx+1)}/{total_chats}) не имеет активных пользователей за последние 7 дней, пропускаем")
-                        continue
-                
-                    logger.info(f"[CACHE_UPDATE] Обрабатываю чат {chat_id} ({(chat_idx+1)}/{total_chats}): {len(active_users)} пользователей × {len(linked_channels)} каналов")
-                    
-                    for user_idx, user_id in enumerate(active_users):
-                        # Явный пропуск служебного аккаунта Telegram
-                        if user_id == 777000:
-                            logger.info(f"[CACHE_UPDATE] Пропуск служебного аккаунта Telegram (ID: {user_id}) при обновлении кэша подписок для чата {chat_id}.")
-                            continue
-
-                        # Попытка определить, является ли user_id ботом, перед циклом по каналам
-                        try:
-                            user_object = await self.bot.get_chat(user_id) # Один запрос для определения типа
-                            if hasattr(user_object, 'is_bot') and user_object.is_bot:
-                                logger.info(f"[CACHE_UPDATE] Пропуск бота (ID: {user_id}, Name: {user_object.full_name if hasattr(user_object, 'full_name') else 'N/A'}) при обновлении кэша подписок для чата {chat_id}.")
-                                continue
-                        except TelegramAPIError as e_get_user:
-                            logger.warning(f"[CACHE_UPDATE] Не удалось получить информацию о user_id {user_id} (возможно, не существует или заблокировал бота): {e_get_user}. Пропускаем этого пользователя для чата {chat_id}.")
-                            continue
-                        except Exception as e_generic_get_user:
-                            logger.error(f"[CACHE_UPDATE] Непредвиденная ошибка при получении информации о user_id {user_id}: {e_generic_get_user}. Пропускаем этого пользователя для чата {chat_id}.", exc_info=True)
-                            continue
+                    cached_at = _subscription_cache[(user_id, channel_id)].timestamp
+                except KeyError:
+                    cached_at = None
+                if cached_at is not None and now - cached_at < fresh_threshold:
+                    stats["cache_hits"] += 1
+                else:
+                    stale_channels.append(channel_id)
+            if not stale_channels:
+                continue
 
-                        total_users_processed +=1 
-                        for channel_id in linked_channels: # Убрал channel_idx, он не использовался
-                            try:
-                                member = await self.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-                                is_member = member.status in {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}
-                            
-                                _subscription_cache[(user_id, channel_id)] = {
-                                    "result": is_member,
-                                    "timestamp": time.time()
-                                }
-                                total_api_checks_made += 1
-                                
-                                if total_api_checks_made > 0 and total_api_checks_made % 50 == 0:
-                                    logger.info(f"[CACHE_UPDATE] Обработано {total_api_checks_made} API-запросов на проверку подписок...")
-                                
-                                await asyncio.sleep(API_REQUEST_DELAY)
-                                    
-                            except TelegramAPIError as e_api:
-                                if "user not found" in str(e_api).lower():
-                                    _subscription_cache[(user_id, channel_id)] = {"result": False, "timestamp": time.time()}
-                                    logger.info(f"[CACHE_UPDATE] Пользователь {user_id} не найден в канале {channel_id} (API: {e_api}), кэшировано как False.")
-                                elif "chat not found" in str(e_api).lower() or "bot was kicked from the channel" in str(e_api).lower():
-                                    logger.warning(f"[CACHE_UPDATE] Канал {channel_id} не найден или бот кикнут (API: {e_api}). Пропускаем дальнейшие проверки для этого канала в этом чате.")
-                                    # Можно добавить логику для удаления этого канала из связанных с чатом chat_id в БД
-                                    break # Прерываем цикл по каналам для текущего пользователя, если канал недействителен
-                                else:
-                                    logger.error(f"[CACHE_UPDATE] Ошибка API при обновлении кэша для user={user_id} channel={channel_id}: {e_api}")
-                                await asyncio.sleep(API_REQUEST_DELAY) 
-                            except Exception as e_inner:
-                                logger.error(f"[CACHE_UPDATE] Непредвиденная ошибка при обновлении кэша для user={user_id} channel={channel_id}: {e_inner}", exc_info=True)
-                                await asyncio.sleep(API_REQUEST_DELAY)
-                        
-                        # Если прервали цикл по каналам (например, канал не найден), выходим из цикла по пользователям для этого чата
-                        if 'e_api' in locals() and ("chat not found" in str(e_api).lower() or "bot was kicked from the channel" in str(e_api).lower()): # pyright: ignore [reportUnboundVariable]
-                           break
-
-                        if (user_idx + 1) % 20 == 0: # Лог после каждых 20 пользователей в чате
-                             logger.info(f"[CACHE_UPDATE] В чате {chat_id} обработано {(user_idx + 1)}/{len(active_users)} пользователей.")
-                             await asyncio.sleep(0.5) # Дополнительная пауза после обработки пачки пользователей
-                except Exception as e_outer_loop:
-                    logger.error(f"[CACHE_UPDATE] Ошибка при обработке чата {chat_id} ({(chat_idx+1)}/{total_chats}): {e_outer_loop}", exc_info=True)
-                    await asyncio.sleep(1) # Пауза при ошибке на уровне чата
-
-            logger.info(f"[CACHE_UPDATE] ✅ Завершено обновление кэша: обработано чатов (попыток) - {total_chats}, уникальных пользователей (в циклах) - {total_users_processed}, API-запросов сделано - {total_api_checks_made}.")
+            # Все каналы пользователя проверяем параллельно, частоту ограничивают self._api_sem и self._api_limiter
+            results = await asyncio.gather(
+                *[self._sweep_check_one(user_id, channel_id) for channel_id in stale_channels],
+                return_exceptions=True
+            )
+            for channel_id, result in zip(stale_channels, results):
+                if isinstance(result, TelegramAPIError):
+                    # Канал недействителен - дальнейшие проверки в этом чате бессмысленны
+                    channel_invalidated = True
+                    logger.warning("[CACHE_UPDATE] Канал %s не найден или бот кикнут (API: %s). Пропускаем дальнейшие проверки для этого канала в этом чате.", channel_id, result)
+                    # Можно добавить логику для удаления этого канала из связанных с чатом chat_id в БД
+                elif isinstance(result, Exception):
+                    logger.error("[CACHE_UPDATE] Непредвиденная ошибка при обновлении кэша для user=%s channel=%s: %s", user_id, channel_id, result, exc_info=result)
+                elif result is not None:
+                    set_subscription_cache(user_id, channel_id, result)
+            previous_checks = stats["api_checks"]
+            stats["api_checks"] += len(stale_channels)
+
+            if stats["api_checks"] // 50 != previous_checks // 50:
+                logger.info("[CACHE_UPDATE] Обработано %s API-запросов на проверку подписок...", stats['api_checks'])
             
-        except Exception as e:
-            logger.error(f"[CACHE_UPDATE] ❌ Критическая ошибка при массовом обновлении кэша: {e}", exc_info=True)
+            # Если канал оказался недействителен, выходим из цикла по пользователям для этого чата
+            if channel_invalidated:
+                break
+
+            if (user_idx + 1) % 20 == 0: # Лог после каждых 20 пользователей в чате
+                logger.info("[CACHE_UPDATE] В чате %s обработано %s/%s пользователей.", chat_id, user_idx + 1, len(active_users))
+                await asyncio.sleep(0.5) # Дополнительная пауза после обработки пачки пользователей
             
-    async def check_single_channel(self, user_id: int, channel_id: int, user_name: str = None) -> Tuple[int, Any]:
+    async def _sweep_check_one(self, user_id: int, channel_id: int) -> Optional[bool]:
+        """
+        Один запрос get_chat_member для массового обновления кэша.
+        Возвращает True/False для кэша или None, если результат кэшировать не нужно.
+        Ошибки "канал не найден"/"бот кикнут" пробрасываются наружу, чтобы прервать обработку чата.
+        """
+        if channel_id in _dead_channels:
+            return None
+        async with self._api_sem:
+            await self._api_limiter.acquire()
+            try:
+                member = await self.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+                return member.status in _SUBSCRIBED_STATUSES
+            except TelegramAPIError as e_api:
+                err_msg = str(e_api).lower()
+                if "user not found" in err_msg:
+                    logger.info("[CACHE_UPDATE] Пользователь %s не найден в канале %s (API: %s), кэшировано как False.", user_id, channel_id, e_api)
+                    return False
+                elif any(s in err_msg for s in _FATAL_CHANNEL_ERRORS):
+                    _dead_channels[channel_id] = err_msg
+                    raise
+                logger.error("[CACHE_UPDATE] Ошибка API при обновлении кэша для user=%s channel=%s: %s", user_id, channel_id, e_api)
+                return None
+
+    async def check_single_channel(self, user_id: int, channel_id: int, user_name: str = None) -> Tuple[int, Any, Optional[str]]:
+        """
+        Проверяет подписку пользователя на ОДИН канал, объединяя одновременные вызовы для одной пары
+        (user_id, channel_id) в один запрос к API. Формат результата - как у _check_single_channel_api.
+        """
+        key = (user_id, channel_id)
+        task = _inflight_checks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._check_single_channel_api(user_id, channel_id, user_name))
+            _inflight_checks[key] = task
+            task.add_done_callback(lambda done, key=key: _inflight_checks.pop(key, None) if _inflight_checks.get(key) is done else None)
+        # shield: отмена одного из ожидающих не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _check_single_channel_api(self, user_id: int, channel_id: int, user_name: str = None) -> Tuple[int, Any, Optional[str]]:
         """
         Проверяет подписку пользователя на ОДИН канал.
-        Возвращает кортеж: (channel_id, status) где status это ChatMemberStatus или None/False при ошибке.
+        Возвращает кортеж: (channel_id, status, channel_title) где status это ChatMemberStatus или None/False при ошибке,
+        а channel_title - название канала из кэша (None, если получить не удалось), чтобы вызывающему не нужно было запрашивать его повторно.
         Логирует результат проверки.
         """
         user_name_for_log = user_name if user_name else f"User_{user_id}"
         channel_name_for_log = f"Channel_{channel_id}" # Попробуем получить позже, если есть
+        channel_title = None
         
         # Попытка получить название канала из кэша или API (для логов)
         try:
             # Используем новый get_cached_chat_info
             channel_info = await get_cached_chat_info(self.bot, channel_id)
             if channel_info and channel_info.title:
-                channel_name_for_log = channel_info.title
+                channel_title = channel_name_for_log = channel_info.title
         except Exception as e_info:
-            logger.debug(f"[SUB_CHECK_SINGLE_INFO_FAIL] Не удалось получить название для канала {channel_id}: {e_info}")
+            logger.debug("[SUB_CHECK_SINGLE_INFO_FAIL] Не удалось получить название для канала %s: %s", channel_id, e_info)
 
 
-        logger.info(f"[SUB_CHECK_SINGLE_INIT] Проверка подписки: {user_name_for_log} на {channel_name_for_log} (ID: {channel_id})")
+        logger.info("[SUB_CHECK_SINGLE_INIT] Проверка подписки: %s на %s (ID: %s)", user_name_for_log, channel_name_for_log, channel_id)
 
         # 1. Проверка кэша (ОТКЛЮЧЕНО НА ВРЕМЯ ОТЛАДКИ)
         # is_cached, cached_result = get_cached_subscription(user_id, channel_id)
         # if is_cached:
         #     logger.info(f"[SUB_CHECK_SINGLE_CACHE] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): результат из кэша: {'подписан' if cached_result else 'НЕ подписан'}")
-        #     return channel_id, ChatMemberStatus.MEMBER if cached_result else ChatMemberStatus.LEFT
+        #     return channel_id, (ChatMemberStatus.MEMBER if cached_result else ChatMemberStatus.LEFT), channel_title
+
+        # Канал недавно оказался недоступен - не повторяем заведомо неудачный запрос
+        if channel_id in _dead_channels:
+            logger.info("[SUB_CHECK_SINGLE_DEAD_CHANNEL] %s на %s (ID: %s): канал недоступен (%s), запрос к API пропущен.", user_name_for_log, channel_name_for_log, channel_id, _dead_channels.get(channel_id))
+            return channel_id, None, channel_title
 
         # 2. Запрос к Telegram API
         try:
-            logger.debug(f"[SUB_CHECK_SINGLE_API_CALL] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): запрос к Telegram API...")
+            logger.debug("[SUB_CHECK_SINGLE_API_CALL] %s на %s (ID: %s): запрос к Telegram API...", user_name_for_log, channel_name_for_log, channel_id)
+            # Живые проверки делят бюджет запросов с массовым обновлением кэша
+            await self._api_limiter.acquire()
             # Добавляем timeout к запросу API
             member_status = await self.bot.get_chat_member(chat_id=channel_id, user_id=user_id) # request_timeout=10 можно добавить, если версия aiogram позволяет
             
-            is_member = member_status.status in {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}
+            is_member = member_status.status in _SUBSCRIBED_STATUSES
             
             # Сохраняем результат в кэш (даже если кэш на чтение отключен, запись оставим)
             set_subscription_cache(user_id, channel_id, is_member)
             
-            logger.info(f"[SUB_CHECK_SINGLE_API_RESULT] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): статус от API: {member_status.status}, результат: {'подписан' if is_member else 'НЕ подписан'}")
-            return channel_id, member_status.status
+            logger.info("[SUB_CHECK_SINGLE_API_RESULT] %s на %s (ID: %s): статус от API: %s, результат: %s", user_name_for_log, channel_name_for_log, channel_id, member_status.status, 'подписан' if is_member else 'НЕ подписан')
+            return channel_id, member_status.status, channel_title
 
         except TelegramAPIError as e:
-            if "user not found" in str(e).lower():
-                logger.warning(f"[SUB_CHECK_SINGLE_API_ERROR] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): пользователь не найден в канале (API: {e}). Считаем НЕ подписанным.")
-                set_subscription_cache(user_id, channel_id, False)
-                return channel_id, ChatMemberStatus.LEFT
-            elif "chat not found" in str(e).lower():
-                logger.error(f"[SUB_CHECK_SINGLE_API_ERROR] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): чат/канал не найден (API: {e}).")
-                return channel_id, None 
-            elif "bot was kicked from the channel" in str(e).lower() or "bot is not a member of the channel" in str(e).lower():
-                logger.error(f"[SUB_CHECK_SINGLE_API_ERROR] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): бот не является участником канала (API: {e}).")
-                return channel_id, None
-            elif isinstance(e, TelegramBadRequest) and "chat unavailable" in str(e).lower(): # TelegramBadRequest - более специфичный тип ошибки
-                logger.warning(f"[SUB_CHECK_SINGLE_API_ERROR_UNAVAILABLE] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): канал временно недоступен (API: {e}). Считаем НЕ подписанным на этот раз.")
-                # Не кэшируем этот результат как False, так как проблема может быть временной
-                return channel_id, ChatMemberStatus.LEFT 
-            else:
-                logger.error(f"[SUB_CHECK_SINGLE_API_ERROR_OTHER] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): другая ошибка Telegram API: {e}", exc_info=True)
-                set_subscription_cache(user_id, channel_id, False) 
-                return channel_id, ChatMemberStatus.LEFT
+            err_msg = str(e).lower() # Форматирование исключения aiogram не бесплатное - делаем его один раз
+            log_args = (user_name_for_log, channel_name_for_log, channel_id)
+            for needle, error_type, handler in _SINGLE_CHECK_ERROR_DISPATCH:
+                if needle in err_msg and isinstance(e, error_type):
+                    return channel_id, handler(user_id, channel_id, e, err_msg, log_args), channel_title
+            return channel_id, _on_other_api_error(user_id, channel_id, e, err_msg, log_args), channel_title
         except Exception as e:
-            logger.error(f"[SUB_CHECK_SINGLE_UNEXPECTED_ERROR] {user_name_for_log} на {channel_name_for_log} (ID: {channel_id}): критическая ошибка при проверке: {e}", exc_info=True)
-            return channel_id, None
+            logger.error("[SUB_CHECK_SINGLE_UNEXPECTED_ERROR] %s на %s (ID: %s): критическая ошибка при проверке: %s", user_name_for_log, channel_name_for_log, channel_id, e, exc_info=True)
+            return channel_id, None, channel_title
 
     async def check_subscription(self, user_id: int, chat_id: int, force_check: bool = False) -> Tuple[bool, List[int]]: # Добавлен force_check
         """
@@ -345,6 +557,10 @@ class SubscriptionService:
         force_check: Если True, подразумевается, что check_single_channel будет делать реальный API запрос (кэш чтения в нём отключен).
         Возвращает кортеж: (is_fully_subscribed, list_of_unsubscribed_channel_ids)
         """
+        # Большинство групп без привязанных каналов: отвечаем из памяти, не обращаясь ни к API, ни к БД
+        if chat_id in _chats_known_empty:
+            return True, []
+
         user_info = await get_cached_general_info(self.bot, user_id, "user")
         user_name_for_log = user_info.get('full_name', f"User_{user_id}") if user_info else f"User_{user_id}"
         
@@ -356,6 +572,7 @@ class SubscriptionService:
 
         linked_channel_ids = await self.db.get_linked_channels_for_chat(chat_id)
         if not linked_channel_ids:
+            _chats_known_empty[chat_id] = True
             logger.info(f"{log_prefix} {user_name_for_log} в {chat_title_for_log}: нет каналов для проверки. Считаем подписанным.")
             return True, []
                                     
@@ -376,20 +593,20 @@ class SubscriptionService:
                 unsubscribed_channel_ids.append(current_channel_id)
                 continue
 
-            returned_channel_id, status = result_item 
+            returned_channel_id, status, channel_title = result_item 
             
             if returned_channel_id != current_channel_id:
                  logger.warning(f"{log_prefix}_GATHER_MISMATCH {user_name_for_log} в {chat_title_for_log}: несоответствие ID канала. Ожидался {current_channel_id}, получен {returned_channel_id}. Используем полученный.")
             
             target_channel_id_for_log = returned_channel_id
             
-            channel_info_for_log = await get_cached_chat_info(self.bot, target_channel_id_for_log)
-            channel_title_for_log_item = channel_info_for_log.title if channel_info_for_log and channel_info_for_log.title else f"Канал ID {target_channel_id_for_log}"
+            # Название уже получено в check_single_channel - повторный запрос не нужен
+            channel_title_for_log_item = channel_title or f"Канал ID {target_channel_id_for_log}"
 
             if status is None: 
                 logger.warning(f"{log_prefix}_CHANNEL_ERROR {user_name_for_log} в {chat_title_for_log}: НЕ УДАЛОСЬ ПРОВЕРИТЬ статус для {channel_title_for_log_item} (ID: {target_channel_id_for_log}). Считаем НЕ подписанным.")
                 unsubscribed_channel_ids.append(target_channel_id_for_log)
-            elif status not in {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}:
+            elif status not in _SUBSCRIBED_STATUSES:
                 logger.info(f"{log_prefix}_NOT_SUBSCRIBED {user_name_for_log} в {chat_title_for_log}: НЕ подписан на {channel_title_for_log_item} (ID: {target_channel_id_for_log}). Статус от API: {status}")
                 unsubscribed_channel_ids.append(target_channel_id_for_log)
             else:
@@ -442,7 +659,7 @@ class SubscriptionService:
                     disable_notification=True 
                 )
                 logger.info(f"[SUB_CALLBACK_GROUP_MSG_SENT] Тихое сообщение об успехе отправлено в чат {chat_id} для {user_mention}, ID: {sent_group_msg.message_id}.")
-                asyncio.create_task(self._delete_message_after_delay(chat_id, sent_group_msg.message_id, 3)) # Удаление через 3 секунды
+                self._schedule_delete(chat_id, sent_group_msg.message_id, 3) # Удаление через 3 секунды
             except Exception as e_group_msg:
                 logger.error(f"[SUB_CALLBACK_GROUP_MSG_FAIL] Не удалось отправить тихое сообщение в чат {chat_id} для {user_mention}: {e_group_msg}", exc_info=True)
 
@@ -456,21 +673,23 @@ class SubscriptionService:
         else: # Если подписки нет
             logger.info(f"[SUB_CALLBACK_FAIL] {user_mention} (ID: {user.id}) НЕ прошел проверку подписки в чате {chat_id}. Незавершенные каналы: {unsubscribed_channels}")
             
-            channels_to_subscribe_info = await self.db.get_channels_info_by_ids(unsubscribed_channels)
+            # Данные каналов получаем один раз (из кэша или параллельными запросами) и строим по ним
+            # и алерт, и текст сообщения, и клавиатуру - без второго прохода ради кнопок
+            resolved_channels = await self._resolve_channels(unsubscribed_channels) if unsubscribed_channels else []
             
             alert_text_parts = []
             channels_list_str_for_edit_msg = [] # Для текста редактируемого сообщения
 
-            if channels_to_subscribe_info:
+            if resolved_channels:
                 alert_text_parts.append(f"🚫 {user_mention}, вы все еще не подписаны на:")
                 channels_list_str_for_edit_msg.append(f"{user_mention}, чтобы писать сообщения, пожалуйста, подпишитесь на:")
 
-                for ch_info in channels_to_subscribe_info:
-                    title = ch_info.get('channel_title', f'Канал ID {ch_info["channel_id"]}')
-                    link = ch_info.get('channel_link') 
+                for ch in resolved_channels:
+                    title = ch['title']
+                    link = ch['link']
                     
                     # Для сообщения используем форматирование с ссылкой/жирным названием
-                    channel_line_for_msg = f"🔗 {hlink(title, link)}" if link else f"📛 {hbold(title)}"
+                    channel_line_for_msg = _format_channel_row(title, link)
                     
                     # Для алерта - просто название
                     alert_text_parts.append(f"  • {title}") 
@@ -480,65 +699,51 @@ class SubscriptionService:
                 channels_list_str_for_edit_msg.append("") # Пустая строка для отступа
                 channels_list_str_for_edit_msg.append("После подписки нажмите кнопку ниже.")
             
-            else: # Если вдруг нет информации о каналах (маловероятно, но на всякий случай)
+            else: # Если вдруг список каналов пуст (маловероятно, но на всякий случай)
                 alert_text_parts.append(f"🚫 {user_mention}, не удалось подтвердить вашу подписку. Убедитесь, что подписаны на все каналы, и попробуйте снова.")
                 channels_list_str_for_edit_msg.append(f"{user_mention}, не удалось подтвердить подписку. Убедитесь, что подписаны на нужные каналы. Кнопка ниже. Сообщение удалится через 15 сек.")
 
             final_alert_text = "\n".join(alert_text_parts) # Собираем текст для алерта
             final_edit_message_text = "\n".join(channels_list_str_for_edit_msg) # Собираем текст для редактирования
 
-            # Получаем актуальную клавиатуру для сообщения
-            # detailed_missing_channels_for_keyboard теперь нужно формировать здесь заново
-            # на основе unsubscribed_channels, чтобы кнопка была актуальной
-            detailed_keyboard_channels_info = []
-            if unsubscribed_channels:
-                # Попытка получить актуальные данные для клавиатуры
-                # Это дублирует логику из send_subscription_warning, но тут это нужно для кнопки
-                # Можно вынести в отдельный хелпер, если будет использоваться еще где-то
-                for ch_id_loop in unsubscribed_channels:
-                    ch_title_kb = f"Канал {ch_id_loop}"
-                    ch_link_kb = None
-                    try:
-                        ch_obj_kb = await self.bot.get_chat(ch_id_loop)
-                        ch_title_kb = ch_obj_kb.title or ch_title_kb
-                        ch_username_kb = getattr(ch_obj_kb, 'username', None)
-                        ch_invite_link_kb = getattr(ch_obj_kb, 'invite_link', None)
-                        if ch_username_kb: ch_link_kb = f"https://t.me/{ch_username_kb}"
-                        elif ch_invite_link_kb: ch_link_kb = ch_invite_link_kb
-                    except Exception: pass # Игнорируем ошибки, если не удалось получить инфо
-                    detailed_keyboard_channels_info.append({
-                        'id': ch_id_loop, 
-                        'title': ch_title_kb, 
-                        'invite_link': ch_link_kb,
-                        'username': ch_link_kb.split('/')[-1] if ch_link_kb and "t.me/" in ch_link_kb else None
-                    })
-            
-            reply_markup_for_edit = get_subscription_check_keyboard(user.id, detailed_keyboard_channels_info if detailed_keyboard_channels_info else [])
+            # Клавиатура принимает данные _resolve_channel как есть (id, title, link, username)
+            reply_markup_for_edit = get_subscription_check_keyboard(user.id, resolved_channels)
 
 
-            try: # Редактируем исходное сообщение с кнопкой
-                await self.bot.edit_message_text(
+            # Редактирование сообщения с кнопкой и алерт независимы - отправляем их одновременно,
+            # чтобы алерт появился, не дожидаясь ответа на edit_message_text
+            edit_result, alert_result = await asyncio.gather(
+                self.bot.edit_message_text(
                     text=final_edit_message_text,
                     chat_id=chat_id,
                     message_id=message_id_of_button,
                     reply_markup=reply_markup_for_edit, # Оставляем кнопку
                     parse_mode="HTML",
                     disable_web_page_preview=True
-                )
-                logger.info(f"[SUB_CALLBACK_EDITED] Сообщение {message_id_of_button} отредактировано для {user_mention} в чате {chat_id} с информацией о недостающих подписках.")
-                # Планируем удаление этого отредактированного сообщения через 15 секунд
-                asyncio.create_task(self._delete_message_after_delay(chat_id, message_id_of_button, 15))
-            except TelegramAPIError as e_edit:
-                logger.error(f"[SUB_CALLBACK_EDIT_FAIL] Не удалось отредактировать сообщение {message_id_of_button} для {user_mention} в чате {chat_id}: {e_edit}")
+                ),
+                callback_query.answer(final_alert_text, show_alert=True, cache_time=5), # cache_time можно убрать или оставить
+                return_exceptions=True
+            )
+
+            if isinstance(edit_result, TelegramAPIError):
+                logger.error(f"[SUB_CALLBACK_EDIT_FAIL] Не удалось отредактировать сообщение {message_id_of_button} для {user_mention} в чате {chat_id}: {edit_result}")
                 # Если редактирование не удалось, возможно, стоит просто удалить старое и отправить новое,
                 # но пока ограничимся логгированием и показом алерта.
+            elif not isinstance(edit_result, BaseException):
+                logger.info(f"[SUB_CALLBACK_EDITED] Сообщение {message_id_of_button} отредактировано для {user_mention} в чате {chat_id} с информацией о недостающих подписках.")
+                # Планируем удаление этого отредактированного сообщения через 15 секунд
+                self._schedule_delete(chat_id, message_id_of_button, 15)
 
-            try: # Показываем алерт пользователю
-                await callback_query.answer(final_alert_text, show_alert=True, cache_time=5) # cache_time можно убрать или оставить
-                logger.info(f"[SUB_CALLBACK_ALERT_SENT] Alert о необходимости подписки отправлен {user_mention} в чате {chat_id}.")
-            except TelegramAPIError as e_alert: 
-                logger.error(f"[SUB_CALLBACK_ALERT_FAIL] Не удалось отправить alert {user_mention} в чате {chat_id}: {e_alert}")
+            if isinstance(alert_result, TelegramAPIError):
+                logger.error(f"[SUB_CALLBACK_ALERT_FAIL] Не удалось отправить alert {user_mention} в чате {chat_id}: {alert_result}")
                 # Если алерт не прошел, пользователь увидит отредактированное сообщение (если оно отредактировалось)
+            elif not isinstance(alert_result, BaseException):
+                logger.info(f"[SUB_CALLBACK_ALERT_SENT] Alert о необходимости подписки отправлен {user_mention} в чате {chat_id}.")
+
+            # Прочие ошибки (не Telegram API) пробрасываем, как и раньше
+            for result in (edit_result, alert_result):
+                if isinstance(result, BaseException) and not isinstance(result, TelegramAPIError):
+                    raise result
 
     async def send_subscription_warning(
         self,
@@ -551,91 +756,25 @@ class SubscriptionService:
         user_mention = get_user_mention_html(user)
         # channels_info = await self.db.get_channels_info_by_ids(missing_channel_ids) # Больше не используем старый метод БД для названий/ссылок
 
-        message_text_parts = []
-        message_text_parts.append(
-            f"{user_mention}, чтобы писать сообщения в этом чате, пожалуйста, подпишитесь на:"
-        )
-
-        detailed_missing_channels_for_keyboard = [] # Для кнопки "Я подписался"
+        intro_line = f"{user_mention}, чтобы писать сообщения в этом чате, пожалуйста, подпишитесь на:"
 
         if not missing_channel_ids:
-            logger.warning(format_sub_log("SUB_WARN_NO_CHANNELS", user_id=user.id, chat_id=chat_id,
-                                           extra_info="Вызван send_subscription_warning, но список missing_channel_ids пуст."))
+            logger.warning("[SUB_WARN_NO_CHANNELS] Пользователь %s в чате %s: Вызван send_subscription_warning, но список missing_channel_ids пуст.", user.id, chat_id)
             # Можно отправить общее сообщение или ничего не делать
             return None
 
-        for channel_id_loop in missing_channel_ids:
-            channel_title_display = f"Канал ID {channel_id_loop}" # Заголовок по умолчанию
-            channel_link_display = None # Ссылка по умолчанию
+        # Информация о каналах запрашивается параллельно (кэшируется на 10 минут);
+        # из одного и того же списка строятся и текст, и кнопка "Я подписался"
+        resolved_channels = await self._resolve_channels(missing_channel_ids)
+        self._recent_resolve[(user.id, chat_id)] = resolved_channels
+        channel_lines = [_format_bullet(ch['title'], ch['link']) for ch in resolved_channels]
 
-            try:
-                # Получаем актуальную информацию о канале
-                # Используем кэшированную функцию get_cached_chat_info, если она доступна и подходит
-                # или напрямую self.bot.get_chat()
-                # Для простоты примера, предположим, что get_cached_chat_info подходит
-                # или делаем прямой вызов:
-                channel_obj = await self.bot.get_chat(channel_id_loop)
-                
-                current_title = channel_obj.title
-                current_username = channel_obj.username if hasattr(channel_obj, 'username') else None
-                current_invite_link = channel_obj.invite_link if hasattr(channel_obj, 'invite_link') else None
-
-                if current_title:
-                    channel_title_display = current_title
-                
-                if current_username:
-                    channel_link_display = f"https://t.me/{current_username}"
-                elif current_invite_link:
-                    channel_link_display = current_invite_link
-                
-                logger.debug(format_sub_log("SUB_WARN_CH_INFO", user_id=user.id, chat_id=chat_id,
-                                           extra_info=f"Канал {channel_id_loop}: title='{current_title}', username='{current_username}', invite_link='{current_invite_link}', final_link='{channel_link_display}'"))
-
-            except TelegramAPIError as e_get_chat:
-                logger.error(format_sub_log("SUB_WARN_CH_FETCH_FAIL", user_id=user.id, chat_id=chat_id,
-                                            extra_info=f"Не удалось получить инфо для канала {channel_id_loop}: {e_get_chat}"))
-                # Оставляем title/link по умолчанию
-            except Exception as e_unexpected_fetch:
-                logger.error(format_sub_log("SUB_WARN_CH_FETCH_UNEXPECTED", user_id=user.id, chat_id=chat_id,
-                                            extra_info=f"Неожиданная ошибка при получении инфо для канала {channel_id_loop}: {e_unexpected_fetch}"))
-
-
-            if channel_link_display:
-                message_text_parts.append(f"  • {hlink(channel_title_display, channel_link_display)}")
-            else:
-                message_text_parts.append(f"  • {hbold(channel_title_display)}")
-
-            detailed_missing_channels_for_keyboard.append({
-                'id': channel_id_loop,
-                'title': channel_title_display,
-                'invite_link': channel_link_display, 
-                'username': channel_link_display.split('/')[-1] if channel_link_display and "t.me/" in channel_link_display else None
-            })
-
-        message_text_parts.append("") # Пустая строка для отступа
-        message_text_parts.append("После подписки нажмите кнопку ниже.")
-
-        # Собираем HTML текст
-        # Первая строка: "Pasha, чтобы писать..."
-        # Далее список каналов, каждый на новой строке
-        # Затем пустая строка (визуальный отступ)
-        # Затем "После подписки нажмите кнопку ниже."
-        
-        # Начальная часть сообщения
-        final_text_parts = [message_text_parts[0]] 
-
-        # Добавляем каналы (элементы с индексами от 1 до предпоследнего элемента оригинального message_text_parts)
-        # message_text_parts изначально: [intro, ch1, ch2, ..., "", "После подписки..."]
-        # Каналы это message_text_parts[1:-2]
-        if len(message_text_parts) > 2: # Если есть хотя бы один канал + intro + два последних элемента
-            final_text_parts.extend(message_text_parts[1:-2])
-        
-        # Добавляем заключительную фразу (последний элемент оригинального message_text_parts)
-        final_text_parts.append(message_text_parts[-1])
-
-        final_text_html = "\n".join(final_text_parts) # Используем \n вместо <br>
+        # Приветствие, список каналов, пустая строка для отступа и подсказка про кнопку - одним join без промежуточного списка
+        final_text_html = "\n".join(itertools.chain(
+            (intro_line,), channel_lines, ("", "После подписки нажмите кнопку ниже.")
+        )) # Используем \n вместо <br>
 
-        reply_markup = get_subscription_check_keyboard(user.id, detailed_missing_channels_for_keyboard)
+        reply_markup = get_subscription_check_keyboard(user.id, resolved_channels)
 
         try:
             sent_msg = await self.bot.send_message(
@@ -645,14 +784,13 @@ class SubscriptionService:
                 parse_mode="HTML",
                 disable_web_page_preview=True
             )
-            logger.info(format_sub_log("SUB_WARN_SENT", user_id=user.id, chat_id=chat_id, 
-                                   extra_info=f"Предупреждение о подписке отправлено, ID: {sent_msg.message_id}"))
+            logger.info("[SUB_WARN_SENT] Пользователь %s в чате %s: Предупреждение о подписке отправлено, ID: %s", user.id, chat_id, sent_msg.message_id)
             # Удаляем это сообщение через 120 секунд, если оно не от кнопки
             if not user_initiated: 
-                asyncio.create_task(self._delete_message_after_delay(chat_id, sent_msg.message_id, 15))
+                self._schedule_delete(chat_id, sent_msg.message_id, 15)
             return sent_msg
         except TelegramAPIError as e:
-            logger.error(format_sub_log("SUB_WARN_FAIL", user_id=user.id, chat_id=chat_id, extra_info=f"Ошибка отправки предупреждения о подписке: {e}"))
+            logger.error("[SUB_WARN_FAIL] Пользователь %s в чате %s: Ошибка отправки предупреждения о подписке: %s", user.id, chat_id, e)
             return None
 
     async def handle_subscription_failure(
@@ -666,142 +804,181 @@ class SubscriptionService:
         mute_duration_minutes: int
     ):
         """Обрабатывает неудачную проверку подписки согласно новой логике."""
-        user_mention = get_user_mention_html(user)
-
         # Увеличиваем счетчик и обновляем в БД
         new_sub_fail_count = current_sub_fail_count + 1
         try:
             await self.db.update_sub_fail_count(user.id, chat.id, new_sub_fail_count)
-            logger.info(format_sub_log("SUB_FAIL_COUNT_UPDATED", user_id=user.id, chat_id=chat.id,
-                                   extra_info=f"Счетчик неудач обновлен на {new_sub_fail_count} (был {current_sub_fail_count})."))
+            logger.info("[SUB_FAIL_COUNT_UPDATED] Пользователь %s в чате %s: Счетчик неудач обновлен на %s (был %s).", user.id, chat.id, new_sub_fail_count, current_sub_fail_count)
         except Exception as e_db_update_fail:
-            logger.error(format_sub_log("SUB_FAIL_COUNT_DB_ERROR", user_id=user.id, chat_id=chat.id,
-                                       extra_info=f"Ошибка при обновлении счетчика неудач на {new_sub_fail_count} в БД: {e_db_update_fail}"))
+            logger.error("[SUB_FAIL_COUNT_DB_ERROR] Пользователь %s в чате %s: Ошибка при обновлении счетчика неудач на %s в БД: %s", user.id, chat.id, new_sub_fail_count, e_db_update_fail)
             # Если не удалось обновить счетчик, возможно, стоит прервать дальнейшие действия или использовать new_sub_fail_count "как есть"
             # Пока продолжаем, но это потенциальная проблема
             pass
 
 
-        # Попытка 1 (new_sub_fail_count = 1)
-        if new_sub_fail_count == 1:
-            logger.info(format_sub_log("SUB_FAIL_ATTEMPT_1", user_id=user.id, chat_id=chat.id, 
-                                   extra_info=f"Первая неудачная попытка. Отправка предупреждения."))
-            # Удаляем оригинальное сообщение пользователя
-            try:
-                await original_message.delete()
-            except TelegramAPIError:
-                logger.warning(format_sub_log("SUB_FAIL_MSG_DEL_ERR", user_id=user.id, chat_id=chat.id, 
-                                       extra_info="Не удалось удалить оригинальное сообщение при первой неудаче."))
-            # Отправляем предупреждение
-            await self.send_subscription_warning(chat.id, user, unsubscribed_channel_ids)
-            return # Завершаем обработку для этой попытки
-
-        # Попытки между первой и последней (1 < new_sub_fail_count < max_fails_allowed)
-        elif 1 < new_sub_fail_count < max_fails_allowed:
-            logger.info(format_sub_log("SUB_FAIL_ATTEMPT_INTERMEDIATE", user_id=user.id, chat_id=chat.id, 
-                                   extra_info=f"Промежуточная неудачная попытка ({new_sub_fail_count}/{max_fails_allowed}). Удаление сообщения."))
-            # Просто удаляем сообщение пользователя
-            try:
-                await original_message.delete()
-            except TelegramAPIError:
-                logger.warning(format_sub_log("SUB_FAIL_MSG_DEL_ERR", user_id=user.id, chat_id=chat.id, 
-                                       extra_info="Не удалось удалить оригинальное сообщение при промежуточной неудаче."))
-            return # Завершаем обработку
-
-        # Последняя разрешенная попытка (new_sub_fail_count == max_fails_allowed)
-        elif new_sub_fail_count >= max_fails_allowed: # Используем >= для надежности
-            logger.info(format_sub_log("SUB_FAIL_ATTEMPT_LAST", user_id=user.id, chat_id=chat.id, 
-                                   extra_info=f"Последняя разрешенная попытка ({new_sub_fail_count}/{max_fails_allowed}). Установка мута."))
-            # Удаляем оригинальное сообщение пользователя
+        # Стадия: первая неудача - предупреждение, промежуточная - только удаление, последняя - мут
+        stage = "first" if new_sub_fail_count == 1 else "last" if new_sub_fail_count >= max_fails_allowed else "intermediate"
+
+        # Сообщение пользователя удаляется на любой стадии
+        try:
+            await original_message.delete()
+        except TelegramAPIError:
+            logger.warning("[SUB_FAIL_MSG_DEL_ERR] Пользователь %s в чате %s: Не удалось удалить оригинальное сообщение (%s неудача).", user.id, chat.id, _FAIL_STAGE_NAMES[stage])
+
+        handler = getattr(self, f"_handle_fail_{stage}")
+        await handler(user, chat, unsubscribed_channel_ids, new_sub_fail_count, max_fails_allowed, mute_duration_minutes)
+
+    async def _handle_fail_first(self, user: types.User, chat: types.Chat, unsubscribed_channel_ids: List[int],
+                                 new_sub_fail_count: int, max_fails_allowed: int, mute_duration_minutes: int):
+        """Первая неудачная попытка: отправляем предупреждение со списком каналов."""
+        logger.info("[SUB_FAIL_ATTEMPT_1] Пользователь %s в чате %s: Первая неудачная попытка. Отправка предупреждения.", user.id, chat.id)
+        await self.send_subscription_warning(chat.id, user, unsubscribed_channel_ids)
+
+    async def _handle_fail_intermediate(self, user: types.User, chat: types.Chat, unsubscribed_channel_ids: List[int],
+                                        new_sub_fail_count: int, max_fails_allowed: int, mute_duration_minutes: int):
+        """Попытки между первой и последней (1 < new_sub_fail_count < max_fails_allowed): только удаление сообщения."""
+        logger.info("[SUB_FAIL_ATTEMPT_INTERMEDIATE] Пользователь %s в чате %s: Промежуточная неудачная попытка (%s/%s). Удаление сообщения.", user.id, chat.id, new_sub_fail_count, max_fails_allowed)
+
+    async def _handle_fail_last(self, user: types.User, chat: types.Chat, unsubscribed_channel_ids: List[int],
+                                new_sub_fail_count: int, max_fails_allowed: int, mute_duration_minutes: int):
+        """Последняя разрешенная попытка (new_sub_fail_count >= max_fails_allowed): мут и сообщение о нем."""
+        logger.info("[SUB_FAIL_ATTEMPT_LAST] Пользователь %s в чате %s: Последняя разрешенная попытка (%s/%s). Установка мута.", user.id, chat.id, new_sub_fail_count, max_fails_allowed)
+        user_mention = get_user_mention_html(user)
+
+        # Накладываем мут
+        mute_until_ts = int(time.time()) + (mute_duration_minutes * 60) # Здесь нужно именно настенное время: until_date уходит в Telegram
+        try:
+            # aiogram 3 принимает until_date как UNIX-время (int) - без перевода в локальный datetime
+            await self.bot.restrict_chat_member(
+                chat_id=chat.id,
+                user_id=user.id,
+                permissions=_MUTE_PERMS,
+                until_date=mute_until_ts
+            )
+            mute_until_str = datetime.datetime.fromtimestamp(mute_until_ts, tz=datetime.timezone.utc).isoformat()
+            logger.info("[MUTE_APPLIED] Пользователь %s в чате %s: Пользователь замучен до %s.", user.id, chat.id, mute_until_str)
+            
+            # Время мута и сброс счетчика неудач - одной транзакцией
+            if await self.db.finalize_mute(user.id, chat.id, mute_until_ts):
+                logger.info("[SUB_FAIL_COUNT_RESET] Пользователь %s в чате %s: Статус мута сохранен, счетчик неудач сброшен.", user.id, chat.id)
+
+            mute_header = (
+                f"{user_mention}, вы были временно ограничены в отправке сообщений на {mute_duration_minutes} мин., "
+                f"так как не подписались на обязательные каналы."
+            )
+            # Если с последнего предупреждения набор каналов не изменился - берем уже полученные данные
+            resolved_channels = self._recent_resolve.pop((user.id, chat.id), None)
+            if resolved_channels is None or [ch['id'] for ch in resolved_channels] != list(unsubscribed_channel_ids):
+                resolved_channels = await self._resolve_channels(unsubscribed_channel_ids) if unsubscribed_channel_ids else []
+            mute_channel_lines = [_format_bullet(ch['title'], ch['link']) for ch in resolved_channels]
+            
+            mute_message_text = "\n".join(itertools.chain(
+                (mute_header,),
+                ("Необходимо подписаться на:",) if unsubscribed_channel_ids else (),
+                mute_channel_lines
+            )) # Используем \n вместо <br>
+            
             try:
-                await original_message.delete()
-            except TelegramAPIError:
-                logger.warning(format_sub_log("SUB_FAIL_MSG_DEL_ERR", user_id=user.id, chat_id=chat.id, 
-                                       extra_info="Не удалось удалить оригинальное сообщение при последней неудаче."))
+                sent_mute_msg = await self.bot.send_message(chat.id, mute_message_text, parse_mode="HTML", disable_web_page_preview=True)
+                self._schedule_delete(chat.id, sent_mute_msg.message_id, 10)
+            except Exception as e_send_mute_msg:
+                logger.error("[MUTE_MSG_SEND_FAIL] Пользователь %s в чате %s: Не удалось отправить сообщение о муте: %s", user.id, chat.id, e_send_mute_msg)
 
-            # Накладываем мут
-            mute_until_ts = int(time.time()) + (mute_duration_minutes * 60)
+        except TelegramAPIError as e:
+            logger.error("[MUTE_FAIL_API] Пользователь %s в чате %s: Ошибка API при установке мута: %s", user.id, chat.id, e)
+        except Exception as e_db_ban: # Этот except должен быть на том же уровне, что и предыдущий TelegramAPIError
+             logger.error("[MUTE_DB_UPDATE_FAIL] Пользователь %s в чате %s: Ошибка при обновлении статуса бана в БД: %s", user.id, chat.id, e_db_ban)
+
+    def _schedule_delete(self, chat_id: int, message_id: int, delay: float):
+        """Ставит сообщение в очередь на удаление через delay секунд (delay <= 0 - удалить при ближайшем проходе)."""
+        # Даже немедленное удаление идет через очередь: разборщик держит ссылку на задачу и повторяет при RetryAfter
+        heapq.heappush(self._delete_queue, (time.monotonic() + max(delay, 0), chat_id, message_id, 0))
+        self._delete_event.set()
+        # Задача-разборщик запускается при первом использовании (сервис создается уже внутри работающего цикла)
+        if self._delete_sweeper_task is None or self._delete_sweeper_task.done():
+            self._delete_sweeper_task = asyncio.create_task(self._deletion_sweeper())
+        logger.debug("[DELETE_SCHEDULED] Сообщение %s в чате %s будет удалено через %s сек.", message_id, chat_id, delay)
+
+    async def _deletion_sweeper(self):
+        """Фоновая задача: ждет ближайший срок из очереди и удаляет все созревшие сообщения параллельно."""
+        while True:
             try:
-                await self.bot.restrict_chat_member(
-                    chat_id=chat.id,
-                    user_id=user.id,
-                    permissions=types.ChatPermissions(can_send_messages=False),
-                    until_date=datetime.datetime.fromtimestamp(mute_until_ts)
-                )
-                logger.info(format_sub_log("MUTE_APPLIED", user_id=user.id, chat_id=chat.id,
-                                       extra_info=f"Пользователь замучен до {datetime.datetime.fromtimestamp(mute_until_ts)}."))
-                
-                await self.db.update_user_ban_status(
-                    user_id=user.id,
-                    chat_id=chat.id,
-                    ban_until_ts=mute_until_ts
-                )
-                await self.db.reset_sub_fail_count(user.id, chat.id)
-                logger.info(format_sub_log("SUB_FAIL_COUNT_RESET", user_id=user.id, chat_id=chat.id,
-                                       extra_info="Счетчик неудач сброшен после мута."))
-
-                mute_message_text_parts_html = []
-                mute_message_text_parts_html.append(
-                    f"{user_mention}, вы были временно ограничены в отправке сообщений на 30 минут, "
-                    f"так как не подписались на обязательные каналы."
-                )
+                if not self._delete_queue:
+                    self._delete_event.clear()
+                    await self._delete_event.wait()
+                    continue
+
+                timeout = self._delete_queue[0][0] - time.monotonic()
+                if timeout > 0:
+                    # Просыпаемся либо к ближайшему сроку, либо раньше - если добавили новое сообщение
+                    self._delete_event.clear()
+                    try:
+                        await asyncio.wait_for(self._delete_event.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                now = time.monotonic()
+                due = []
+                while self._delete_queue and self._delete_queue[0][0] <= now:
+                    due.append(heapq.heappop(self._delete_queue))
+                # Первый же флуд-контроль (RetryAfter) отменяет остальные удаления пачки,
+                # чтобы не добивать API запросами, которые все равно получат 429
+                tasks = [
+                    asyncio.create_task(self._delete_message(chat_id, message_id, raise_retry_after=True))
+                    for _, chat_id, message_id, _ in due
+                ]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                retry_afters = [
+                    t.exception().retry_after for t in done
+                    if not t.cancelled() and isinstance(t.exception(), TelegramRetryAfter)
+                ]
+                if pending:
+                    for t in pending:
+                        t.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                if retry_afters:
+                    retry_after = max(retry_afters)
+                    retry_at = time.monotonic() + retry_after
+                    requeued = 0
+                    for _, chat_id, message_id, attempt in due:
+                        if (chat_id, message_id) in self._deleted_recently:
+                            continue
+                        if attempt >= 1:
+                            logger.warning(f"[SUB_DEL_FAIL] Чат {chat_id}: сообщение {message_id} не удалено - повторный флуд-контроль.")
+                            continue
+                        heapq.heappush(self._delete_queue, (retry_at, chat_id, message_id, attempt + 1))
+                        requeued += 1
+                    logger.warning(f"[DELETE_SWEEPER_RETRY_AFTER] Флуд-контроль при удалении сообщений: пауза {retry_after} сек., повторно в очереди {requeued} сообщ.")
+                    await asyncio.sleep(retry_after)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[DELETE_SWEEPER_ERROR] Неожиданная ошибка в задаче удаления сообщений: {e}", exc_info=True)
+                await asyncio.sleep(1)
 
-                if unsubscribed_channel_ids:
-                    mute_message_text_parts_html.append("Необходимо подписаться на:")
-                    for channel_id_loop in unsubscribed_channel_ids:
-                        channel_title_display = f"Канал ID {channel_id_loop}"
-                        channel_link_display = None
-                        try:
-                            channel_obj = await self.bot.get_chat(channel_id_loop)
-                            current_title = channel_obj.title
-                            current_username = channel_obj.username if hasattr(channel_obj, 'username') else None
-                            current_invite_link = channel_obj.invite_link if hasattr(channel_obj, 'invite_link') else None
-                            if current_title:
-                                channel_title_display = current_title
-                            if current_username:
-                                channel_link_display = f"https://t.me/{current_username}"
-                        except TelegramAPIError as e_get_chat_mute:
-                            logger.warning(format_sub_log("MUTE_MSG_CH_FETCH_FAIL", user_id=user.id, chat_id=chat.id,
-                                                        extra_info=f"Не удалось получить инфо для канала {channel_id_loop} при формировании сообщения о муте: {e_get_chat_mute}"))
-                        except Exception as e_generic_fetch:
-                            logger.error(format_sub_log("MUTE_MSG_CH_FETCH_UNEXPECTED", user_id=user.id, chat_id=chat.id,
-                                                       extra_info=f"Неожиданная ошибка при получении инфо для канала {channel_id_loop} для сообщения о муте: {e_generic_fetch}"), exc_info=True)
-                        
-                        if channel_link_display:
-                            mute_message_text_parts_html.append(f"  • {hlink(channel_title_display, channel_link_display)}")
-                        else:
-                            mute_message_text_parts_html.append(f"  • {hbold(channel_title_display)}")
-                
-                mute_message_text = "\n".join(mute_message_text_parts_html) # Используем \n вместо <br>
-                
-                try:
-                    sent_mute_msg = await self.bot.send_message(chat.id, mute_message_text, parse_mode="HTML", disable_web_page_preview=True)
-                    asyncio.create_task(self._delete_message_after_delay(chat.id, sent_mute_msg.message_id, 10))
-                except Exception as e_send_mute_msg:
-                    logger.error(format_sub_log("MUTE_MSG_SEND_FAIL", user_id=user.id, chat_id=chat.id,
-                                               extra_info=f"Не удалось отправить сообщение о муте: {e_send_mute_msg}"))
-
-            except TelegramAPIError as e:
-                logger.error(format_sub_log("MUTE_FAIL_API", user_id=user.id, chat_id=chat.id, extra_info=f"Ошибка API при установке мута: {e}"))
-            except Exception as e_db_ban: # Этот except должен быть на том же уровне, что и предыдущий TelegramAPIError
-                 logger.error(format_sub_log("MUTE_DB_UPDATE_FAIL", user_id=user.id, chat_id=chat.id, extra_info=f"Ошибка при обновлении статуса бана в БД: {e_db_ban}"))
-            return # Завершаем обработку
-
-    async def _delete_message_after_delay(self, chat_id: int, message_id: int, delay: int):
-        """Deletes a message after a specified delay."""
-        logger.info(f"[DELETE_TASK_STARTED] Задача на удаление сообщения {message_id} в чате {chat_id} через {delay} сек. ЗАПУЩЕНА.")
-        await asyncio.sleep(delay)
-        logger.info(f"[DELETE_TASK_AWOKE] Задача на удаление сообщения {message_id} в чате {chat_id}. ПРОСНУЛАСЬ после {delay} сек. Попытка удаления...")
+    async def _delete_message(self, chat_id: int, message_id: int, raise_retry_after: bool = False):
+        """Удаляет сообщение, логируя результат. Ошибки не пробрасывает, кроме RetryAfter при raise_retry_after=True."""
+        key = (chat_id, message_id)
+        if key in self._deleted_recently:
+            return
         try:
             await self.bot.delete_message(chat_id, message_id)
-            # Используем format_sub_log, если он доступен в этом контексте, или просто logger.info
-            # logger.info(format_sub_log("SUB_DEL_SUCCESS", chat_id=chat_id, extra_info=f"Сообщение {message_id} успешно удалено."))
-            logger.info(f"[SUB_DEL_SUCCESS] Чат {chat_id}: Сообщение {message_id} успешно удалено.") # Упрощенный лог для надежности
+            self._deleted_recently[key] = True
+            logger.info(f"[SUB_DEL_SUCCESS] Чат {chat_id}: Сообщение {message_id} успешно удалено.")
+        except TelegramRetryAfter:
+            if raise_retry_after:
+                raise
+            logger.warning(f"[SUB_DEL_FAIL] Чат {chat_id}: Не удалось удалить сообщение {message_id}: флуд-контроль.")
         except TelegramAPIError as e:
-            # logger.warning(format_sub_log("SUB_DEL_FAIL", chat_id=chat_id, extra_info=f"Не удалось удалить сообщение {message_id}: {e}"))
-            logger.warning(f"[SUB_DEL_FAIL] Чат {chat_id}: Не удалось удалить сообщение {message_id}: {e}") # Упрощенный лог
+            if "message to delete not found" in str(e).lower():
+                # Обычная гонка: сообщение уже удалено (пользователем, админом или другой задачей)
+                self._deleted_recently[key] = True
+                logger.debug("[SUB_DEL_SKIP] Чат %s: сообщение %s уже удалено.", chat_id, message_id)
+                return
+            logger.warning(f"[SUB_DEL_FAIL] Чат {chat_id}: Не удалось удалить сообщение {message_id}: {e}")
         except Exception as e_unexp:
-            logger.error(f"[DELETE_TASK_UNEXPECTED_ERROR] Неожиданная ошибка в задаче удаления сообщения {message_id} в чате {chat_id}: {e_unexp}", exc_info=True)
+            logger.error(f"[DELETE_TASK_UNEXPECTED_ERROR] Неожиданная ошибка при удалении сообщения {message_id} в чате {chat_id}: {e_unexp}", exc_info=True)
 
     async def unban_user_for_subscription(self, user_id: int, chat_id: int):
         """Снимает ограничения с пользователя и сбрасывает его статус бана/счетчик неудач в БД."""
@@ -809,28 +986,18 @@ class SubscriptionService:
             await self.bot.restrict_chat_member(
                 chat_id=chat_id,
                 user_id=user_id,
-                permissions=types.ChatPermissions(
-                    can_send_messages=True,
-                    can_send_media_messages=True,
-                    can_send_polls=True,
-                    can_send_other_messages=True,
-                    can_add_web_page_previews=True,
-                    can_change_info=False, # Обычно не разрешаем
-                    can_invite_users=True,
-                    can_pin_messages=False # Обычно не разрешаем
-                ),
+                permissions=_UNMUTE_PERMS,
                 until_date=0  # Снимаем ограничения немедленно
             )
-            logger.info(format_sub_log("UNBAN_SUCCESS", user_id=user_id, chat_id=chat_id, extra_info="Ограничения сняты после подписки."))
+            logger.info("[UNBAN_SUCCESS] Пользователь %s в чате %s: Ограничения сняты после подписки.", user_id, chat_id)
         except TelegramAPIError as e:
-            logger.error(format_sub_log("UNBAN_FAIL_API", user_id=user_id, chat_id=chat_id, extra_info=f"Ошибка API при снятии ограничений: {e}"))
+            logger.error("[UNBAN_FAIL_API] Пользователь %s в чате %s: Ошибка API при снятии ограничений: %s", user_id, chat_id, e)
         
         try:
-            await self.db.clear_user_ban_status(user_id, chat_id)
-            await self.db.reset_sub_fail_count(user_id, chat_id)
-            logger.info(format_sub_log("UNBAN_DB_SUCCESS", user_id=user_id, chat_id=chat_id, extra_info="Статус бана и счетчик неудач сброшены в БД."))
+            await self.db.clear_ban_and_fails(user_id, chat_id)
+            logger.info("[UNBAN_DB_SUCCESS] Пользователь %s в чате %s: Статус бана и счетчик неудач сброшены в БД.", user_id, chat_id)
         except Exception as e:
-            logger.error(format_sub_log("UNBAN_DB_FAIL", user_id=user_id, chat_id=chat_id, extra_info=f"Ошибка при сбросе статуса бана/счетчика в БД: {e}"))
+            logger.error("[UNBAN_DB_FAIL] Пользователь %s в чате %s: Ошибка при сбросе статуса бана/счетчика в БД: %s", user_id, chat_id, e)
 
     # Старый метод handle_unsubscribed_user, оставляем его закомментированным или удаляем позже
     # async def handle_unsubscribed_user(
@@ -1,24 +1,123 @@
 import asyncio
 import logging
-from typing import List
+import random
+import re
+from typing import List, Tuple
 
+import time
+from cachetools import TTLCache
 from aiogram import Bot
 # Импорты для aiogram v3.x (с учетом вашей версии 3.20.0)
 from aiogram.exceptions import (
     TelegramBadRequest,      # Изменено с TelegramBadRequestError
     TelegramForbiddenError,
     TelegramNotFound,        # Изменено с ChatNotFound (UserDeactivated и BotBlocked будут ловиться через эти)
+    TelegramNetworkError,
+    TelegramRetryAfter,
     # BotBlocked, UserDeactivated - специфичных классов нет в выводе dir(),
     # они будут пойманы как TelegramForbiddenError или TelegramBadRequest
 )
 
 from bot.db.database import DatabaseManager # Убедитесь, что путь импорта корректен
+from bot.utils.helpers import RateLimiter
 
 logger = logging.getLogger(__name__)
 
 USER_CHECK_BATCH_SIZE = 3000  # Количество пользователей для проверки за один раз
 MAX_DELETIONS_PER_RUN = 100   # Максимальное количество удалений за один запуск
-API_CALL_DELAY = 0.05         # Задержка между вызовами API в секундах (20 запросов/сек)
+EARLY_STOP_MIN_CHECKED = 100  # После скольких проверок начинаем оценивать долю удаленных
+EARLY_STOP_DELETED_RATIO = 0.5 # Доля удаленных среди проверенных, при которой проверка завершается досрочно
+INACTIVE_DAYS = 180           # Пользователи, не появлявшиеся дольше, проверяются через API в первую очередь
+INACTIVE_PROBE_LIMIT = 1000   # Сколько таких пользователей ставится в начало очереди проверки за один запуск
+CHECK_CONCURRENCY = 25        # Воркеров, одновременно проверяющих пользователей (одновременных запросов get_chat)
+CHECK_RATE_PER_SEC = 28       # Частота запросов get_chat (глобальный лимит Telegram ~30 запросов/сек)
+RETRY_BASE_DELAY = 1.0        # Базовая задержка экспоненциального повтора при сетевых ошибках, сек.
+RETRY_MAX_DELAY = 30.0        # Верхняя граница задержки повтора, сек.
+
+# Фрагменты текста ошибок API, означающие удаленный/деактивированный аккаунт или заблокированного бота,
+# и уровень лога для каждого. Невалидный ID - не обычное удаление аккаунта, а повод присмотреться к данным в БД.
+# Одно регулярное выражение вместо цепочки проверок `in` по строке, приведенной к нижнему регистру один раз;
+# найденный фрагмент сразу дает уровень лога через словарь
+_DELETED_MARKERS = {
+    "user not found": logging.INFO,
+    "chat not found": logging.INFO,
+    "user_id_invalid": logging.WARNING,
+    "peer_id_invalid": logging.WARNING,
+    "user is deactivated": logging.INFO,
+    "bot was blocked by the user": logging.INFO,
+}
+_DELETED_RE = re.compile("|".join(map(re.escape, _DELETED_MARKERS)))
+
+# Пользователи, которые недавно (за последние 72 часа) успешно прошли проверку get_chat.
+# TTL заметно больше суточного интервала задачи, поэтому следующие 2 запуска их не перепроверяют.
+# Кэш живет только в памяти: после рестарта порядок проверки держится на last_cleanup_check_ts в БД
+RECENTLY_ALIVE_TTL = 72 * 3600
+_recently_alive = TTLCache(maxsize=200_000, ttl=RECENTLY_ALIVE_TTL, timer=time.monotonic)
+
+
+async def _get_chat_with_retry(bot: Bot, user_id: int, limiter: RateLimiter, max_retries: int = 3):
+    """
+    bot.get_chat с повторами при временных сбоях.
+    RetryAfter - ждем столько, сколько просит Telegram; сетевые ошибки и таймауты - экспоненциальная
+    задержка с джиттером (не больше RETRY_MAX_DELAY). NotFound/Forbidden/BadRequest пробрасываются сразу:
+    по ним и определяется удаленный аккаунт. После max_retries повторов пробрасывается последняя ошибка.
+    Каждая попытка (включая повторы) берет токен из limiter.
+    """
+    attempt = 0
+    while True:
+        await limiter.acquire()
+        try:
+            # Именно get_chat, а не более легкий send_chat_action: большинство пользователей знакомы боту только
+            # по группам и не писали ему в ЛС, поэтому send_chat_action вернет им Forbidden ("bot can't initiate
+            # conversation") - и живые аккаунты ушли бы на удаление. К тому же тем, кто писал, показалось бы "печатает..."
+            return await bot.get_chat(chat_id=user_id)
+        except TelegramRetryAfter as e:
+            if attempt >= max_retries:
+                raise
+            logger.warning("[UserCleanup] Флуд-контроль при проверке пользователя %s: ожидание %s сек. (попытка %s/%s)", user_id, e.retry_after, attempt + 1, max_retries)
+            await asyncio.sleep(e.retry_after)
+        except (TelegramNetworkError, asyncio.TimeoutError) as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random() * 0.5))
+            logger.warning("[UserCleanup] Сетевая ошибка при проверке пользователя %s: %s. Повтор через %.1f сек. (попытка %s/%s)", user_id, e, delay, attempt + 1, max_retries)
+            await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _check_user(bot: Bot, user_id: int, limiter: RateLimiter) -> Tuple[int, bool]:
+    """
+    Проверяет одного пользователя через get_chat.
+    Возвращает (user_id, True), если аккаунт удален/деактивирован или бот заблокирован.
+    """
+    is_deleted_or_inactive = False
+    try:
+        await _get_chat_with_retry(bot, user_id, limiter)
+        _recently_alive[user_id] = True
+    except TelegramNotFound:
+        is_deleted_or_inactive = True
+        logger.info("[UserCleanup] Пользователь %s не найден (TelegramNotFound). Добавлен в список на удаление.", user_id)
+    except TelegramForbiddenError as e:
+        # Forbidden всегда означает удаление; текст ошибки нужен только чтобы указать причину в логе
+        is_deleted_or_inactive = True
+        match = _DELETED_RE.search(str(e).lower())
+        if match:
+            logger.log(_DELETED_MARKERS[match.group(0)], "[UserCleanup] Пользователь %s: %s (Forbidden). Добавлен в список на удаление.", user_id, match.group(0))
+        else:
+            logger.warning("[UserCleanup] Ошибка Forbidden для пользователя %s: %s. Добавлен в список на удаление.", user_id, e)
+    except TelegramBadRequest as e:
+        # Удаленный/деактивированный аккаунт или невалидный ID могут приходить и как BadRequest с определенным текстом
+        match = _DELETED_RE.search(str(e).lower())
+        if match:
+            is_deleted_or_inactive = True
+            logger.log(_DELETED_MARKERS[match.group(0)], "[UserCleanup] Пользователь %s: %s (BadRequest: %s). Добавлен в список на удаление.", user_id, match.group(0), e)
+        else:
+            # Логируем неожиданные BadRequest, но не добавляем на удаление автоматически, если не уверены
+            logger.warning("[UserCleanup] Неожиданная ошибка BadRequest для пользователя %s: %s", user_id, e)
+    except Exception as e:
+        logger.error("[UserCleanup] Непредвиденная ошибка при проверке пользователя %s: %s", user_id, e, exc_info=True)
+    return user_id, is_deleted_or_inactive
+
 
 async def scheduled_user_cleanup_task(bot: Bot, db_manager: DatabaseManager):
     """
@@ -27,85 +126,111 @@ async def scheduled_user_cleanup_task(bot: Bot, db_manager: DatabaseManager):
     """
     logger.info("[UserCleanup] Запуск задачи очистки удаленных пользователей (aiogram v3.20.0 compatible).")
     
-    candidate_users_data = [] # Инициализируем здесь на случай ошибки в try
+    # Давно не появлявшиеся пользователи - самые вероятные кандидаты, поэтому проверяем их первыми.
+    # Удалять их без get_chat нельзя: last_seen_timestamp обновляется только при входе в чат и /start,
+    # а не на каждом сообщении, так что активный участник тоже может выглядеть "неактивным"
+    inactive_user_ids: List[int] = []
     try:
-        candidate_users_data = await db_manager.get_users_for_cleanup_check(USER_CHECK_BATCH_SIZE)
+        inactive_user_ids = await db_manager.get_likely_dead_users(INACTIVE_DAYS, INACTIVE_PROBE_LIMIT)
+        if inactive_user_ids:
+            logger.info(f"[UserCleanup] {len(inactive_user_ids)} пользователей не появлялись более {INACTIVE_DAYS} дней - проверяются первыми.")
     except Exception as e:
-        logger.error(f"[UserCleanup] Не удалось получить кандидатов на удаление из БД: {e}", exc_info=True)
-        return
-
-    if not candidate_users_data:
-        logger.info("[UserCleanup] Не найдено пользователей для проверки в БД (выборка пуста).")
-        return
-
-    candidate_user_ids = [user['user_id'] for user in candidate_users_data]
-    logger.info(f"[UserCleanup] Получено {len(candidate_user_ids)} пользователей из БД для проверки.")
+        logger.error(f"[UserCleanup] Ошибка при выборе давно неактивных пользователей: {e}", exc_info=True)
 
     deleted_user_ids: List[int] = []
+    alive_user_ids: List[int] = []
     checked_users_count = 0
+    stopped_early = False
+    # Общий token bucket на всех воркеров: лимит Telegram действует на токен бота целиком,
+    # а не на отдельного пользователя, поэтому делить его между воркерами нет смысла
+    limiter = RateLimiter(rate=CHECK_RATE_PER_SEC)
+    queue: asyncio.Queue = asyncio.Queue()
+    fetched_count = 0
+    skipped_alive = 0
+
+    async def _producer() -> None:
+        # Кандидаты идут из курсора БД прямо в очередь: воркеры начинают проверку с первой строки,
+        # не дожидаясь всей выборки. Соединение с БД закрывается, как только выборка прочитана
+        queued = set()
+
+        def _enqueue(user_id: int) -> None:
+            nonlocal fetched_count, skipped_alive
+            if user_id in queued:
+                return
+            queued.add(user_id)
+            fetched_count += 1
+            if user_id in _recently_alive:
+                skipped_alive += 1
+                return
+            queue.put_nowait(user_id)
 
-    for user_id in candidate_user_ids:
-        checked_users_count += 1
-        is_deleted_or_inactive = False
-        error_detail = ""
         try:
-            await bot.get_chat(user_id=user_id)
-        except TelegramNotFound as e:
-            is_deleted_or_inactive = True
-            error_detail = f"TelegramNotFound: {e}"
-            logger.info(f"[UserCleanup] Пользователь {user_id} не найден (TelegramNotFound). Добавлен в список на удаление.")
-        except TelegramForbiddenError as e:
-            is_deleted_or_inactive = True
-            error_detail = f"TelegramForbiddenError: {e}"
-            # Анализируем сообщение об ошибке, если нужно различать причины
-            if "bot was blocked by the user" in str(e).lower():
-                logger.info(f"[UserCleanup] Бот заблокирован пользователем {user_id}. Добавлен в список на удаление.")
-            elif "user is deactivated" in str(e).lower():
-                 logger.info(f"[UserCleanup] Пользователь {user_id} деактивирован. Добавлен в список на удаление.")
-            else:
-                logger.warning(f"[UserCleanup] Ошибка Forbidden для пользователя {user_id}: {e}. Добавлен в список на удаление.")
-        except TelegramBadRequest as e:
-            error_message = str(e).lower()
-            if "user not found" in error_message or \
-               "chat not found" in error_message or \
-               "user_id_invalid" in error_message or \
-               "peer_id_invalid" in error_message:
-                is_deleted_or_inactive = True
-                error_detail = f"TelegramBadRequest (user/chat not found or invalid): {e}"
-                logger.info(f"[UserCleanup] Пользователь {user_id} не найден или ID невалиден (BadRequest: {e}). Добавлен в список на удаление.")
-            # Некоторые случаи деактивации или блокировки могут также приходить как BadRequest с определенным текстом
-            elif "user is deactivated" in error_message:
-                is_deleted_or_inactive = True
-                error_detail = f"TelegramBadRequest (user deactivated): {e}"
-                logger.info(f"[UserCleanup] Пользователь {user_id} деактивирован (BadRequest: {e}). Добавлен в список на удаление.")
-            else:
-                # Логируем неожиданные BadRequest, но не добавляем на удаление автоматически, если не уверены
-                logger.warning(f"[UserCleanup] Неожиданная ошибка BadRequest для пользователя {user_id}: {e}")
+            for user_id in inactive_user_ids:
+                _enqueue(user_id)
+            async for user_id in db_manager.iter_users_for_cleanup_check(USER_CHECK_BATCH_SIZE):
+                _enqueue(user_id)
         except Exception as e:
-            logger.error(f"[UserCleanup] Непредвиденная ошибка при проверке пользователя {user_id}: {e}", exc_info=True)
-        
-        if is_deleted_or_inactive:
-            deleted_user_ids.append(user_id)
-            # logger.debug(f"[UserCleanup] User {user_id} marked for deletion due to: {error_detail}") # Для детальной отладки
+            logger.error(f"[UserCleanup] Не удалось получить кандидатов на удаление из БД: {e}", exc_info=True)
+        finally:
+            # По одному маркеру конца на воркера
+            for _ in range(CHECK_CONCURRENCY):
+                queue.put_nowait(None)
 
-        if len(deleted_user_ids) >= MAX_DELETIONS_PER_RUN:
-            logger.info(f"[UserCleanup] Достигнут лимит MAX_DELETIONS_PER_RUN ({MAX_DELETIONS_PER_RUN}) найденных удаленных пользователей. Прерывание проверки.")
-            break
+    async def _worker() -> None:
+        # Каждый воркер берет следующего пользователя сразу, как освободится, - без ожидания самой
+        # медленной проверки в пачке. Списки и счетчик общие: цикл событий однопоточный, блокировки не нужны
+        nonlocal checked_users_count, stopped_early
+        while not stopped_early and len(deleted_user_ids) < MAX_DELETIONS_PER_RUN:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            try:
+                _, is_deleted_or_inactive = await _check_user(bot, user_id, limiter)
+            except Exception as e:
+                logger.error("[UserCleanup] Непредвиденная ошибка в задаче проверки пользователя %s: %s", user_id, e)
+                continue
+            checked_users_count += 1
+            if is_deleted_or_inactive:
+                deleted_user_ids.append(user_id)
+                # Аномально много удаленных подряд: половина лимита уже набрана, остаток доберет следующий запуск.
+                # Заодно не тратим запросы, если API массово отвечает ошибками
+                if (not stopped_early and checked_users_count >= EARLY_STOP_MIN_CHECKED
+                        and len(deleted_user_ids) >= MAX_DELETIONS_PER_RUN // 2
+                        and len(deleted_user_ids) / checked_users_count > EARLY_STOP_DELETED_RATIO):
+                    stopped_early = True
+                    logger.info(f"[UserCleanup] Доля удаленных {len(deleted_user_ids)}/{checked_users_count} выше {EARLY_STOP_DELETED_RATIO:.0%}. Досрочное завершение проверки, остальные - в следующий запуск.")
+            elif user_id in _recently_alive:
+                # Только успешный get_chat; пользователи с неясной ошибкой останутся в начале очереди
+                alive_user_ids.append(user_id)
 
-        await asyncio.sleep(API_CALL_DELAY)
+    producer = asyncio.create_task(_producer())
+    await asyncio.gather(*(_worker() for _ in range(CHECK_CONCURRENCY)))
+    # Воркеры могли остановиться по лимиту раньше, чем закончилась выборка
+    producer.cancel()
+    await asyncio.gather(producer, return_exceptions=True)
+
+    if not fetched_count:
+        logger.info("[UserCleanup] Не найдено пользователей для проверки в БД (выборка пуста).")
+        return
+    logger.info(f"[UserCleanup] Получено {fetched_count} пользователей из БД, из них {skipped_alive} недавно проверены и пропущены.")
+    if len(deleted_user_ids) >= MAX_DELETIONS_PER_RUN:
+        logger.info(f"[UserCleanup] Достигнут лимит MAX_DELETIONS_PER_RUN ({MAX_DELETIONS_PER_RUN}) найденных удаленных пользователей. Проверка прервана.")
 
     logger.info(f"[UserCleanup] Проверено {checked_users_count} пользователей. Найдено {len(deleted_user_ids)} кандидатов на удаление.")
 
-    if deleted_user_ids:
-        ids_to_delete = deleted_user_ids[:MAX_DELETIONS_PER_RUN]
+    # Проверенных живых отмечаем (следующие запуски начнут с других), удаленных удаляем - одной транзакцией
+    ids_to_delete = deleted_user_ids[:MAX_DELETIONS_PER_RUN]
+    if ids_to_delete:
         logger.info(f"[UserCleanup] Попытка удалить {len(ids_to_delete)} пользователей.")
-        try:
-            deleted_count = await db_manager.delete_users_by_ids(ids_to_delete)
-            logger.info(f"[UserCleanup] Успешно удалено {deleted_count} пользователей из БД.")
-        except Exception as e:
-            logger.error(f"[UserCleanup] Ошибка при удалении пользователей из БД: {e}", exc_info=True)
     else:
         logger.info("[UserCleanup] Не найдено пользователей для удаления в этой сессии.")
+    if ids_to_delete or alive_user_ids:
+        try:
+            deleted_count = await db_manager.apply_cleanup_results(alive_user_ids, ids_to_delete)
+            if ids_to_delete:
+                logger.info(f"[UserCleanup] Успешно удалено {deleted_count} пользователей из БД.")
+        except Exception as e:
+            logger.error(f"[UserCleanup] Ошибка при сохранении результатов очистки в БД: {e}", exc_info=True)
 
     logger.info("[UserCleanup] Задача очистки удаленных пользователей завершена.")
 
@@ -4,13 +4,12 @@ from aiogram.fsm.state import State, StatesGroup
 #     waiting_for_channel_id = State()
 
 class ManageChannels(StatesGroup):
-    managing_list = State()  # Основное состояние управления списком
+    managing_list = State()  # Основное состояние управления списком (отображены кнопки Добавить/Удалить/Готово)
     waiting_for_channel_select = State() # Ожидание выбора канала через кнопку request_chat после команды
 
     # Сценарий 2: Через добавление бота админом
     waiting_for_channel_select_admin = State() # Ожидание выбора канала через кнопку request_chat после добавления админом
 
-    managing_list = State()              # Состояние управления списком (отображены кнопки Добавить/Удалить/Готово)
     waiting_for_channel_remove = State() # Ожидание выбора канала для удаления (отображена клавиатура с каналами)
     adding_channel = State()             # Состояние добавления нового канала
     
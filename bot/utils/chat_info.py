@@ -1,14 +1,53 @@
 from aiogram import Bot
-from typing import List
+from cachetools import TTLCache
+from typing import Dict, Iterable, List
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Списки ID администраторов по чатам. Админы меняются редко, поэтому держим список до 5 минут;
+# при повышении/понижении админа запись сбрасывается через invalidate_admins
+_admins_cache = TTLCache(maxsize=5000, ttl=300, timer=time.monotonic)
+
+def invalidate_admins(chat_id: int) -> None:
+    """Сбрасывает закэшированный список администраторов чата."""
+    _admins_cache.pop(chat_id, None)
+
 async def get_chat_administrators_ids(bot: Bot, chat_id: int) -> List[int]:
-    """Возвращает список ID администраторов чата."""
+    """Возвращает список ID администраторов чата (с кэшем на 5 минут)."""
+    try:
+        return _admins_cache[chat_id]
+    except KeyError:
+        pass
     try:
         admins = await bot.get_chat_administrators(chat_id)
-        return [admin.user.id for admin in admins]
+        admin_ids = [admin.user.id for admin in admins]
+        _admins_cache[chat_id] = admin_ids # Кэшируем только успешный ответ
+        return admin_ids
     except Exception as e:
         logger.error(f"Ошибка при получении администраторов чата {chat_id}: {e}")
-        return [] 
\ No newline at end of file
+        return []
+
+async def get_chat_administrators_ids_bulk(bot: Bot, chat_ids: Iterable[int], concurrency: int = 15) -> Dict[int, List[int]]:
+    """
+    Возвращает {chat_id: [ID администраторов]} для нескольких чатов.
+    Запросы идут параллельно, но не более concurrency одновременно. При ошибке для чата - пустой список,
+    как и у get_chat_administrators_ids.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids)) # Без повторов, порядок сохраняем
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _one(chat_id: int) -> List[int]:
+        async with sem:
+            return await get_chat_administrators_ids(bot, chat_id)
+
+    results = await asyncio.gather(*(_one(cid) for cid in chat_ids), return_exceptions=True)
+    admins_by_chat: Dict[int, List[int]] = {}
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Ошибка при получении администраторов чата {chat_id}: {result}")
+            result = []
+        admins_by_chat[chat_id] = result
+    return admins_by_chat
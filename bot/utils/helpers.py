@@ -1,19 +1,35 @@
 from aiogram import Bot
 from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import User, Chat, ChatMember
 from html import escape
+from cachetools import TTLCache
+import asyncio
+import functools
 import time
 import logging # Добавим для логов кэша
-from typing import Optional, Union, Tuple, Any, Dict # Для аннотаций
+from typing import Optional, Union, Tuple, Dict # Для аннотаций
 
 logger = logging.getLogger(__name__) # Логгер для этого модуля
 
-# Кэш для общей информации о пользователях в чатах и информации о чатах
-# Ключ: (type: str, id1: int, id2: Optional[int]) -> (data: Any, timestamp: float)
-# type: 'user_in_chat' -> id1=chat_id, id2=user_id, data=ChatMember
+# Кэши для общей информации о пользователях в чатах и информации о чатах.
+# TTLCache ограничен по размеру и сам вытесняет устаревшие записи, поэтому память не растет
+# с каждым когда-либо встреченным (chat_id, user_id).
+# Ключ: (type: str, id1: int, id2: Optional[int]) -> (data: Any, timestamp: float по time.monotonic)
+# type: 'user_in_chat' -> id1=user_id, id2=chat_id, data=ChatMember
 # type: 'chat_info'    -> id1=chat_id, id2=None,    data=Chat
-_general_info_cache: Dict[Tuple[str, int, Optional[int]], Tuple[Any, float]] = {}
+# TTL кэша - верхняя граница: вызывающий может запросить более свежие данные через параметр ttl.
+# Кэш живет только в памяти процесса: бот работает одним процессом на SQLite, внешнего хранилища (Redis) нет.
+# После рестарта кэш прогревается сам за первые минуты, а одновременные промахи по одному ключу
+# схлопываются в один запрос (см. _inflight_general_info), так что всплеска дублирующихся запросов нет.
 DEFAULT_GENERAL_INFO_TTL = 60  # 1 минута по умолчанию
+_user_in_chat_cache = TTLCache(maxsize=50_000, ttl=300, timer=time.monotonic) # Статус админа меняется редко - до 5 минут
+_chat_info_cache = TTLCache(maxsize=10_000, ttl=DEFAULT_GENERAL_INFO_TTL, timer=time.monotonic)
+_GENERAL_INFO_CACHES = {'user_in_chat': _user_in_chat_cache, 'chat_info': _chat_info_cache}
+
+# Запросы к API, выполняющиеся прямо сейчас: {cache_key: Task}. Одновременные промахи кэша
+# по одному ключу (например, несколько is_admin для того же пользователя) ждут один и тот же запрос
+_inflight_general_info: Dict[Tuple[str, int, Optional[int]], asyncio.Task] = {}
 
 async def get_cached_general_info(
     bot: Bot, 
@@ -28,20 +44,39 @@ async def get_cached_general_info(
     entity_id: user_id (если 'user_in_chat') или chat_id (если 'chat_info')
     context_id: chat_id (только для 'user_in_chat')
     """
+    cache = _GENERAL_INFO_CACHES.get(entity_type)
+    if cache is None:
+        logger.warning(f"Unknown entity_type {entity_type!r} for get_cached_general_info")
+        return None
     cache_key = (entity_type, entity_id, context_id)
-    current_time = time.time()
 
-    if cache_key in _general_info_cache:
-        data, timestamp = _general_info_cache[cache_key]
-        if current_time - timestamp < ttl:
-            logger.debug(f"[CACHE_HIT] General info cache for {cache_key}")
+    # Одно обращение к кэшу вместо `in` + []; устаревшие по TTL кэша записи TTLCache уже вытеснил
+    try:
+        data, timestamp = cache[cache_key]
+    except KeyError:
+        pass
+    else:
+        if time.monotonic() - timestamp < ttl:
+            logger.debug("[CACHE_HIT] General info cache for %s", cache_key)
             return data
-        else:
-            logger.debug(f"[CACHE_STALE] General info cache for {cache_key} is stale.")
-            # Удаляем устаревшую запись
-            del _general_info_cache[cache_key]
+        logger.debug("[CACHE_STALE] General info cache for %s is stale.", cache_key)
+
+    logger.debug("[CACHE_MISS] General info cache for %s. Fetching from API.", cache_key)
+    task = _inflight_general_info.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_general_info(bot, cache, cache_key))
+        _inflight_general_info[cache_key] = task
+        task.add_done_callback(lambda done, key=cache_key: _inflight_general_info.pop(key, None) if _inflight_general_info.get(key) is done else None)
+    # shield: отмена одного из ожидающих не должна отменять запрос для остальных
+    return await asyncio.shield(task)
 
-    logger.debug(f"[CACHE_MISS] General info cache for {cache_key}. Fetching from API.")
+async def _fetch_general_info(
+    bot: Bot,
+    cache: TTLCache,
+    cache_key: Tuple[str, int, Optional[int]]
+) -> Optional[Union[ChatMember, Chat]]:
+    """Запрашивает данные для cache_key у API и кладет их в кэш. Ошибки логирует и возвращает None."""
+    entity_type, entity_id, context_id = cache_key
     try:
         new_data: Optional[Union[ChatMember, Chat]] = None
         if entity_type == 'user_in_chat' and context_id is not None:
@@ -53,7 +88,7 @@ async def get_cached_general_info(
             return None
 
         if new_data:
-            _general_info_cache[cache_key] = (new_data, current_time)
+            cache[cache_key] = (new_data, time.monotonic())
             return new_data
         return None
     except Exception as e:
@@ -75,6 +110,99 @@ async def is_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
 
 def get_user_mention_html(user: User) -> str:
     """Возвращает HTML-упоминание пользователя."""
-    # user.full_name может содержать символы, которые нужно экранировать
-    full_name = escape(user.full_name)
-    return f"<a href='tg://user?id={user.id}'>{full_name}</a>" 
\ No newline at end of file
+    return _build_user_mention_html(user.id, user.full_name)
+
+@functools.lru_cache(maxsize=4096)
+def _build_user_mention_html(user_id: int, full_name: str) -> str:
+    """Собирает HTML-упоминание. Результат кэшируется: активные пользователи упоминаются постоянно."""
+    # full_name может содержать символы, которые нужно экранировать
+    return f"<a href='tg://user?id={user_id}'>{escape(full_name)}</a>"
+
+def with_telegram_retry(max_attempts: int = 2):
+    """
+    Декоратор для корутин, вызывающих Telegram API.
+    При TelegramRetryAfter ждет e.retry_after секунд и повторяет вызов (всего не более max_attempts попыток).
+    Остальные ошибки пробрасываются сразу, без повторов.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempt = 1
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    if attempt >= max_attempts:
+                        raise
+                    logger.warning(f"[RETRY_AFTER] {getattr(func, '__name__', func)}: флуд-контроль, ожидание {e.retry_after} сек. (попытка {attempt}/{max_attempts})")
+                    await asyncio.sleep(e.retry_after)
+                    attempt += 1
+        return wrapper
+    return decorator
+
+
+class RateLimiter:
+    """
+    Простой token bucket для ограничения частоты запросов к Telegram API.
+    Токены пополняются со скоростью rate в секунду, накапливаясь не более capacity штук,
+    поэтому короткие всплески проходят без задержки, а средняя частота не превышает rate.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Ждет, пока в корзине не появится свободный токен, и забирает его."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    Token bucket, подстраивающий частоту под ответы Telegram (AIMD).
+    Каждый успешный запрос поднимает rate на increase (не выше max_rate), флуд-контроль (RetryAfter)
+    умножает rate на decrease (не ниже min_rate) и приостанавливает выдачу токенов на retry_after секунд.
+    Так частота сама держится чуть ниже порога, после которого Telegram начинает отвечать RetryAfter.
+    """
+    def __init__(
+        self,
+        rate: float,
+        max_rate: float,
+        min_rate: float = 1.0,
+        increase: float = 0.2,
+        decrease: float = 0.5,
+        capacity: Optional[float] = None
+    ):
+        super().__init__(rate, capacity)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def _refill(self) -> None:
+        # Начисляем токены по старой частоте, прежде чем ее менять
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def on_success(self) -> None:
+        """Запрос прошел - осторожно ускоряемся."""
+        self._refill()
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_retry_after(self, retry_after: float) -> None:
+        """Telegram ответил RetryAfter - резко замедляемся и ждем retry_after секунд."""
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        # Долг в токенах: следующий токен появится не раньше, чем через retry_after секунд
+        self._tokens = min(self._tokens, 0.0) - retry_after * self.rate
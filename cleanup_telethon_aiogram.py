@@ -6,7 +6,8 @@ import time # Для задержек
 
 from telethon import TelegramClient
 from telethon.tl.functions.channels import EditBannedRequest
-from telethon.tl.types import ChatBannedRights, ChannelParticipantsAdmins
+from telethon.tl.types import ChatBannedRights
+from telethon.utils import get_peer_id
 from telethon.errors.rpcerrorlist import ( # Импортируем ошибки Telethon
     UserNotParticipantError, ChatAdminRequiredError, UserAdminInvalidError,
     UserKickedError, ChannelPrivateError, ChatWriteForbiddenError,
@@ -48,6 +49,7 @@ try:
 
     # Импортируем DatabaseManager
     from bot.db.database import DatabaseManager
+    from bot.utils.helpers import AdaptiveRateLimiter
 
 except ImportError as e:
     # Добавим обработку ошибки импорта DatabaseManager
@@ -63,6 +65,15 @@ except Exception as e:
     sys.exit(1)
 
 
+# Корень проекта найден выше при импорте; путь к БД вычисляем один раз здесь же, а не заново в main()
+PROJECT_ROOT = project_root
+DB_NAME = getattr(settings, 'db_name', 'bot_data.db')
+DB_PATH = os.path.join(PROJECT_ROOT, DB_NAME)
+# Проверка, если БД лежит в bot/db
+_DB_PATH_IN_BOT_DIR = os.path.join(PROJECT_ROOT, 'bot', 'db', DB_NAME)
+if os.path.exists(_DB_PATH_IN_BOT_DIR):
+    DB_PATH = _DB_PATH_IN_BOT_DIR
+
 # --- НАСТРОЙКИ СКРИПТА --- (берутся из .env через settings)
 # API_ID и API_HASH для Telethon должны быть в .env: TELETHON_API_ID, TELETHON_API_HASH
 # BOT_TOKEN для AIOgram должен быть в .env: BOT_TOKEN
@@ -82,8 +93,15 @@ except (ValueError, TypeError):
 # Имя файла сессии для Telethon
 SESSION_NAME = 'cleanup_session' # Можно изменить, если нужно несколько сессий
 
-# Задержка между обработкой каждого пользователя (в секундах)
-DELAY_PER_USER = 0.5 # Рекомендуется 0.3 - 1.0 секунды
+# Параллельная обработка участников: число воркеров, выполняющих действия через AIOgram,
+# начальная и максимальная частота запросов в секунду (ниже потолка Bot API ~30 запросов/сек) и размер очереди участников.
+# Между ними частота подстраивается сама: растет на успешных запросах и падает при флуд-контроле
+ACTION_WORKERS = 8
+ACTIONS_START_RATE = 5
+ACTIONS_PER_SECOND = 25
+# Telethon запрашивает участников страницами по 200; очередь на 2.5 страницы позволяет ему загружать
+# следующую страницу, пока воркеры обрабатывают предыдущую, а не ждать, пока очередь освободится
+PARTICIPANT_QUEUE_SIZE = 500
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -101,11 +119,34 @@ UNMUTE_PERMISSIONS = ChatPermissions(
     can_pin_messages=False
 )
 
+# --- Классификация ошибок AIOgram при кике/анмуте ---
+# Фрагменты текста ошибок Telegram по видам; текст ошибки приводится к нижнему регистру один раз
+_ADMIN_MARKERS = ("user is an administrator", "can't remove chat owner")
+_NOT_IN_CHAT_MARKERS = ("user not found", "user_not_participant")
+_UNRESTRICTED_MARKERS = ("member is not restricted", "rights are same")
+
+def classify_aiogram_error(e: Exception) -> str:
+    """Вид ошибки TelegramBadRequest/TelegramForbiddenError: 'admin', 'gone', 'unrestricted' или 'other'."""
+    msg = str(e).casefold()
+    if any(m in msg for m in _ADMIN_MARKERS):
+        return "admin"
+    if any(m in msg for m in _NOT_IN_CHAT_MARKERS):
+        return "gone"
+    if any(m in msg for m in _UNRESTRICTED_MARKERS):
+        return "unrestricted"
+    return "other"
+
 # --- Функции для сохранения/загрузки состояния ---
 STATE_FILE = 'cleanup_last_processed_id.txt'
+# Промежуточное сохранение прогресса: раз в SAVE_EVERY_USERS обработанных пользователей
+# или раз в SAVE_EVERY_SECONDS секунд (что наступит раньше), а не после каждого пользователя
+SAVE_EVERY_USERS = 50
+SAVE_EVERY_SECONDS = 10
 
-def read_last_id(filename: str) -> int | None:
-    """Читает последний обработанный ID из файла."""
+# Файловые операции выполняются в отдельном потоке (asyncio.to_thread), чтобы медленный диск
+# не останавливал цикл событий, пока идут запросы к Telethon/AIOgram
+
+def _read_last_id_sync(filename: str) -> int | None:
     try:
         if os.path.exists(filename):
             with open(filename, 'r') as f:
@@ -116,8 +157,7 @@ def read_last_id(filename: str) -> int | None:
         logger.error(f"Ошибка чтения файла состояния '{filename}': {e}")
     return None
 
-def save_last_id(filename: str, user_id: int):
-    """Сохраняет последний обработанный ID в файл."""
+def _save_last_id_sync(filename: str, user_id: int):
     try:
         with open(filename, 'w') as f:
             f.write(str(user_id))
@@ -125,6 +165,14 @@ def save_last_id(filename: str, user_id: int):
     except IOError as e:
         logger.error(f"Ошибка сохранения файла состояния '{filename}': {e}")
 
+async def read_last_id(filename: str) -> int | None:
+    """Читает последний обработанный ID из файла."""
+    return await asyncio.to_thread(_read_last_id_sync, filename)
+
+async def save_last_id(filename: str, user_id: int):
+    """Сохраняет последний обработанный ID в файл."""
+    await asyncio.to_thread(_save_last_id_sync, filename, user_id)
+
 async def main():
     logger.info("Запуск гибридного скрипта очистки чата (Telethon + Aiogram + DB)...")
 
@@ -139,7 +187,7 @@ async def main():
 
     try:
         # Читаем последний обработанный ID при старте
-        last_processed_id = read_last_id(STATE_FILE)
+        last_processed_id = await read_last_id(STATE_FILE)
         if last_processed_id:
             logger.info(f"Обнаружен предыдущий запуск. Попытка возобновить после ID: {last_processed_id}")
         else:
@@ -147,26 +195,8 @@ async def main():
 
         # Инициализация DatabaseManager
         try:
-            db_name = getattr(settings, 'db_name', 'bot_data.db')
-            # Определяем путь к БД относительно корня проекта (логика из load_config)
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            current_dir = script_dir
-            project_root = None
-            while current_dir != os.path.dirname(current_dir):
-                if os.path.exists(os.path.join(current_dir, 'bot', '__init__.py')) or \
-                   os.path.exists(os.path.join(current_dir, 'bot', '__main__.py')):
-                    project_root = current_dir
-                    break
-                current_dir = os.path.dirname(current_dir)
-            if not project_root:
-                raise RuntimeError("Не удалось определить корневую директорию проекта (папка 'bot' не найдена).")
-            
-            db_path = os.path.join(project_root, db_name)
-            # Проверка, если БД лежит в bot/db
-            expected_db_path_in_bot_dir = os.path.join(project_root, 'bot', 'db', db_name)
-            if os.path.exists(expected_db_path_in_bot_dir):
-                 db_path = expected_db_path_in_bot_dir
-            
+            # Путь к БД определен при загрузке модуля (DB_PATH)
+            db_path = DB_PATH
             if not os.path.exists(db_path):
                  raise FileNotFoundError(f"Файл базы данных не найден по пути: {db_path}")
             
@@ -275,19 +305,34 @@ async def main():
             logger.critical(f"Произошла непредвиденная ошибка при получении информации о сущности '{TARGET_CHAT_IDENTIFIER}': {e}", exc_info=True)
             raise # Передаем исключение выше
 
-        # Получение ID администраторов с помощью Telethon
+        # Данные чата, которые нужны на каждом участнике, - в локальные переменные один раз.
+        # Для Bot API нужен ID чата в формате -100..., а не "сырой" ID сущности Telethon
+        chat_id = get_peer_id(chat)
+        chat_title = getattr(chat, 'title', chat_id)
+
+        # Получение ID администраторов через Bot API (AIOgram): Telethon нужен только для перебора участников
         admins_ids = set() # Используем set для быстрого поиска
         try:
-            logger.info(f"Получение списка администраторов в чате '{getattr(chat, 'title', chat.id)}'...")
-            async for admin_user in client.iter_participants(chat, filter=ChannelParticipantsAdmins):
-                admins_ids.add(admin_user.id)
+            logger.info(f"Получение списка администраторов в чате '{chat_title}'...")
+            admins = await bot.get_chat_administrators(chat_id=chat_id)
+            admins_ids = {admin.user.id for admin in admins}
             logger.info(f"Найдено {len(admins_ids)} администраторов. Они будут пропущены.")
-        except ChatAdminRequiredError:
-            logger.warning("Предупреждение: Недостаточно прав у аккаунта Telethon для получения списка администраторов. Пропускаем их определение.")
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logger.warning(f"Предупреждение: Бот не может получить список администраторов ({e}). Пропускаем их определение.")
         except Exception as e:
             logger.error(f"Ошибка при получении списка администраторов: {e}", exc_info=True)
 
-        logger.info(f"\nНачинаем перебор участников в чате '{getattr(chat, 'title', chat.id)}'...")
+        # Всех, кого не трогаем, собираем в одно множество заранее
+        try:
+            me = await client.get_me()
+            self_id = me.id
+        except Exception as e:
+            logger.error(f"Не удалось получить ID аккаунта Telethon: {e}", exc_info=True)
+            self_id = None
+        skip_ids = admins_ids | {bot_id, self_id}
+        skip_ids.discard(None)
+
+        logger.info(f"\nНачинаем перебор участников в чате '{chat_title}'...")
 
         processed_count = 0
         unmuted_count = 0
@@ -296,12 +341,164 @@ async def main():
         error_count = 0
         processed_after_resume = 0 # Счетчик реально обработанных после точки возобновления
         found_start_point = (last_processed_id is None) # Начинаем сразу, если ID не было
-
-        try: # Вложенный try-except для цикла перебора участников
-            # Убираем reverse=True и aggressive=True, используем стандартную итерацию
+        last_save_time = time.monotonic()
+
+        # Telethon читает участников и кладет их в очередь, ACTION_WORKERS воркеров параллельно выполняют
+        # действия через AIOgram. Частоту запросов ограничивает общий адаптивный token bucket, а не sleep после каждого
+        participant_queue: asyncio.Queue = asyncio.Queue(maxsize=PARTICIPANT_QUEUE_SIZE)
+        action_limiter = AdaptiveRateLimiter(rate=ACTIONS_START_RATE, max_rate=ACTIONS_PER_SECOND)
+        # Участники обрабатываются не по порядку, поэтому точкой возобновления сохраняем ID, до которого
+        # включительно обработаны все взятые в работу: {порядковый номер: ID} в порядке очереди
+        in_progress: dict[int, int] = {}
+        finished: set[int] = set()
+        # Активные муты чата из БД - одним запросом до начала перебора; ID, чьи записи нужно сбросить,
+        # копятся в ban_clears и записываются пачкой вместе с сохранением прогресса и в конце
+        ban_map: dict[int, int] = await db_manager.get_active_bans_in_chat(chat_id) if db_manager else {}
+        ban_clears: list[int] = []
+
+        def mark_finished(seq: int):
+            nonlocal current_last_id_to_save
+            finished.add(seq)
+            while in_progress:
+                first_seq = next(iter(in_progress))
+                if first_seq not in finished:
+                    break
+                finished.discard(first_seq)
+                current_last_id_to_save = in_progress.pop(first_seq)
+
+        async def handle_participant(participant, current_user_log_prefix: str):
+            nonlocal unmuted_count, kicked_deleted_count, skipped_count, error_count
+            # participant уже является объектом User (или Channel)
+            user = participant
+            user_id = user.id
+            action_taken_this_user = False
+
+            logger.info(f"\n--- {current_user_log_prefix} Обработка. Имя: {user.first_name or ''} {user.last_name or ''} (@{user.username or 'N/A'}) ---")
+
+            # 1. Удаление "собачек"
+            if user.deleted:
+                logger.info(f"  {current_user_log_prefix} [УДАЛЕНИЕ] Является удаленным аккаунтом. Попытка кика через AIOgram...")
+                try:
+                    await action_limiter.acquire()
+                    await bot.ban_chat_member(chat_id=chat_id, user_id=user_id, revoke_messages=False)
+                    action_limiter.on_success()
+                    logger.info(f"    [УДАЛЕНИЕ-УСПЕХ] {current_user_log_prefix} Удаленный аккаунт кикнут.")
+                    kicked_deleted_count += 1
+                    action_taken_this_user = True
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    error_kind = classify_aiogram_error(e)
+                    if error_kind == "admin":
+                         logger.warning(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Недостаточно прав для кика (вероятно, админ). ({e})")
+                    elif error_kind == "gone":
+                         logger.warning(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Пользователь уже не в чате. ({e})")
+                    else:
+                         logger.error(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Не удалось кикнуть: {e}")
+                         error_count += 1
+                except TelegramRetryAfter as e:
+                     logger.warning(f"    [УДАЛЕНИЕ-FLOOD AIOgram] {current_user_log_prefix} Слишком много запросов. Ожидание {e.retry_after} секунд...")
+                     action_limiter.on_retry_after(e.retry_after) # Притормаживаем всех воркеров, а не только этот
+                     await asyncio.sleep(e.retry_after)
+                     # Можно добавить повторную попытку, но для удаления может быть излишне
+                     error_count += 1 # Считаем как ошибку, т.к. пропустили
+                except Exception as e:
+                     logger.error(f"    [УДАЛЕНИЕ-НЕИЗВЕСТНАЯ-ОШИБКА] {current_user_log_prefix} Не удалось кикнуть: {type(e).__name__} - {e}", exc_info=True)
+                     error_count += 1
+                return # Переход к следующему после попытки кика
+
+            # 2. Анмут (если не "собачка" и не админ)
+            is_muted = False
+            # participant.banned_rights присутствует, если есть *любые* ограничения (один getattr вместо hasattr + обращений)
+            banned_rights = getattr(participant, 'banned_rights', None)
+            if banned_rights:
+                # Главный критерий мута - send_messages == False
+                if not banned_rights.send_messages:
+                    is_muted = True
+                    logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] ЗАМУЧЕН (не может отправлять сообщения).")
+                else:
+                     # Могут быть другие ограничения (отправка медиа, стикеров и т.д.)
+                     # Можно добавить логику для снятия и этих ограничений, если нужно,
+                     # но UNMUTE_PERMISSIONS уже разрешает все.
+                     # Важно, что он *может* отправлять текстовые сообщения.
+                     logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] Есть ограничения, но может отправлять сообщения. Анмут не требуется.")
+                     logger.debug(f"  {current_user_log_prefix} Детали ограничений: {banned_rights}")
+                     skipped_count += 1 # Считаем как пропуск, т.к. основной анмут не нужен
+
+            if is_muted:
+                logger.info(f"  {current_user_log_prefix} [АНМУТ] Попытка размутить через AIOgram...")
+                try:
+                    await action_limiter.acquire()
+                    await bot.restrict_chat_member(
+                        chat_id=chat_id,
+                        user_id=user_id,
+                        permissions=UNMUTE_PERMISSIONS,
+                        until_date=0 # Снять временные ограничения
+                    )
+                    action_limiter.on_success()
+                    logger.info(f"    [АНМУТ-УСПЕХ] {current_user_log_prefix} Пользователь размучен.")
+                    unmuted_count += 1
+                    action_taken_this_user = True
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    error_kind = classify_aiogram_error(e)
+                    if error_kind == "admin":
+                        logger.warning(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Является администратором, не может быть ограничен/размучен ботом.")
+                    elif error_kind == "gone":
+                        logger.warning(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Не найден в чате. Пропуск анмута. ({e})")
+                    elif error_kind == "unrestricted":
+                         logger.info(f"    [АНМУТ-ИНФО] {current_user_log_prefix} Уже не ограничен или права не изменились. Пропуск анмута. ({e})")
+                    else:
+                        logger.error(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Не удалось размутить: {e}")
+                        error_count += 1
+                except TelegramRetryAfter as e:
+                    logger.warning(f"    [АНМУТ-FLOOD AIOgram] {current_user_log_prefix} Слишком много запросов на размут. Ожидание {e.retry_after} секунд...")
+                    action_limiter.on_retry_after(e.retry_after) # Притормаживаем всех воркеров, а не только этот
+                    await asyncio.sleep(e.retry_after)
+                    try:
+                         await action_limiter.acquire()
+                         await bot.restrict_chat_member(chat_id=chat_id, user_id=user_id, permissions=UNMUTE_PERMISSIONS, until_date=0)
+                         action_limiter.on_success()
+                         logger.info(f"    [АНМУТ-ПОВТОР-УСПЕХ] {current_user_log_prefix} Размучен после ожидания.")
+                         unmuted_count += 1
+                         action_taken_this_user = True
+                    except Exception as e_retry:
+                         logger.error(f"    [АНМУТ-ПОВТОР-ОШИБКА] {current_user_log_prefix} Не удалось размутить после ожидания: {e_retry}", exc_info=True)
+                         error_count += 1
+                except Exception as e:
+                    logger.error(f"    [АНМУТ-НЕИЗВЕСТНАЯ-ОШИБКА] {current_user_log_prefix}: {type(e).__name__} - {e}", exc_info=True)
+                    error_count += 1
+                # --- Очистка мута в БД --- 
+                # Сами записи сбрасываются пачкой (flush_ban_clears), а не запросом на каждого пользователя
+                if db_manager and action_taken_this_user: # Если размут был успешен (или прошлая попытка была успешной)
+                    ban_clears.append(user_id)
+
+            elif not user.deleted: # Если не собачка и не был замучен
+                logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] Не замучен. Анмут не требуется.")
+                skipped_count +=1
+                # --- Дополнительная проверка мута в БД (даже если не замучен по API) ---
+                # Если по API он не замучен, но в БД есть активная запись, ее тоже нужно очистить.
+                # Активные муты чата загружены заранее одним запросом (ban_map) - здесь без обращений к БД
+                ban_until_ts = ban_map.get(user_id)
+                if ban_until_ts and ban_until_ts > int(time.time()):
+                    logger.warning(f"    [БД-НЕСООТВЕТСТВИЕ] Пользователь {current_user_log_prefix} не замучен по API, но в БД есть активный мут до {ban_until_ts}. Запись будет очищена.")
+                    ban_clears.append(user_id)
+
+        async def flush_ban_clears():
+            nonlocal ban_clears, error_count
+            if not ban_clears:
+                return
+            user_ids, ban_clears = ban_clears, []
+            try:
+                await db_manager.bulk_clear_ban_until(chat_id, user_ids)
+                logger.info(f"    [БД-ОЧИСТКА] Записи о муте очищены в БД для {len(user_ids)} пользователей.")
+            except Exception as e_db:
+                logger.error(f"    [БД-ОЧИСТКА-ОШИБКА] Не удалось очистить записи о муте для {len(user_ids)} пользователей в БД: {e_db}", exc_info=True)
+                error_count += 1 # Считаем ошибку БД
+
+        async def produce_participants():
+            nonlocal found_start_point, processed_count, processed_after_resume, skipped_count
+            # Убираем reverse=True и aggressive=True, используем стандартную итерацию.
+            # Страницы подгружаются заранее за счет очереди participant_queue: этот цикл идет независимо от воркеров
             # async for participant in client.iter_participants(chat, aggressive=True, reverse=True):
             async for participant in client.iter_participants(chat):
-                # participant уже является объектом User (или Channel)
                 user = participant
                 current_user_id = user.id # Сохраняем ID для удобства
 
@@ -316,164 +513,49 @@ async def main():
                 # Если мы здесь, значит, пользователь подлежит обработке
                 processed_count += 1 # Общий счетчик просмотренных после точки старта
                 processed_after_resume += 1 # Счетчик реально обработанных
-                action_taken_this_user = False
                 current_user_log_prefix = f"Пользователь {processed_after_resume} (ID: {current_user_id}):" # Используем счетчик после возобновления
 
-                # --- Начало блока обработки пользователя --- 
-                if hasattr(user, 'is_self') and user.is_self:
-                     logger.info(f"  {current_user_log_prefix} Пропуск (этот аккаунт Telethon)...")
-                     skipped_count += 1
-                     await asyncio.sleep(0.01)
-                     continue
-
-                # Пропускаем самого бота AIOgram, используя сохраненный ID
-                if user.id == bot_id:
-                    logger.info(f"  {current_user_log_prefix} Пропуск (AIOgram бот)...")
+                # Админы, бот AIOgram и аккаунт Telethon - одна проверка по множеству, без запросов к API
+                if current_user_id in skip_ids:
+                    logger.info(f"  {current_user_log_prefix} Пропуск (администратор, бот AIOgram или аккаунт Telethon)...")
                     skipped_count += 1
-                    await asyncio.sleep(0.01)
                     continue
 
-                if user.id in admins_ids:
-                     logger.info(f"  {current_user_log_prefix} Пропуск (Администратор)...")
-                     skipped_count += 1
-                     await asyncio.sleep(0.01)
-                     continue
-
-                logger.info(f"\n--- {current_user_log_prefix} Обработка. Имя: {user.first_name or ''} {user.last_name or ''} (@{user.username or 'N/A'}) ---")
+                in_progress[processed_after_resume] = current_user_id
+                await participant_queue.put((processed_after_resume, participant, current_user_log_prefix))
+
+        async def action_worker():
+            nonlocal error_count, last_save_time
+            while True:
+                item = await participant_queue.get()
+                if item is None:
+                    return
+                seq, participant, current_user_log_prefix = item
+                try:
+                    await handle_participant(participant, current_user_log_prefix)
+                except Exception as e:
+                    logger.error(f"  {current_user_log_prefix} Непредвиденная ошибка обработки: {type(e).__name__} - {e}", exc_info=True)
+                    error_count += 1
+                mark_finished(seq)
+                # Периодически сохраняем прогресс, чтобы при аварийном завершении не начинать сначала
+                if current_last_id_to_save is not None and (seq % SAVE_EVERY_USERS == 0 or time.monotonic() - last_save_time > SAVE_EVERY_SECONDS):
+                    last_save_time = time.monotonic()
+                    await flush_ban_clears()
+                    await save_last_id(STATE_FILE, current_last_id_to_save)
 
-                # 1. Удаление "собачек"
-                if user.deleted:
-                    logger.info(f"  {current_user_log_prefix} [УДАЛЕНИЕ] Является удаленным аккаунтом. Попытка кика через AIOgram...")
-                    try:
-                        await bot.ban_chat_member(chat_id=chat.id, user_id=user.id, revoke_messages=False)
-                        logger.info(f"    [УДАЛЕНИЕ-УСПЕХ] {current_user_log_prefix} Удаленный аккаунт кикнут.")
-                        kicked_deleted_count += 1
-                        action_taken_this_user = True
-                        await asyncio.sleep(DELAY_PER_USER * 1.5)
-                    except (TelegramForbiddenError, TelegramBadRequest) as e:
-                        error_msg_lower = str(e).lower()
-                        if "user is an administrator" in error_msg_lower or "can't remove chat owner" in error_msg_lower:
-                             logger.warning(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Недостаточно прав для кика (вероятно, админ). ({e})")
-                        elif "user not found" in error_msg_lower or "user_not_participant" in error_msg_lower:
-                             logger.warning(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Пользователь уже не в чате. ({e})")
-                        else:
-                             logger.error(f"    [УДАЛЕНИЕ-ОШИБКА AIOgram] {current_user_log_prefix} Не удалось кикнуть: {e}")
-                             error_count += 1
-                    except TelegramRetryAfter as e:
-                         logger.warning(f"    [УДАЛЕНИЕ-FLOOD AIOgram] {current_user_log_prefix} Слишком много запросов. Ожидание {e.retry_after} секунд...")
-                         await asyncio.sleep(e.retry_after)
-                         # Можно добавить повторную попытку, но для удаления может быть излишне
-                         error_count += 1 # Считаем как ошибку, т.к. пропустили
-                    except Exception as e:
-                         logger.error(f"    [УДАЛЕНИЕ-НЕИЗВЕСТНАЯ-ОШИБКА] {current_user_log_prefix} Не удалось кикнуть: {type(e).__name__} - {e}", exc_info=True)
-                         error_count += 1
-                    continue # Переход к следующему после попытки кика
-
-                # 2. Анмут (если не "собачка" и не админ)
-                is_muted = False
-                # participant.banned_rights присутствует, если есть *любые* ограничения
-                if hasattr(participant, 'banned_rights') and participant.banned_rights:
-                    # Главный критерий мута - send_messages == False
-                    if not participant.banned_rights.send_messages:
-                        is_muted = True
-                        logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] ЗАМУЧЕН (не может отправлять сообщения).")
-                    else:
-                         # Могут быть другие ограничения (отправка медиа, стикеров и т.д.)
-                         # Можно добавить логику для снятия и этих ограничений, если нужно,
-                         # но UNMUTE_PERMISSIONS уже разрешает все.
-                         # Важно, что он *может* отправлять текстовые сообщения.
-                         logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] Есть ограничения, но может отправлять сообщения. Анмут не требуется.")
-                         logger.debug(f"  {current_user_log_prefix} Детали ограничений: {participant.banned_rights}")
-                         skipped_count += 1 # Считаем как пропуск, т.к. основной анмут не нужен
-
-                if is_muted:
-                    logger.info(f"  {current_user_log_prefix} [АНМУТ] Попытка размутить через AIOgram...")
-                    try:
-                        await bot.restrict_chat_member(
-                            chat_id=chat.id,
-                            user_id=user.id,
-                            permissions=UNMUTE_PERMISSIONS,
-                            until_date=0 # Снять временные ограничения
-                        )
-                        logger.info(f"    [АНМУТ-УСПЕХ] {current_user_log_prefix} Пользователь размучен.")
-                        unmuted_count += 1
-                        action_taken_this_user = True
-                        await asyncio.sleep(DELAY_PER_USER)
-                    except (TelegramForbiddenError, TelegramBadRequest) as e:
-                        error_msg_lower = str(e).lower()
-                        if "user is an administrator" in error_msg_lower:
-                            logger.warning(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Является администратором, не может быть ограничен/размучен ботом.")
-                        elif "user not found" in error_msg_lower or "user_not_participant" in error_msg_lower:
-                            logger.warning(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Не найден в чате. Пропуск анмута. ({e})")
-                        elif "member is not restricted" in error_msg_lower or "rights are same" in error_msg_lower:
-                             logger.info(f"    [АНМУТ-ИНФО] {current_user_log_prefix} Уже не ограничен или права не изменились. Пропуск анмута. ({e})")
-                        else:
-                            logger.error(f"    [АНМУТ-ОШИБКА AIOgram] {current_user_log_prefix} Не удалось размутить: {e}")
-                            error_count += 1
-                    except TelegramRetryAfter as e:
-                        logger.warning(f"    [АНМУТ-FLOOD AIOgram] {current_user_log_prefix} Слишком много запросов на размут. Ожидание {e.retry_after} секунд...")
-                        await asyncio.sleep(e.retry_after)
-                        try:
-                             await bot.restrict_chat_member(chat_id=chat.id, user_id=user.id, permissions=UNMUTE_PERMISSIONS, until_date=0)
-                             logger.info(f"    [АНМУТ-ПОВТОР-УСПЕХ] {current_user_log_prefix} Размучен после ожидания.")
-                             unmuted_count += 1
-                             action_taken_this_user = True
-                             await asyncio.sleep(DELAY_PER_USER)
-                        except Exception as e_retry:
-                             logger.error(f"    [АНМУТ-ПОВТОР-ОШИБКА] {current_user_log_prefix} Не удалось размутить после ожидания: {e_retry}", exc_info=True)
-                             error_count += 1
-                    except Exception as e:
-                        logger.error(f"    [АНМУТ-НЕИЗВЕСТНАЯ-ОШИБКА] {current_user_log_prefix}: {type(e).__name__} - {e}", exc_info=True)
-                        error_count += 1
-                    # --- Дополнительная проверка и очистка мута в БД --- 
-                    if db_manager and action_taken_this_user: # Если размут был успешен (или прошлая попытка была успешной)
-                        try:
-                             # Обновляем статус мута в БД (устанавливаем ban_until_ts = 0)
-                             # Убедитесь, что метод называется правильно!
-                            if hasattr(db_manager, 'update_user_ban_status'): 
-                                await db_manager.update_user_ban_status(user_id=user.id, chat_id=chat.id, ban_until_ts=0)
-                                logger.info(f"    [БД-ОЧИСТКА] Запись о муте для {current_user_log_prefix} очищена в БД.")
-                            else:
-                                 logger.warning(f"    [БД-ОЧИСТКА] Метод 'update_user_ban_status' не найден в DatabaseManager. Не могу очистить запись о муте.")
-                        except Exception as e_db:
-                            logger.error(f"    [БД-ОЧИСТКА-ОШИБКА] Не удалось обновить статус мута для {current_user_log_prefix} в БД: {e_db}", exc_info=True)
-                            error_count += 1 # Считаем ошибку БД
-
-                elif not user.deleted: # Если не собачка и не был замучен
-                    logger.info(f"  {current_user_log_prefix} [ПРОВЕРКА-МУТА] Не замучен. Анмут не требуется.")
-                    skipped_count +=1
-                    # --- Дополнительная проверка и очистка мута в БД (даже если не замучен по API) ---
-                    # Если по API он не замучен, но в БД есть активная запись, ее тоже нужно очистить
-                    if db_manager:
-                         try:
-                              # Нужен метод для проверки статуса мута в БД, например, get_user_ban_until_ts
-                              # Если такого метода нет, эту логику можно убрать или адаптировать
-                              if hasattr(db_manager, 'get_user_ban_until_ts'):
-                                   ban_until_ts = await db_manager.get_user_ban_until_ts(user_id=user.id, chat_id=chat.id)
-                                   current_timestamp = int(time.time())
-                                   if ban_until_ts and ban_until_ts > current_timestamp:
-                                        logger.warning(f"    [БД-НЕСООТВЕТСТВИЕ] Пользователь {current_user_log_prefix} не замучен по API, но в БД есть активный мут до {ban_until_ts}. Очищаем запись...")
-                                        if hasattr(db_manager, 'update_user_ban_status'):
-                                             await db_manager.update_user_ban_status(user_id=user.id, chat_id=chat.id, ban_until_ts=0)
-                                             logger.info(f"    [БД-ОЧИСТКА] Запись о муте для {current_user_log_prefix} очищена в БД.")
-                                        else:
-                                             logger.warning(f"    [БД-ОЧИСТКА] Метод 'update_user_ban_status' не найден. Не могу очистить запись.")
-                              # else:
-                              #      logger.debug(f"    [БД-ПРОВЕРКА] Метод 'get_user_ban_until_ts' не найден. Пропускаем проверку несоответствий.")
-                         except Exception as e_db_check:
-                              logger.error(f"    [БД-ПРОВЕРКА-ОШИБКА] Не удалось проверить/обновить статус для {current_user_log_prefix} в БД: {e_db_check}", exc_info=True)
-                              error_count += 1
-
-                # Задержка, если не было активных действий
-                if not action_taken_this_user and not user.deleted:
-                    await asyncio.sleep(DELAY_PER_USER / 2.0)
-
-                # Обновляем ID для сохранения после КАЖДОЙ успешной попытки обработки
-                # (даже если ошибок не было, но и действий не требовалось)
-                current_last_id_to_save = current_user_id
+        try: # Вложенный try-except для цикла перебора участников
+            workers = [asyncio.create_task(action_worker()) for _ in range(ACTION_WORKERS)]
+            try:
+                await produce_participants()
+            finally:
+                # По одному маркеру конца на воркера; ждем, пока они доделают уже взятых в очередь участников
+                for _ in workers:
+                    await participant_queue.put(None)
+                await asyncio.gather(*workers)
+                await flush_ban_clears()
 
         except ChatAdminRequiredError:
-            logger.critical(f"\nКритическая ошибка Telethon: У аккаунта нет прав администратора в чате '{getattr(chat, 'title', chat.id)}' для перебора участников. Скрипт не может продолжить.")
+            logger.critical(f"\nКритическая ошибка Telethon: У аккаунта нет прав администратора в чате '{chat_title}' для перебора участников. Скрипт не может продолжить.")
             error_count += 1 # Указываем на ошибку перед выходом из цикла
         except FloodWaitError as e:
             logger.error(f"\nTelethon FloodWaitError при переборе участников: Ожидание {e.value} секунд.")
@@ -504,7 +586,7 @@ async def main():
         # Сохраняем последний обработанный ID перед выходом
         if current_last_id_to_save is not None:
             logger.info(f"Сохранение последнего обработанного ID: {current_last_id_to_save}")
-            save_last_id(STATE_FILE, current_last_id_to_save)
+            await save_last_id(STATE_FILE, current_last_id_to_save)
         else:
             logger.info("Нет ID для сохранения (обработка не дошла до участников или произошла ошибка до начала).")
 